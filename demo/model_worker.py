@@ -12,6 +12,8 @@ import asyncio
 import base64
 import json
 import math
+import os
+import sys
 import threading
 import time
 import uuid
@@ -21,16 +23,18 @@ from threading import Thread
 
 import requests
 import torch
-import torchvision.transforms as T
 import uvicorn
-from constants import IMAGENET_MEAN, IMAGENET_STD, WORKER_HEART_BEAT_INTERVAL
+from constants import WORKER_HEART_BEAT_INTERVAL
 from fastapi import BackgroundTasks, FastAPI, Request
 from fastapi.responses import StreamingResponse
 from PIL import Image
-from torchvision.transforms.functional import InterpolationMode
-from transformers import AutoModel, AutoTokenizer, TextIteratorStreamer
+from transformers import AutoModel, TextIteratorStreamer
 from utils import build_logger, pretty_print_semaphore, server_error_msg
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+from earthdial.train.tiling import tile_image  # noqa: E402
+from earthdial.train.tokenizer import load_tokenizer  # noqa: E402
+
 worker_id = str(uuid.uuid4())[:6]
 logger = build_logger('model_worker', f'model_worker_{worker_id}.log')
 global_counter = 0
@@ -41,72 +45,6 @@ def load_image_from_base64(image):
     return Image.open(BytesIO(base64.b64decode(image)))
 
 
-def build_transform(input_size):
-    MEAN, STD = IMAGENET_MEAN, IMAGENET_STD
-    transform = T.Compose([
-        T.Lambda(lambda img: img.convert('RGB') if img.mode != 'RGB' else img),
-        T.Resize((input_size, input_size), interpolation=InterpolationMode.BICUBIC),
-        T.ToTensor(),
-        T.Normalize(mean=MEAN, std=STD)
-    ])
-    return transform
-
-
-def find_closest_aspect_ratio(aspect_ratio, target_ratios, width, height, image_size):
-    best_ratio_diff = float('inf')
-    best_ratio = (1, 1)
-    area = width * height
-    for ratio in target_ratios:
-        target_aspect_ratio = ratio[0] / ratio[1]
-        ratio_diff = abs(aspect_ratio - target_aspect_ratio)
-        if ratio_diff < best_ratio_diff:
-            best_ratio_diff = ratio_diff
-            best_ratio = ratio
-        elif ratio_diff == best_ratio_diff:
-            if area > 0.5 * image_size * image_size * ratio[0] * ratio[1]:
-                best_ratio = ratio
-    return best_ratio
-
-
-def dynamic_preprocess(image, min_num=1, max_num=6, image_size=448, use_thumbnail=False):
-    orig_width, orig_height = image.size
-    aspect_ratio = orig_width / orig_height
-
-    # calculate the existing image aspect ratio
-    target_ratios = set(
-        (i, j) for n in range(min_num, max_num + 1) for i in range(1, n + 1) for j in range(1, n + 1) if
-        i * j <= max_num and i * j >= min_num)
-    target_ratios = sorted(target_ratios, key=lambda x: x[0] * x[1])
-
-    # find the closest aspect ratio to the target
-    target_aspect_ratio = find_closest_aspect_ratio(
-        aspect_ratio, target_ratios, orig_width, orig_height, image_size)
-
-    # calculate the target width and height
-    target_width = image_size * target_aspect_ratio[0]
-    target_height = image_size * target_aspect_ratio[1]
-    blocks = target_aspect_ratio[0] * target_aspect_ratio[1]
-
-    # resize the image
-    resized_img = image.resize((target_width, target_height))
-    processed_images = []
-    for i in range(blocks):
-        box = (
-            (i % (target_width // image_size)) * image_size,
-            (i // (target_width // image_size)) * image_size,
-            ((i % (target_width // image_size)) + 1) * image_size,
-            ((i // (target_width // image_size)) + 1) * image_size
-        )
-        # split the image
-        split_img = resized_img.crop(box)
-        processed_images.append(split_img)
-    assert len(processed_images) == blocks
-    if use_thumbnail and len(processed_images) != 1:
-        thumbnail_img = image.resize((image_size, image_size))
-        processed_images.append(thumbnail_img)
-    return processed_images
-
-
 def heart_beat_worker(controller):
     while True:
         time.sleep(WORKER_HEART_BEAT_INTERVAL)
@@ -151,7 +89,7 @@ def split_model(model_name, vit_alpha=0.5):
 
 class ModelWorker:
     def __init__(self, controller_addr, worker_addr, worker_id, model_path, model_name,
-                 load_8bit, device, context_len=8192):
+                 load_8bit, device, context_len=8192, use_fast_tokenizer=False):
         self.controller_addr = controller_addr
         self.worker_addr = worker_addr
         self.worker_id = worker_id
@@ -168,7 +106,7 @@ class ModelWorker:
 
         logger.info(f'Loading the model {self.model_name} on worker {worker_id} ...')
 
-        tokenizer = AutoTokenizer.from_pretrained(model_path, trust_remote_code=True, use_fast=False)
+        tokenizer = load_tokenizer(model_path, use_fast=use_fast_tokenizer)
         tokens_to_keep = ['<box>', '</box>', '<ref>', '</ref>']
         tokenizer.additional_special_tokens = [item for item in tokenizer.additional_special_tokens if item not in tokens_to_keep]
         self.tokenizer = tokenizer
@@ -316,19 +254,15 @@ class ModelWorker:
         old_system_message = self.model.system_message
         self.model.system_message = system_message
         image_tiles, num_patches_list = [], []
-        transform = build_transform(input_size=self.image_size)
         if len(pil_images) > 0:
             for current_max_input_tiles, pil_image in zip(max_input_tile_list, pil_images):
-                if self.model.config.dynamic_image_size:
-                    tiles = dynamic_preprocess(
-                        pil_image, image_size=self.image_size, max_num=current_max_input_tiles,
-                        use_thumbnail=self.model.config.use_thumbnail)
-                else:
-                    tiles = [pil_image]
-                num_patches_list.append(len(tiles))
-                image_tiles += tiles
-            pixel_values = [transform(item) for item in image_tiles]
-            pixel_values = torch.stack(pixel_values).to(self.model.device, dtype=torch.bfloat16)
+                tiles = tile_image(
+                    pil_image, image_size=self.image_size, max_num=current_max_input_tiles,
+                    use_thumbnail=self.model.config.use_thumbnail,
+                    dynamic=self.model.config.dynamic_image_size)
+                num_patches_list.append(tiles.size(0))
+                image_tiles.append(tiles)
+            pixel_values = torch.cat(image_tiles).to(self.model.device, dtype=torch.bfloat16)
             logger.info(f'Split images to {pixel_values.shape}')
         else:
             pixel_values = None
@@ -436,6 +370,7 @@ if __name__ == '__main__':
     parser.add_argument('--limit-model-concurrency', type=int, default=5)
     parser.add_argument('--stream-interval', type=int, default=1)
     parser.add_argument('--load-8bit', action='store_true')
+    parser.add_argument('--use-fast-tokenizer', action='store_true')
     args = parser.parse_args()
     logger.info(f'args: {args}')
 
@@ -445,5 +380,6 @@ if __name__ == '__main__':
                          args.model_path,
                          args.model_name,
                          args.load_8bit,
-                         args.device)
+                         args.device,
+                         use_fast_tokenizer=args.use_fast_tokenizer)
     uvicorn.run(app, host=args.host, port=args.port, log_level='info')
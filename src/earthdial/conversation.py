@@ -5,7 +5,8 @@ Conversation prompt templates.
 
 import dataclasses
 from enum import IntEnum, auto
-from typing import Any, Dict, List, Tuple, Union
+from functools import lru_cache
+from typing import Any, Dict, List, Optional, Tuple, Union
 
 
 class SeparatorStyle(IntEnum):
@@ -328,6 +329,103 @@ def get_conv_template(name: str) -> Conversation:
     return conv_templates[name].copy()
 
 
+@dataclasses.dataclass(frozen=True)
+class TemplateTokens:
+    """Token ids of the fixed parts of a conversation template, for one tokenizer and system message.
+
+    Every prompt of the template starts with `prefix`, the system prompt and its separator, so
+    `prefix_ids` are also the prefix whose keys and values can be shared across prompts at inference.
+    """
+
+    # The rendered system prompt and separator
+    prefix: str
+    # Its token ids, with the special tokens the tokenizer adds in front (e.g. <s>)
+    prefix_ids: Tuple[int, ...]
+    # The token ids of the header of each role, as in a prompt; the assistant header and the
+    # separator delimit the answers for label masking (`assistant_boundaries`)
+    role_ids: Tuple[Tuple[int, ...], ...]
+    # The token ids of the separator closing every message
+    sep_ids: Tuple[int, ...]
+
+    def encode(self, tokenizer, prompts: List[str], max_length: Optional[int] = None) -> List[List[int]]:
+        """
+        Token ids of rendered prompts, those of `tokenizer(prompts).input_ids`, tokenizing only what
+        follows the prefix. With `max_length`, the ids are truncated as with `truncation=True`.
+        """
+        if not all(prompt.startswith(self.prefix) for prompt in prompts) or (
+                max_length is not None and max_length <= len(self.prefix_ids)):
+            return tokenizer(prompts, **_truncation(max_length)).input_ids
+        bodies = [prompt[len(self.prefix):] for prompt in prompts]
+        body_length = None if max_length is None else max_length - len(self.prefix_ids)
+        body_ids = tokenizer(bodies, add_special_tokens=False, **_truncation(body_length)).input_ids
+        return [list(self.prefix_ids) + ids for ids in body_ids]
+
+
+def _truncation(max_length):
+    return {} if max_length is None else {'max_length': max_length, 'truncation': True}
+
+
+@lru_cache(maxsize=None)
+def _template_tokens(name, system_message, tokenizer, vocab_size):
+    conv = get_conv_template(name)
+    if system_message is not None:
+        conv.system_message = system_message
+    if conv.sep_style != SeparatorStyle.MPT:
+        return None
+    prefix = conv.system_template.format(system_message=conv.system_message) + conv.sep
+
+    def encode(text):
+        ids = tokenizer(text, add_special_tokens=False).input_ids
+        # Legacy sentencepiece tokenizers prepend a lone '▁' to a text starting with a special token,
+        # which a role header following the separator in a prompt does not have
+        while ids and tokenizer.convert_ids_to_tokens(ids[0]) == '▁':
+            ids = ids[1:]
+        return ids
+
+    template_tokens = TemplateTokens(
+        prefix=prefix,
+        prefix_ids=tuple(tokenizer(prefix).input_ids),
+        role_ids=tuple(tuple(encode(role)) for role in conv.roles),
+        sep_ids=tuple(encode(conv.sep)),
+    )
+    # The prefix ids are only reusable when the separator is a token the tokenizer splits the text
+    # on, and when the tokenizer adds no special tokens at the end (e.g. add_eos_token=True)
+    probe = conv.copy()
+    probe.append_message(conv.roles[0], ' <image>\nHow many ships? ')
+    probe.append_message(conv.roles[1], '\nThree ships.\n')
+    probe.append_message(conv.roles[0], 'And planes?')
+    probe.append_message(conv.roles[1], None)
+    for prompt in (probe.get_prompt(), conv.get_prompt()):
+        if template_tokens.encode(tokenizer, [prompt])[0] != tokenizer(prompt).input_ids:
+            return None
+    return template_tokens
+
+
+def get_template_tokens(name: str, tokenizer, system_message: Optional[str] = None) -> Optional[TemplateTokens]:
+    """
+    Get the cached token ids of the fixed parts of a conversation template.
+
+    Args:
+        name (str): Name of the template.
+        tokenizer: The tokenizer, once its special tokens have been added.
+        system_message (str): System message replacing that of the template.
+
+    Returns:
+        TemplateTokens | None: None when the prompts of the template cannot be tokenized after
+            a cached prefix with the same ids, e.g. its separator is not a special token.
+    """
+    return _template_tokens(name, system_message, tokenizer, len(tokenizer))
+
+
+def tokenize_prompts(tokenizer, prompts: List[str], name: str, system_message: Optional[str] = None,
+                     max_length: Optional[int] = None) -> List[List[int]]:
+    """Token ids of prompts rendered with a template, with the ids of its prefix cached when possible."""
+    template_tokens = get_template_tokens(name, tokenizer, system_message)
+    if template_tokens is None:
+        return tokenizer(prompts, **_truncation(max_length)).input_ids
+    return template_tokens.encode(tokenizer, prompts, max_length)
+
+
 # InternVL-Chat-V1-1 template
 register_conv_template(
     Conversation(
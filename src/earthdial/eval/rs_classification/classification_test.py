@@ -10,10 +10,11 @@ import sys
 sys.path.append('./src')
 import torch
 from earthdial.model.internvl_chat import InternVLChatModel
-from earthdial.train.dataset import build_transform, dynamic_preprocess
+from earthdial.train.tokenizer import load_tokenizer
+from earthdial.train.dataset import build_transform
+from earthdial.train.tiling import tile_image
 from PIL import Image
 from tqdm import tqdm
-from transformers import AutoTokenizer
 import json
 from datasets import load_from_disk
 import numpy as np
@@ -117,6 +118,7 @@ class ClassificationDataset(torch.utils.data.Dataset):
         self.transform = build_transform(is_train=False, input_size=input_size)
 
         self.model=model        
+        self.normalize_type = normalize_type
         self.transform = build_transform(is_train=False, input_size=input_size,normalize_type=normalize_type)
         self.pooling = pooling
         
@@ -160,11 +162,11 @@ class ClassificationDataset(torch.utils.data.Dataset):
       
 
         if self.ds_name in {'AID', 'UCM', 'WHU_19', 'BigEarthNet_RGB'}:
-            images = (dynamic_preprocess(image, image_size=self.input_size,
-                                        use_thumbnail=self.use_thumbnail,
-                                        max_num=self.max_num)
-                    if self.dynamic_image_size else [image])
-            pixel_values = torch.stack([self.transform(img) for img in images])
+            pixel_values = tile_image(image, image_size=self.input_size,
+                                      use_thumbnail=self.use_thumbnail,
+                                      max_num=self.max_num,
+                                      normalize_type=self.normalize_type,
+                                      dynamic=self.dynamic_image_size)
         else:
             if self.ds_name == 'UHI_test':
                 image = self.convert_ms_bands(image)
@@ -302,6 +304,7 @@ if __name__ == '__main__':
     parser.add_argument('--load-in-8bit', action='store_true')
     parser.add_argument('--load-in-4bit', action='store_true')
     parser.add_argument('--auto', action='store_true')
+    parser.add_argument('--use-fast-tokenizer', action='store_true')
     args = parser.parse_args()
 
     if not os.path.exists(args.out_dir):
@@ -322,7 +325,7 @@ if __name__ == '__main__':
     if args.auto:
         os.environ['CUDA_LAUNCH_BLOCKING'] = '1'
     kwargs = {'device_map': 'auto'} if args.auto else {}
-    tokenizer = AutoTokenizer.from_pretrained(args.checkpoint, trust_remote_code=True, use_fast=False)
+    tokenizer = load_tokenizer(args.checkpoint, use_fast=args.use_fast_tokenizer)
     model = InternVLChatModel.from_pretrained(
         args.checkpoint, low_cpu_mem_usage=True, torch_dtype=torch.bfloat16,
         load_in_8bit=args.load_in_8bit, load_in_4bit=args.load_in_4bit, **kwargs).eval()
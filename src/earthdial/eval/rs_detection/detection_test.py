@@ -12,10 +12,11 @@ import sys
 sys.path.append('./src')
 import torch
 from earthdial.model.internvl_chat import InternVLChatModel
-from earthdial.train.dataset import build_transform, dynamic_preprocess
+from earthdial.train.tokenizer import load_tokenizer
+from earthdial.train.dataset import build_transform
+from earthdial.train.tiling import tile_image
 from PIL import Image
 from tqdm import tqdm
-from transformers import AutoTokenizer
 
 import torch.distributed as dist
 from itertools import islice
@@ -88,6 +89,7 @@ class RSDataset(torch.utils.data.Dataset):
         self.dynamic_image_size = dynamic_image_size
         self.use_thumbnail = use_thumbnail
         self.max_num = max_num
+        self.normalize_type = normalize_type
         self.transform = build_transform(is_train=False, input_size=input_size,normalize_type=normalize_type)
         self.ds_name = ds_name
         self.pooling = pooling
@@ -109,11 +111,11 @@ class RSDataset(torch.utils.data.Dataset):
 
         if self.ds_name in {'GeoChat', 'NWPU_VHR_10', 'Swimming_pool_dataset', 'urban_tree_crown_detection'}:
             
-            images = (dynamic_preprocess(image, image_size=self.input_size,
-                                        use_thumbnail=self.use_thumbnail,
-                                        max_num=self.max_num)
-                    if self.dynamic_image_size else [image])
-            pixel_values = torch.stack([self.transform(img) for img in images])
+            pixel_values = tile_image(image, image_size=self.input_size,
+                                      use_thumbnail=self.use_thumbnail,
+                                      max_num=self.max_num,
+                                      normalize_type=self.normalize_type,
+                                      dynamic=self.dynamic_image_size)
         else:
             pixel_values = self.transform(image).unsqueeze(0)
             pixel_values = self.model.sequential_vit_features(pixel_values, self.pooling)
@@ -250,6 +252,7 @@ if __name__ == '__main__':
     parser.add_argument('--load-in-8bit', action='store_true')
     parser.add_argument('--load-in-4bit', action='store_true')
     parser.add_argument('--auto', action='store_true')
+    parser.add_argument('--use-fast-tokenizer', action='store_true')
     args = parser.parse_args()
 
     if not os.path.exists(args.out_dir):
@@ -271,7 +274,7 @@ if __name__ == '__main__':
         os.environ['CUDA_LAUNCH_BLOCKING'] = '1'
     kwargs = {'device_map': 'auto'} if args.auto else {}
     PATTERN = re.compile(r'\[*\[(.*?),(.*?),(.*?),(.*?)\]\]*')
-    tokenizer = AutoTokenizer.from_pretrained(args.checkpoint, trust_remote_code=True, use_fast=False)
+    tokenizer = load_tokenizer(args.checkpoint, use_fast=args.use_fast_tokenizer)
     model = InternVLChatModel.from_pretrained(
         args.checkpoint, low_cpu_mem_usage=True, torch_dtype=torch.bfloat16,
         load_in_8bit=args.load_in_8bit, load_in_4bit=args.load_in_4bit, **kwargs).eval()
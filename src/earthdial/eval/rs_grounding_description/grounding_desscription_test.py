@@ -11,10 +11,10 @@ import sys
 sys.path.append('./src')
 import torch
 from earthdial.model.internvl_chat import InternVLChatModel
-from earthdial.train.dataset import build_transform, dynamic_preprocess
+from earthdial.train.tokenizer import load_tokenizer
+from earthdial.train.tiling import tile_image
 from PIL import Image
 from tqdm import tqdm
-from transformers import AutoTokenizer
 import json
 
 import nltk
@@ -83,7 +83,6 @@ class RSDataset(torch.utils.data.Dataset):
         self.max_num = max_num
         self.ds_name = ds_name
         
-        self.transform = build_transform(is_train=False, input_size=input_size)
 
     def __len__(self):
         return len(self.test)
@@ -104,14 +103,10 @@ class RSDataset(torch.utils.data.Dataset):
             
             
         
-        if self.dynamic_image_size:
-            images = dynamic_preprocess(image, image_size=self.input_size,
-                                        use_thumbnail=self.use_thumbnail,
-                                        max_num=self.max_num)
-        else:
-            images = [image]
-        pixel_values = [self.transform(image) for image in images]
-        pixel_values = torch.stack(pixel_values)
+        pixel_values = tile_image(image, image_size=self.input_size,
+                                  use_thumbnail=self.use_thumbnail,
+                                  max_num=self.max_num,
+                                  dynamic=self.dynamic_image_size)
         
         return {
             'question': question,
@@ -249,6 +244,7 @@ if __name__ == '__main__':
     parser.add_argument('--load-in-8bit', action='store_true')
     parser.add_argument('--load-in-4bit', action='store_true')
     parser.add_argument('--auto', action='store_true')
+    parser.add_argument('--use-fast-tokenizer', action='store_true')
     args = parser.parse_args()
 
     if not os.path.exists(args.out_dir):
@@ -270,7 +266,7 @@ if __name__ == '__main__':
     if args.auto:
         os.environ['CUDA_LAUNCH_BLOCKING'] = '1'
     kwargs = {'device_map': 'auto'} if args.auto else {}
-    tokenizer = AutoTokenizer.from_pretrained(args.checkpoint, trust_remote_code=True, use_fast=False)
+    tokenizer = load_tokenizer(args.checkpoint, use_fast=args.use_fast_tokenizer)
     model = InternVLChatModel.from_pretrained(
         args.checkpoint, low_cpu_mem_usage=True, torch_dtype=torch.bfloat16,
         load_in_8bit=args.load_in_8bit, load_in_4bit=args.load_in_4bit, **kwargs).eval()
@@ -0,0 +1,73 @@
+# --------------------------------------------------------
+# InternVL
+# Copyright (c) 2024 OpenGVLab
+# Licensed under The MIT License [see LICENSE for details]
+# --------------------------------------------------------
+"""
+Cross-entropy of the LM head computed over vocabulary chunks, without the `[N, V]` logits.
+
+Only the hidden states of the supervised positions are given, and their logits are computed
+`chunk_size` vocabulary rows at a time, in the forward pass for the log-sum-exp and the target
+logits, and again in the backward pass for the gradients. At most `[M, chunk_size]` logits
+exist at once, for `M` supervised tokens, instead of the `[B, N, V]` logits and their copies.
+"""
+
+import torch
+import torch.nn.functional as F
+
+
+class ChunkedLinearCrossEntropy(torch.autograd.Function):
+
+    @staticmethod
+    def forward(ctx, hidden_states, weight, labels, chunk_size):
+        # hidden_states: [M, C] supervised hidden states, weight: [V, C] LM head, labels: [M]
+        lse = hidden_states.new_full((hidden_states.shape[0],), float('-inf'), dtype=torch.float32)
+        target_logits = hidden_states.new_zeros(hidden_states.shape[0], dtype=torch.float32)
+        for start in range(0, weight.shape[0], chunk_size):
+            # The logits are computed in the dtype of the LM head and the loss in float32, as in the LLMs
+            logits = F.linear(hidden_states, weight[start:start + chunk_size]).float()
+            lse = torch.logaddexp(lse, torch.logsumexp(logits, dim=-1))
+            rows = torch.nonzero((labels >= start) & (labels < start + logits.shape[1])).flatten()
+            target_logits[rows] = logits[rows, labels[rows] - start]
+        ctx.save_for_backward(hidden_states, weight, labels, lse)
+        ctx.chunk_size = chunk_size
+        return (lse - target_logits).mean()
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        hidden_states, weight, labels, lse = ctx.saved_tensors
+        scale = grad_output.float() / hidden_states.shape[0]
+        grad_hidden_states = torch.zeros_like(hidden_states, dtype=torch.float32)
+        grad_weight = torch.zeros_like(weight) if ctx.needs_input_grad[1] else None
+        for start in range(0, weight.shape[0], ctx.chunk_size):
+            weight_chunk = weight[start:start + ctx.chunk_size]
+            # d loss / d logits = (softmax - one_hot(labels)) / M
+            grad_logits = torch.exp(F.linear(hidden_states, weight_chunk).float() - lse[:, None])
+            rows = torch.nonzero((labels >= start) & (labels < start + weight_chunk.shape[0])).flatten()
+            grad_logits[rows, labels[rows] - start] -= 1
+            grad_logits = (grad_logits * scale).to(hidden_states.dtype)
+            if ctx.needs_input_grad[0]:
+                grad_hidden_states += grad_logits @ weight_chunk
+            if grad_weight is not None:
+                grad_weight[start:start + ctx.chunk_size] = grad_logits.t() @ hidden_states
+        return grad_hidden_states.to(hidden_states.dtype), grad_weight, None, None
+
+
+def chunked_linear_cross_entropy(hidden_states, weight, labels, chunk_size=8192, ignore_index=-100):
+    """
+    Mean next-token cross-entropy of `F.linear(hidden_states, weight)` against `labels`.
+
+    Args:
+        hidden_states (torch.Tensor): [B, N, C] last hidden states of the LLM.
+        weight (torch.Tensor): [V, C] weight of its LM head, without bias.
+        labels (torch.Tensor): [B, N] labels, not yet shifted; `ignore_index` is not supervised.
+        chunk_size (int): Vocabulary rows whose logits are computed at once.
+
+    Returns:
+        torch.Tensor: The loss of `CrossEntropyLoss` over the shifted logits and labels.
+    """
+    shift_labels = labels[..., 1:].to(hidden_states.device)
+    supervised = shift_labels != ignore_index
+    return ChunkedLinearCrossEntropy.apply(
+        hidden_states[..., :-1, :][supervised], weight, shift_labels[supervised], chunk_size
+    )
@@ -37,6 +37,8 @@ class InternVLChatConfig(PretrainedConfig):
             ps_version='v1',
             min_dynamic_patch=1,
             max_dynamic_patch=6,
+            loss_chunk_size=0,
+            vit_chunk_size=0,
             **kwargs):
         super().__init__(**kwargs)
 
@@ -71,6 +73,8 @@ class InternVLChatConfig(PretrainedConfig):
         self.ps_version = ps_version  # pixel shuffle version
         self.min_dynamic_patch = min_dynamic_patch
         self.max_dynamic_patch = max_dynamic_patch
+        self.loss_chunk_size = loss_chunk_size  # vocabulary chunk of the training loss, 0 for the full logits
+        self.vit_chunk_size = vit_chunk_size  # band groups per ViT call of multi-band images, 0 for all at once
 
         logger.info(f'vision_select_layer: {self.select_layer}')
         logger.info(f'ps_version: {self.ps_version}')
@@ -100,5 +104,7 @@ class InternVLChatConfig(PretrainedConfig):
         output['ps_version'] = self.ps_version
         output['min_dynamic_patch'] = self.min_dynamic_patch
         output['max_dynamic_patch'] = self.max_dynamic_patch
+        output['loss_chunk_size'] = self.loss_chunk_size
+        output['vit_chunk_size'] = self.vit_chunk_size
 
         return output
@@ -11,9 +11,12 @@ import torch.utils.checkpoint
 import transformers
 import torch.nn.functional as F
 import math
-from earthdial.conversation import get_conv_template
+from earthdial.conversation import get_conv_template, tokenize_prompts
 from earthdial.model.internlm2.modeling_internlm2 import InternLM2ForCausalLM
+from earthdial.model.modality import MULTIBAND_MODALITY
 from earthdial.model.phi3.modeling_phi3 import Phi3ForCausalLM
+from earthdial.train.image_tokens import insert_image_placeholders, splice_image_tokens
+from earthdial.train.profiler import device_stage
 from peft import LoraConfig, get_peft_model
 from torch import nn
 from torch.nn import CrossEntropyLoss
@@ -23,12 +26,12 @@ from transformers.modeling_outputs import CausalLMOutputWithPast
 from transformers.modeling_utils import PreTrainedModel
 from transformers.utils import ModelOutput, logging
 
+from .chunked_cross_entropy import chunked_linear_cross_entropy
 from .configuration_internvl_chat import InternVLChatConfig
 from .modeling_intern_vit import InternVisionModel
 
 logger = logging.get_logger(__name__)
 
-import multiprocessing
 
 def version_cmp(v1, v2, op='eq'):
     import operator
@@ -142,6 +145,7 @@ class InternVLChatModel(PreTrainedModel):
             attention_mask: Optional[torch.Tensor] = None,
             position_ids: Optional[torch.LongTensor] = None,
             image_flags: Optional[torch.LongTensor] = None,
+            image_modality: Optional[torch.LongTensor] = None,
             past_key_values: Optional[List[torch.FloatTensor]] = None,
             labels: Optional[torch.LongTensor] = None,
             use_cache: Optional[bool] = None,
@@ -154,7 +158,7 @@ class InternVLChatModel(PreTrainedModel):
         image_flags = image_flags.squeeze(-1)
         input_embeds = self.language_model.get_input_embeddings()(input_ids).clone() # Text embeds [1,4096,3072]
 
-        vit_embeds = self.extract_feature(pixel_values) # output feature [[1,256,3072]]
+        vit_embeds = self.extract_feature(pixel_values, image_modality) # output feature [[1,256,3072]]
         vit_embeds = vit_embeds[image_flags == 1]
         vit_batch_size = pixel_values.shape[0]
 
@@ -179,6 +183,37 @@ class InternVLChatModel(PreTrainedModel):
 
         input_embeds = input_embeds.reshape(B, N, C) #[1,4096,3072]
 
+        lm_head = self.language_model.get_output_embeddings()
+        if (labels is not None and self.training and self.config.loss_chunk_size
+                and lm_head.bias is None and not hasattr(lm_head.weight, 'ds_id')):
+            # The loss is computed from the hidden states of the supervised positions, over vocabulary
+            # chunks, and no logits are returned (not with ZeRO-3, whose LM head weight is partitioned)
+            outputs = self.language_model.get_decoder()(
+                inputs_embeds=input_embeds,
+                attention_mask=attention_mask,
+                position_ids=position_ids,
+                past_key_values=past_key_values,
+                use_cache=use_cache,
+                output_attentions=output_attentions,
+                output_hidden_states=output_hidden_states,
+                return_dict=True,
+            )
+            logits = None
+            loss = chunked_linear_cross_entropy(
+                outputs.last_hidden_state, lm_head.weight, labels, self.config.loss_chunk_size
+            )
+            if ignore_flag:
+                loss = loss * 0.0
+            if not return_dict:
+                return (loss, logits) + outputs[1:]
+            return CausalLMOutputWithPast(
+                loss=loss,
+                logits=logits,
+                past_key_values=outputs.past_key_values,
+                hidden_states=outputs.hidden_states,
+                attentions=outputs.attentions,
+            )
+
         outputs = self.language_model(
             inputs_embeds=input_embeds,
             attention_mask=attention_mask,
@@ -234,159 +269,127 @@ class InternVLChatModel(PreTrainedModel):
             x = x.permute(0, 2, 1, 3).contiguous()
         return x
     
-    def bilinear_interpolate_and_concat(self,emds, final_size=(1024, 1024)):
-	
-        num_channels = len(emds)
+    def bilinear_interpolate_and_concat(self, emds, final_size=(1024, 1024)):
+        # emds: [B, G, T, D] ViT features per band group (a list of G [B, T, D] tensors is also accepted).
+        # Each group's T x D map is resized into its cell of a near-square grid covering final_size.
+        if isinstance(emds, (list, tuple)):
+            emds = torch.stack(emds, dim=1)
+        batch_size, num_channels = emds.shape[:2]
         if num_channels == 1:
             # If there is only one channel
-            return F.interpolate(emds[0].unsqueeze(0), size=final_size, mode='bilinear', align_corners=False).squeeze(0)
-        
+            return F.interpolate(emds, size=final_size, mode='bilinear', align_corners=False).squeeze(1)
+
         # Determine the grid dimensions
         num_rows = math.ceil(math.sqrt(num_channels))
         num_cols = math.ceil(num_channels / num_rows)
-        
-        # Calculate width and height for each embedding
-        target_width = final_size[1] // num_cols
-        target_height = final_size[0] // num_rows
-        
-        # To ensure final concatenation yields exactly 1024x1024
-        adjusted_heights = [target_height] * num_rows
-        adjusted_widths = [target_width] * num_cols
-
-        # Distribute any remaining pixels across the first few rows and columns
-        height_remainder = final_size[0] - (target_height * num_rows)
-        width_remainder = final_size[1] - (target_width * num_cols)
-        for i in range(height_remainder):
-            adjusted_heights[i] += 1
-        for j in range(width_remainder):
-            adjusted_widths[j] += 1
-
-        # Interpolate each embedding and arrange in a grid
-        resized_emds = []
-        for i, emd in enumerate(emds):
-            row = i // num_cols
-            col = i % num_cols
-            resized_emds.append(F.interpolate(
-                emd.unsqueeze(0),
-                size=(adjusted_heights[row], adjusted_widths[col]),
+
+        # Calculate width and height for each cell, distributing any remaining pixels
+        # across the first few rows and columns so the grid covers exactly final_size
+        adjusted_heights = [final_size[0] // num_rows + int(i < final_size[0] % num_rows) for i in range(num_rows)]
+        adjusted_widths = [final_size[1] // num_cols + int(j < final_size[1] % num_cols) for j in range(num_cols)]
+        row_offsets = [sum(adjusted_heights[:i]) for i in range(num_rows)]
+        col_offsets = [sum(adjusted_widths[:j]) for j in range(num_cols)]
+
+        # Cells of a missing trailing column stay zero, as with the previous right padding
+        final_tensor = emds.new_zeros(batch_size, final_size[0], final_size[1])
+
+        # Interpolate all groups (and the whole batch) that share a cell size in one call
+        cells = {}
+        for i in range(num_channels):
+            row, col = divmod(i, num_cols)
+            cells.setdefault((adjusted_heights[row], adjusted_widths[col]), []).append(i)
+        for (cell_height, cell_width), groups in cells.items():
+            resized = F.interpolate(
+                emds[:, groups],
+                size=(cell_height, cell_width),
                 mode='bilinear',
                 align_corners=False
-            ))
-
-        # Concatenate the embeddings into rows, then concatenate rows into the final tensor
-        grid_rows = []
-        for row in range(num_rows):
-            row_embeddings = resized_emds[row * num_cols:(row + 1) * num_cols]
-            row_concat = torch.cat(row_embeddings, dim=-1)  # Concatenate along width
-            grid_rows.append(row_concat)
-        
-        # Ensure each row has the same width (pad if necessary)
-        max_width = max([row.shape[-1] for row in grid_rows])
-        grid_rows = [F.pad(row, (0, max_width - row.shape[-1])) for row in grid_rows]
-
-        # Concatenate rows along height to form the final tensor
-        final_tensor = torch.cat(grid_rows, dim=-2)  # Concatenate rows along height
-        
-        final_tensor = final_tensor.squeeze(0)
+            )
+            for k, i in enumerate(groups):
+                row, col = divmod(i, num_cols)
+                final_tensor[:, row_offsets[row]:row_offsets[row] + cell_height,
+                             col_offsets[col]:col_offsets[col] + cell_width] = resized[:, k]
         return final_tensor
-    
+
+    def forward_vision(self, pixel_values):
+        if self.select_layer == -1:
+            # Pass to CLIP and extract features for the RGB [1,3,448,448]
+            vit_embeds = self.vision_model(
+                pixel_values=pixel_values,
+                output_hidden_states=False,
+                return_dict=True).last_hidden_state
+        else:
+            vit_embeds = self.vision_model(
+                pixel_values=pixel_values,
+                output_hidden_states=True,
+                return_dict=True).hidden_states[self.select_layer]
+        return vit_embeds[:, 1:, :] # [1,1024,1024] # Remove the CLS token from the model
+
     @torch.no_grad()
-    def sequential_vit_features(self, pixel_values,mm_spatial_pool_mode):
-        multiprocessing.set_start_method("spawn", force=True)
-        # Determine batch size, number of channels, height, and width
+    def sequential_vit_features(self, pixel_values, mm_spatial_pool_mode, vit_chunk_size=None):
+        # pixel_values: [B, C, H, W] normalized bands. Every 3-band group of every sample goes through
+        # the ViT in one batch (or in chunks of `vit_chunk_size` groups) and is fused on the device.
         batch_size, num_channels, height, width = pixel_values.shape
-        
-        # List to store the outputs for each 3-channel subset across the batch
-        vit_outputs = []
-
-        # Process each batch entry individually
-        for batch_idx in range(batch_size):
-            single_vit_outputs = []  # Temporary list for each 3-channel group for this batch entry
-
-            # Process in groups of 3 channels
-            for i in range(0, num_channels, 3):
-                # Select a subset of up to 3 channels for this batch item
-                subset = pixel_values[batch_idx, i:i + 3, :, :]  # Shape: [C, H, W]
-
-                # If fewer than 3 channels in this subset, pad by duplicating the last channel
-                if subset.shape[0] < 3:
-                  #  print("Subset has less than 3 bands",subset.shape)
-                    padding_needed = 3 - subset.shape[0]
-                    subset = torch.cat([subset] + [subset[-1:]] * padding_needed, dim=0)
-
-                # Add batch dimension for ViT input ([1, 3, H, W])
-                subset = subset.unsqueeze(0)
-                # Move the input tensor to the same device and dtype as the model parameters
-                subset = subset.to(device=next(self.vision_model.parameters()).device, dtype=next(self.vision_model.parameters()).dtype)
-
-                if self.select_layer == -1:
-                    # Pass to CLIP and extract features for the RGB [1,3,448,448]
-                    vit_embeds = self.vision_model(
-                        pixel_values=subset,
-                        output_hidden_states=False,
-                        return_dict=True).last_hidden_state
-                else:
-                    vit_embeds = self.vision_model(
-                        pixel_values=subset,
-                        output_hidden_states=True,
-                        return_dict=True).hidden_states[self.select_layer]
-                vit_embeds = vit_embeds[:, 1:, :].cpu() # [1,1024,1024] # Remove the CLS token from the model
-
-                # Store the embedding output for this subset
-                single_vit_outputs.append(vit_embeds)
-
-            # Stack single_vit_outputs along a new dimension and apply pooling for this batch entry
-            #single_vit_outputs = torch.stack(single_vit_outputs, dim=0)  # Shape: [N, 1, C, H, W]
-            
-            # Apply spatial pooling based on config
-            if mm_spatial_pool_mode == "average":
-                stack_op=torch.stack(single_vit_outputs, dim=0)
-                pooled_output = stack_op.mean(dim=0)  # Average pooling across the 3-channel groups
-            elif mm_spatial_pool_mode == "max":
-                stack_op=torch.stack(single_vit_outputs, dim=0)
-                pooled_output = stack_op.max(dim=0)  # Max pooling across the 3-channel groups
-            elif mm_spatial_pool_mode == "sum":
-                stack_op=torch.stack(single_vit_outputs, dim=0)
-                pooled_output = stack_op.sum(dim=0)  # Sum pooling across the 3-channel groups
-            elif mm_spatial_pool_mode == "bilinear":
-                  pooled_output =self.bilinear_interpolate_and_concat(single_vit_outputs)
-                #     resized_features = [
-                #         torch.nn.functional.interpolate(feature, size=(height, width), mode='bilinear', align_corners=False)
-                #         for feature in single_vit_outputs
-                #     ]
-                # pooled_output = torch.stack(resized_features).mean(dim=0)  # Average resized features
-
-            vit_outputs.append(pooled_output)  # Append pooled result for this batch entry
-
-        # Stack all batch entries and remove extra dimensions if needed
-        vit_outputs  = torch.stack(vit_outputs, dim=0)  # Shape: [B, C, H, W]
-        vision_embeds = vit_outputs.squeeze(0)  # s shape [2, 1024, 1024]
-        if(vision_embeds.size(0)>1) :
-           # print("After Vit before mean across 2 ",vision_embeds.size())
-            vision_embeds=vision_embeds.squeeze(1) 
-            #vision_embeds = vision_embeds.mean(dim=1)  # Average across the embedding dimension
-            #print("After Vit After mean across 2 ",vision_embeds.size())
+        num_groups = math.ceil(num_channels / 3)
+        param = next(self.vision_model.parameters())
+        pixel_values = pixel_values.to(device=param.device, dtype=param.dtype)
+
+        # If the last group has fewer than 3 bands, pad it by duplicating its last band
+        padding_needed = num_groups * 3 - num_channels
+        if padding_needed:
+            pixel_values = torch.cat(
+                [pixel_values, pixel_values[:, -1:].expand(-1, padding_needed, -1, -1)], dim=1)
+        subsets = pixel_values.reshape(batch_size * num_groups, 3, height, width)
+
+        if vit_chunk_size:
+            vit_embeds = torch.cat([self.forward_vision(chunk) for chunk in subsets.split(vit_chunk_size)])
+        else:
+            vit_embeds = self.forward_vision(subsets)
+        vit_embeds = vit_embeds.reshape(batch_size, num_groups, *vit_embeds.shape[1:])  # [B, G, T, D]
+
+        # Fuse the band groups of each sample
+        if mm_spatial_pool_mode == 'average':
+            vision_embeds = vit_embeds.mean(dim=1)
+        elif mm_spatial_pool_mode == 'max':
+            vision_embeds = vit_embeds.amax(dim=1)
+        elif mm_spatial_pool_mode == 'sum':
+            vision_embeds = vit_embeds.sum(dim=1)
+        elif mm_spatial_pool_mode == 'bilinear':
+            vision_embeds = self.bilinear_interpolate_and_concat(vit_embeds)
+        else:
+            raise NotImplementedError(f'{mm_spatial_pool_mode} pooling is not implemented.')
 
         return vision_embeds  # [B,H,W]
 
-    def extract_feature(self, pixel_values):
+    def multiband_mask(self, pixel_values, image_modality=None):
+        # Datasets tag band tensors explicitly; untagged inputs (chat/generate) fall back to the channel count
+        if image_modality is not None:
+            return image_modality.to(pixel_values.device).reshape(-1) == MULTIBAND_MODALITY
+        multiband = pixel_values.ndim == 4 and pixel_values.shape[1] != 3
+        return torch.full((pixel_values.shape[0],), multiband, dtype=torch.bool, device=pixel_values.device)
+
+    def extract_feature(self, pixel_values, image_modality=None, mm_spatial_pool_mode='bilinear'):
         #if  pixel_values.shape[1] !=3:
         if  pixel_values.shape[2] == 1024 or pixel_values.ndim==3:
             #vit_embeds = self.sequential_vit_features(pixel_values,'average')
             vit_embeds = pixel_values #[1,1024,1024]
         else:
-            if self.select_layer == -1:
-                # Pass to CLIP and extract features for the RGB [1,3,448,448]
-                vit_embeds = self.vision_model(
-                    pixel_values=pixel_values,
-                    output_hidden_states=False,
-                    return_dict=True).last_hidden_state
-            else:
-                vit_embeds = self.vision_model(
-                    pixel_values=pixel_values,
-                    output_hidden_states=True,
-                    return_dict=True).hidden_states[self.select_layer]
-            vit_embeds = vit_embeds[:, 1:, :] # [1,1024,1024] # Remove the CLS token from the model
+            multiband = self.multiband_mask(pixel_values, image_modality)
+            with device_stage('vit'):
+                if multiband.all():
+                    # Normalized band tensors [N,C,H,W]: run every band group of the batch through the ViT here
+                    vit_embeds = self.sequential_vit_features(
+                        pixel_values, mm_spatial_pool_mode, self.config.vit_chunk_size)
+                elif not multiband.any():
+                    vit_embeds = self.forward_vision(pixel_values)
+                else:
+                    # A batch mixing modalities: every tile takes the path of its own tag
+                    band_embeds = self.sequential_vit_features(
+                        pixel_values[multiband], mm_spatial_pool_mode, self.config.vit_chunk_size)
+                    rgb_embeds = self.forward_vision(pixel_values[~multiband])
+                    vit_embeds = rgb_embeds.new_empty(pixel_values.shape[0], *rgb_embeds.shape[1:])
+                    vit_embeds[multiband] = band_embeds.to(rgb_embeds.dtype)
+                    vit_embeds[~multiband] = rgb_embeds
 
         h = w = int(vit_embeds.shape[1] ** 0.5) # [1,1024,1024]
         vit_embeds = vit_embeds.reshape(vit_embeds.shape[0], h, w, -1) #([1, 32, 32, 1024])
@@ -424,12 +427,18 @@ class InternVLChatModel(PreTrainedModel):
             template.append_message(template.roles[1], None)
             query = template.get_prompt()
 
-            image_tokens = IMG_START_TOKEN + IMG_CONTEXT_TOKEN * self.num_image_token * num_patches + IMG_END_TOKEN
-            query = query.replace('<image>', image_tokens, 1)
+            # One context marker per image: the image tokens are spliced into the ids
+            query = insert_image_placeholders(query, 1, IMG_START_TOKEN + IMG_CONTEXT_TOKEN + IMG_END_TOKEN)
             queries.append(query)
 
+        input_ids = []
+        for query_ids, num_patches in zip(tokenize_prompts(tokenizer, queries, self.template), num_patches_list):
+            query_ids, = splice_image_tokens(
+                torch.tensor(query_ids), img_context_token_id, [self.num_image_token * num_patches]
+            )
+            input_ids.append(query_ids.tolist())
         tokenizer.padding_side = 'left'
-        model_inputs = tokenizer(queries, return_tensors='pt', padding=True)
+        model_inputs = tokenizer.pad({'input_ids': input_ids}, padding=True, return_tensors='pt')
         input_ids = model_inputs['input_ids'].cuda()
         attention_mask = model_inputs['attention_mask'].cuda()
         eos_token_id = tokenizer.convert_tokens_to_ids(template.sep)
@@ -474,13 +483,16 @@ class InternVLChatModel(PreTrainedModel):
             image_bs = pixel_values.shape[0]
             print(f'dynamic ViT batch size: {image_bs}')
 
-        for num_patches in num_patches_list:
-            image_tokens = IMG_START_TOKEN + IMG_CONTEXT_TOKEN * self.num_image_token * num_patches + IMG_END_TOKEN
-            query = query.replace('<image>', image_tokens, 1)
-
-        model_inputs = tokenizer(query, return_tensors='pt')
-        input_ids = model_inputs['input_ids'].cuda()
-        attention_mask = model_inputs['attention_mask'].cuda()
+        # One context marker per image: the image tokens are spliced into the ids
+        query = insert_image_placeholders(
+            query, len(num_patches_list), IMG_START_TOKEN + IMG_CONTEXT_TOKEN + IMG_END_TOKEN
+        )
+        query_ids = torch.tensor(tokenize_prompts(tokenizer, [query], self.template, self.system_message)[0])
+        query_ids, = splice_image_tokens(
+            query_ids, img_context_token_id, [self.num_image_token * num_patches for num_patches in num_patches_list]
+        )
+        input_ids = query_ids.unsqueeze(0).cuda()
+        attention_mask = torch.ones_like(input_ids)
         generation_config['eos_token_id'] = eos_token_id
         generation_output = self.generate(
             pixel_values=pixel_values,
@@ -0,0 +1,5 @@
+"""Image modality tags of the `image_modality` input of `InternVLChatModel`, one per tile."""
+
+# RGB tiles go through the ViT as they are; multi-band tiles are split into 3-band groups
+RGB_MODALITY = 0
+MULTIBAND_MODALITY = 1
@@ -0,0 +1,47 @@
+import torch
+from flash_attn.flash_attn_interface import flash_attn_varlen_func
+
+from earthdial.model.internlm2.modeling_internlm2 import \
+    InternLM2FlashAttention2
+from earthdial.model.phi3.modeling_phi3 import Phi3FlashAttention2
+
+
+# The attention mask of a packed batch is the [1, n + 1] `cu_seqlens` of its n samples,
+# built by `packed_data_collator`; every sample attends only to its own tokens.
+def _flash_attention_forward(
+    self,
+    query_states,
+    key_states,
+    value_states,
+    attention_mask,
+    query_length,
+    dropout=0.0,
+    softmax_scale=None,
+    use_sliding_windows=False,
+):
+    assert query_states.size(0) == 1, 'packed samples are concatenated into a single row'
+    cu_seqlens = attention_mask.squeeze(0).to(torch.int32)
+    max_seqlen = (cu_seqlens[1:] - cu_seqlens[:-1]).max().item()
+    kwargs = {}
+    if use_sliding_windows:
+        kwargs['window_size'] = (self.config.sliding_window, self.config.sliding_window)
+    attn_output = flash_attn_varlen_func(
+        query_states.squeeze(0),
+        key_states.squeeze(0),
+        value_states.squeeze(0),
+        cu_seqlens_q=cu_seqlens,
+        cu_seqlens_k=cu_seqlens,
+        max_seqlen_q=max_seqlen,
+        max_seqlen_k=max_seqlen,
+        dropout_p=dropout,
+        softmax_scale=softmax_scale,
+        causal=self.is_causal,
+        **kwargs,
+    )
+    return attn_output.unsqueeze(0)
+
+
+def replace_with_packed_flash_attn():
+    InternLM2FlashAttention2._flash_attention_forward = _flash_attention_forward
+    Phi3FlashAttention2._flash_attention_forward = _flash_attention_forward
+    print('Replace flash attention with packed flash attention!!')
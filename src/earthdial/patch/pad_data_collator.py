@@ -1,25 +1,51 @@
+import math
+
 import numpy as np
 import torch
+from torch.utils.data import get_worker_info
+
+from earthdial.train.profiler import BATCH_NAME, record_stage, stage_clock
 
 IGNORE_INDEX = -100
+_LONG = torch.empty(0, dtype=torch.long)
+_BOOL = torch.empty(0, dtype=torch.bool)
+
+
+def new_batch_tensor(elem, shape, pin_memory=False):
+    """
+    Uninitialized batch tensor with the dtype of `elem`.
 
+    In DataLoader workers it is allocated in shared memory, as in `default_collate`, so that
+    the batch reaches the main process without a copy; otherwise it is optionally pinned.
+    """
+    if get_worker_info() is not None:
+        storage = elem._typed_storage()._new_shared(math.prod(shape), device=elem.device)
+        return elem.new(storage).resize_(shape)
+    return torch.empty(shape, dtype=elem.dtype, pin_memory=pin_memory)
 
-def pad_data_collator(features, pad_id=0):
 
+def pad_text_features(features, pad_id=0, pad_to_multiple_of=None, pin_memory=False):
+    # `input_ids`, `labels` and `attention_mask` of the batch, each allocated once and
+    # written in place; the length is optionally rounded up for tensor-core friendly shapes
+    max_item_length = max(feat['input_ids'].shape[0] for feat in features)
+    if pad_to_multiple_of:
+        max_item_length = -(-max_item_length // pad_to_multiple_of) * pad_to_multiple_of
+    shape = (len(features), max_item_length)
+    input_ids = new_batch_tensor(_LONG, shape, pin_memory).fill_(pad_id)
+    labels = new_batch_tensor(_LONG, shape, pin_memory).fill_(IGNORE_INDEX)
+    for idx, feat in enumerate(features):
+        input_ids[idx, :feat['input_ids'].shape[0]] = feat['input_ids']
+        labels[idx, :feat['labels'].shape[0]] = feat['labels']
+    attention_mask = new_batch_tensor(_BOOL, shape, pin_memory)
+    torch.ne(input_ids, pad_id, out=attention_mask)
+    return {'input_ids': input_ids, 'labels': labels, 'attention_mask': attention_mask}
+
+
+def pad_data_collator(features, pad_id=0, pad_to_multiple_of=None, pin_memory=False):
+
+    start = stage_clock()
     first = features[0]
-    batch = {}
-
-    batch_lens = [feat['input_ids'].shape for feat in features]
-    max_item_length = max(batch_lens)[0]
-    for idx in range(len(features)):
-        feat = features[idx]
-        temp_input_ids = torch.LongTensor([pad_id] * max_item_length)
-        temp_input_ids[:feat['input_ids'].shape[0]] = feat['input_ids']
-        feat['input_ids'] = temp_input_ids
-        temp_labels = torch.LongTensor([IGNORE_INDEX] * max_item_length)
-        temp_labels[:feat['labels'].shape[0]] = feat['labels']
-        feat['labels'] = temp_labels
-        feat['attention_mask'] = feat['input_ids'].ne(pad_id)
+    batch = pad_text_features(features, pad_id, pad_to_multiple_of, pin_memory)
 
     # Special handling for labels.
     # Ensure that tensor is created with the correct type
@@ -38,32 +64,23 @@ def pad_data_collator(features, pad_id=0):
     # Handling of all other possible keys.
     # Again, we will use the first element to figure out which key/values are not None for this model.
     for k, v in first.items():
-        if k not in ('label', 'label_ids') and v is not None and not isinstance(v, str):
+        if k not in ('label', 'label_ids', 'input_ids', 'labels', 'attention_mask') and \
+                v is not None and not isinstance(v, str):
             if isinstance(v, torch.Tensor):
                 batch[k] = torch.stack([f[k] for f in features])
             elif isinstance(v, np.ndarray):
                 batch[k] = torch.tensor(np.stack([f[k] for f in features]))
             else:
                 batch[k] = torch.tensor([f[k] for f in features])
+    record_stage('collate', BATCH_NAME, start)
     return batch
 
 
-def concat_pad_data_collator(features, pad_id=0):
+def concat_pad_data_collator(features, pad_id=0, pad_to_multiple_of=None, pin_memory=False):
 
+    start = stage_clock()
     first = features[0]
-    batch = {}
-
-    batch_lens = [feat['input_ids'].shape for feat in features]
-    max_item_length = max(batch_lens)[0]
-    for idx in range(len(features)):
-        feat = features[idx]
-        temp_input_ids = torch.LongTensor([pad_id] * max_item_length)
-        temp_input_ids[:feat['input_ids'].shape[0]] = feat['input_ids']
-        feat['input_ids'] = temp_input_ids
-        temp_labels = torch.LongTensor([IGNORE_INDEX] * max_item_length)
-        temp_labels[:feat['labels'].shape[0]] = feat['labels']
-        feat['labels'] = temp_labels
-        feat['attention_mask'] = feat['input_ids'].ne(pad_id)
+    batch = pad_text_features(features, pad_id, pad_to_multiple_of, pin_memory)
 
     # Special handling for labels.
     # Ensure that tensor is created with the correct type
@@ -82,19 +99,40 @@ def concat_pad_data_collator(features, pad_id=0):
     # Handling of all other possible keys.
     # Again, we will use the first element to figure out which key/values are not None for this model.
     for k, v in first.items():
-        if k not in ('label', 'label_ids', 'pixel_values', 'image_flags') and \
-                v is not None and not isinstance(v, str):
+        if k not in ('label', 'label_ids', 'input_ids', 'labels', 'attention_mask', 'pixel_values',
+                     'image_flags', 'image_modality') and v is not None and not isinstance(v, str):
             if isinstance(v, torch.Tensor):
                 batch[k] = torch.stack([f[k] for f in features])
             elif isinstance(v, np.ndarray):
                 batch[k] = torch.tensor(np.stack([f[k] for f in features]))
             else:
                 batch[k] = torch.tensor([f[k] for f in features])
-        if k in ('pixel_values', 'image_flags'):
-            if isinstance(v, torch.Tensor):
-                batch[k] = torch.concat([f[k] for f in features])
-            elif isinstance(v, np.ndarray):
-                batch[k] = torch.concat(np.stack([f[k] for f in features]))
-            else:
-                batch[k] = torch.concat([f[k] for f in features])
+        if k in ('image_flags', 'image_modality'):
+            batch[k] = torch.concat([torch.as_tensor(f[k]) for f in features])
+    if 'pixel_values' in first:
+        # The tiles of all the samples are written into one batch buffer
+        tiles = [torch.as_tensor(f['pixel_values']) for f in features]
+        shape = (sum(tile.shape[0] for tile in tiles),) + tuple(tiles[0].shape[1:])
+        batch['pixel_values'] = torch.cat(tiles, out=new_batch_tensor(tiles[0], shape, pin_memory))
+    record_stage('collate', BATCH_NAME, start)
+    return batch
+
+
+def packed_data_collator(features):
+    # Packs from `PackedDataset` are concatenated into a single row; the attention mask is
+    # the `cu_seqlens` of all their samples, for the packed flash attention patch. A sample
+    # starts wherever its position ids restart at 0.
+    start = stage_clock()
+    position_ids = torch.cat([feat['position_ids'] for feat in features])
+    sample_starts = torch.nonzero(position_ids == 0).flatten()
+    cu_seqlens = torch.cat([sample_starts, sample_starts.new_tensor([position_ids.size(0)])]).to(torch.int32)
+    batch = {
+        'input_ids': torch.cat([feat['input_ids'] for feat in features]).unsqueeze(0),
+        'labels': torch.cat([feat['labels'] for feat in features]).unsqueeze(0),
+        'position_ids': position_ids.unsqueeze(0),
+        'attention_mask': cu_seqlens.unsqueeze(0),
+    }
+    for k in ('pixel_values', 'image_flags', 'image_modality'):
+        batch[k] = torch.cat([feat[k] for feat in features])
+    record_stage('collate', BATCH_NAME, start)
     return batch
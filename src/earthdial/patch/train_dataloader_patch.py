@@ -0,0 +1,64 @@
+import numpy as np
+import transformers
+from torch.utils.data import DataLoader
+from transformers.trainer_utils import seed_worker
+
+from earthdial.train.shard_stream import WeightedStreamDataset
+
+from earthdial.train.dataset import WeightedConcatDataset
+
+from .train_sampler_patch import MixtureSampler, TokenBudgetBatchSampler
+
+_get_train_dataloader_origin = transformers.Trainer.get_train_dataloader
+
+
+class BudgetDataLoader(DataLoader):
+    # The Trainer reshuffles through `set_epoch` of the training dataloader
+    def set_epoch(self, epoch):
+        self.batch_sampler.set_epoch(epoch)
+
+
+# patch trainer
+def get_train_dataloader(self) -> DataLoader:
+    train_dataset = self.train_dataset
+    data_collator = self._get_collator_with_removed_columns(self.data_collator, description='training')
+    dataloader_params = {
+        'collate_fn': data_collator,
+        'num_workers': self.args.dataloader_num_workers,
+        'pin_memory': self.args.dataloader_pin_memory,
+        'persistent_workers': self.args.dataloader_persistent_workers,
+    }
+
+    # Streams are already split between the ranks: accelerate must neither dispatch
+    # them from rank 0 nor make every rank read the whole stream and keep a shard of it.
+    if isinstance(train_dataset, WeightedStreamDataset):
+        return DataLoader(train_dataset, batch_size=self._train_batch_size, **dataloader_params)
+
+    # Token and tile budget: the batch sampler deals its batches to the ranks itself
+    if getattr(train_dataset, 'max_batch_tokens', None):
+        datasets = train_dataset.datasets
+        batch_sampler = TokenBudgetBatchSampler(
+            lengths=np.concatenate([np.asarray(dataset.length) for dataset in datasets]),
+            # The actual ViT passes of every sample when they were indexed, else their upper bound
+            num_tiles=np.concatenate([
+                getattr(dataset, 'vit_tiles', np.full(len(dataset), dataset.max_num_tiles)) for dataset in datasets
+            ]),
+            max_tokens=train_dataset.max_batch_tokens,
+            max_tiles=train_dataset.max_batch_tiles,
+            world_size=self.args.world_size,
+            rank=self.args.process_index,
+            seed=self.args.seed,
+            modalities=train_dataset.modality_groups(),
+            mixture=MixtureSampler(
+                [len(dataset) for dataset in datasets], train_dataset.num_samples, seed=self.args.seed
+            ) if isinstance(train_dataset, WeightedConcatDataset) else None,
+        )
+        return BudgetDataLoader(train_dataset, batch_sampler=batch_sampler, worker_init_fn=seed_worker,
+                                **dataloader_params)
+
+    return _get_train_dataloader_origin(self)
+
+
+def replace_train_dataloader():
+    transformers.Trainer.get_train_dataloader = get_train_dataloader
+    print('Replace train dataloader!!')
@@ -1,13 +1,18 @@
+import heapq
 from typing import List, Optional
 
+import numpy as np
 import torch
 import transformers
 from torch.utils.data import Dataset, Sampler
 from transformers.tokenization_utils_base import BatchEncoding
-from transformers.trainer import (LengthGroupedSampler, RandomSampler,
-                                  has_length)
+from transformers.trainer import LengthGroupedSampler, has_length
 from transformers.trainer_pt_utils import logger
 
+from earthdial.train.dataset import WeightedConcatDataset
+
+LENGTH_GROUPED_BLOCK_SIZE = 1 << 20
+
 
 # copy from https://github.com/haotian-liu/LLaVA/blob/main/llava/train/llava_trainer.py#L38
 def split_to_even_chunks(indices, lengths, num_chunks):
@@ -21,27 +26,178 @@ def split_to_even_chunks(indices, lengths, num_chunks):
     num_indices_per_chunk = len(indices) // num_chunks
 
     chunks = [[] for _ in range(num_chunks)]
-    chunks_lengths = [0 for _ in range(num_chunks)]
+    # (total length, chunk) of the chunks that are not full yet; ties go to the first chunk
+    heap = [(0, chunk) for chunk in range(num_chunks)]
     for index in indices:
-        shortest_chunk = chunks_lengths.index(min(chunks_lengths))
+        chunk_length, shortest_chunk = heapq.heappop(heap)
         chunks[shortest_chunk].append(index)
-        chunks_lengths[shortest_chunk] += lengths[index]
-        if len(chunks[shortest_chunk]) == num_indices_per_chunk:
-            chunks_lengths[shortest_chunk] = float('inf')
+        if len(chunks[shortest_chunk]) < num_indices_per_chunk:
+            heapq.heappush(heap, (chunk_length + lengths[index], shortest_chunk))
 
     return chunks
 
 
+def split_megabatches_to_even_chunks(megabatches, megabatch_lengths, num_chunks):
+    """
+    `split_to_even_chunks` applied to every row of `megabatches` at once.
+
+    Args:
+        megabatches (np.ndarray): `[num_megabatches, megabatch_size]` indices, longest first.
+        megabatch_lengths (np.ndarray): Their lengths.
+        num_chunks (int): Number of chunks; divides `megabatch_size`.
+
+    Returns:
+        np.ndarray: The indices of every megabatch, reordered chunk after chunk.
+    """
+    num_megabatches, megabatch_size = megabatches.shape
+    num_indices_per_chunk = megabatch_size // num_chunks
+    rows = np.arange(num_megabatches)
+    chunk_lengths = np.zeros((num_megabatches, num_chunks), dtype=np.float64)
+    chunk_sizes = np.zeros((num_megabatches, num_chunks), dtype=np.int64)
+    assignment = np.empty((num_megabatches, megabatch_size), dtype=np.int32)
+    # Same greedy as split_to_even_chunks, one position at a time for all the megabatches
+    for position in range(megabatch_size):
+        shortest_chunk = chunk_lengths.argmin(axis=1)
+        assignment[:, position] = shortest_chunk
+        chunk_lengths[rows, shortest_chunk] += megabatch_lengths[:, position]
+        chunk_sizes[rows, shortest_chunk] += 1
+        full = chunk_sizes[rows, shortest_chunk] == num_indices_per_chunk
+        chunk_lengths[rows[full], shortest_chunk[full]] = np.inf
+    order = np.argsort(assignment, axis=1, kind='stable')
+    return np.take_along_axis(megabatches, order, axis=1)
+
+
+def iter_length_grouped_indices(lengths, batch_size, world_size, generator=None, start=0,
+                                block_size=LENGTH_GROUPED_BLOCK_SIZE, indices=None, costs=None):
+    """
+    Yield the length-grouped order of `get_length_grouped_indices` as numpy blocks.
+
+    Megabatches are sorted and split with vectorized operations, one block of about
+    `block_size` indices at a time. The order starts at position `start`: the blocks
+    before it are never computed. `indices`, e.g. the plan of a `MixtureSampler`, replaces
+    the random permutation of all the indices that is cut into megabatches. Megabatches are
+    sorted by `lengths` and split between the ranks on `costs`, e.g. tokens plus ViT tiles,
+    when given.
+    """
+    lengths = np.asarray(lengths)
+    costs = lengths if costs is None else np.asarray(costs)
+    if indices is None:
+        # We need to use torch for the random part as a distributed sampler will set the random seed for torch.
+        dtype = torch.int32 if len(lengths) < 2 ** 31 else torch.int64
+        indices = torch.randperm(len(lengths), generator=generator, dtype=dtype).numpy()
+    num_indices = len(indices)
+    megabatch_size = world_size * batch_size
+    num_full = num_indices // megabatch_size
+    megabatches_per_block = max(1, block_size // megabatch_size)
+
+    first = start // megabatch_size
+    offset = start - first * megabatch_size
+    for block_start in range(first, num_full, megabatches_per_block):
+        block_stop = min(block_start + megabatches_per_block, num_full)
+        megabatches = indices[block_start * megabatch_size:block_stop * megabatch_size].reshape(-1, megabatch_size)
+        order = np.argsort(-lengths[megabatches], axis=1, kind='stable')
+        megabatches = np.take_along_axis(megabatches, order, axis=1)
+        block = split_megabatches_to_even_chunks(megabatches, costs[megabatches], world_size).reshape(-1)
+        yield block[offset:]
+        offset = 0
+
+    # The last, partial megabatch
+    tail = indices[max(first, num_full) * megabatch_size:]
+    if len(tail):
+        tail = tail[np.argsort(-lengths[tail], kind='stable')]
+        chunks = split_to_even_chunks(tail, costs, world_size)
+        yield np.asarray([i for chunk in chunks for i in chunk], dtype=np.int64)[offset:]
+
+
 # copy from https://github.com/haotian-liu/LLaVA/blob/main/llava/train/llava_trainer.py#L88
-def get_length_grouped_indices(lengths, batch_size, world_size, generator=None, merge=True):
-    # We need to use torch for the random part as a distributed sampler will set the random seed for torch.
-    indices = torch.randperm(len(lengths), generator=generator)
+def get_length_grouped_indices(lengths, batch_size, world_size, generator=None, merge=True, costs=None):
+    return np.concatenate(
+        list(iter_length_grouped_indices(lengths, batch_size, world_size, generator=generator, costs=costs))
+        or [np.zeros(0, dtype=np.int64)]
+    ).tolist()
+
+
+def group_by_modality(indices, modalities, batch_size, world_size, rng, lengths=None, costs=None):
+    """
+    Reorder `indices` into megabatches of `world_size * batch_size` indices of one modality group.
+
+    The indices of every group keep their order and are cut into megabatches; the last,
+    partial megabatch of a group is completed with random indices of the same group, so
+    that no per-device batch straddles two groups. With `lengths`, every megabatch is then
+    sorted and split between the ranks like in `get_length_grouped_indices`, on `costs` when
+    given. The megabatches
+    of the groups are interleaved at random, which keeps their proportions over the epoch.
+    """
+    indices = np.asarray(indices)
     megabatch_size = world_size * batch_size
-    megabatches = [indices[i : i + megabatch_size].tolist() for i in range(0, len(lengths), megabatch_size)]
-    megabatches = [sorted(megabatch, key=lambda i: lengths[i], reverse=True) for megabatch in megabatches]
-    megabatches = [split_to_even_chunks(megabatch, lengths, world_size) for megabatch in megabatches]
+    groups = modalities[indices]
+    megabatches = []
+    for group in np.unique(groups).tolist():
+        members = indices[groups == group]
+        padding = -len(members) % megabatch_size
+        if padding:
+            members = np.concatenate([members, rng.choice(members, padding)])
+        megabatches.append(members.reshape(-1, megabatch_size))
+    megabatches = np.concatenate(megabatches)
+    if lengths is not None:
+        costs = lengths if costs is None else costs
+        order = np.argsort(-lengths[megabatches], axis=1, kind='stable')
+        megabatches = np.take_along_axis(megabatches, order, axis=1)
+        megabatches = split_megabatches_to_even_chunks(megabatches, costs[megabatches], world_size)
+    return megabatches[rng.permutation(len(megabatches))].reshape(-1)
+
 
-    return [i for megabatch in megabatches for batch in megabatch for i in batch]
+class MixtureSampler(Sampler):
+    r"""
+    Sampler of a `WeightedConcatDataset`: every epoch draws `num_samples[d]` indices of
+    dataset `d` and shuffles them together.
+
+    The indices of a dataset are read from a sequence of seeded permutations of it that
+    continues across epochs, so a sample is drawn again only after all the others. An
+    epoch depends only on `seed` and its number: every rank plans the same one, the
+    Trainer's dataloader deals its batches to the ranks, and resuming replays it.
+    """
+
+    def __init__(self, sizes, num_samples, seed: int = 0):
+        self.sizes = np.asarray(sizes, dtype=np.int64)
+        self.num_samples = np.asarray(num_samples, dtype=np.int64)
+        self.offsets = np.concatenate([[0], np.cumsum(self.sizes)[:-1]])
+        self.seed = seed
+        self.epoch = 0
+        self.start_index = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def skip(self, num_samples):
+        """Start the next iteration at position `num_samples` of the epoch."""
+        self.start_index = num_samples
+
+    def plan(self):
+        dtype = np.int32 if self.sizes.sum() < 2 ** 31 else np.int64
+        indices = np.empty(self.num_samples.sum(), dtype=dtype)
+        position = 0
+        for dataset_idx, (size, count, offset) in enumerate(zip(self.sizes, self.num_samples, self.offsets)):
+            if count == 0:
+                continue
+            # Positions `first:stop` of the dataset's sequence, which may span several permutations
+            first, stop = self.epoch * count, (self.epoch + 1) * count
+            for permutation_idx in range(first // size, -(-stop // size)):
+                permutation = np.random.default_rng([self.seed, dataset_idx, permutation_idx]).permutation(size)
+                chunk = permutation[max(first - permutation_idx * size, 0):stop - permutation_idx * size]
+                indices[position:position + len(chunk)] = chunk + offset
+                position += len(chunk)
+        np.random.default_rng([self.seed, self.epoch]).shuffle(indices)
+        return indices
+
+    def __len__(self):
+        return int(self.num_samples.sum())
+
+    def __iter__(self):
+        start, self.start_index = self.start_index, 0
+        indices = self.plan()
+        for block_start in range(start, len(indices), LENGTH_GROUPED_BLOCK_SIZE):
+            yield from indices[block_start:block_start + LENGTH_GROUPED_BLOCK_SIZE].tolist()
 
 
 # modified from https://github.com/haotian-liu/LLaVA/blob/main/llava/train/llava_trainer.py#L99
@@ -49,6 +205,10 @@ class LengthGroupedSampler(Sampler):
     r"""
     Sampler that samples indices in a way that groups together features of the dataset of roughly the same length while
     keeping a bit of randomness.
+
+    With `mixture`, every epoch groups the plan of the `MixtureSampler` instead of a permutation
+    of all the indices, which keeps its weights and repeats. With `costs`, the samples are still
+    grouped by length, and the megabatches are split between the ranks on their costs.
     """
 
     def __init__(
@@ -59,6 +219,9 @@ class LengthGroupedSampler(Sampler):
         lengths: Optional[List[int]] = None,
         model_input_name: Optional[str] = None,
         generator=None,
+        seed: Optional[int] = None,
+        mixture: Optional[MixtureSampler] = None,
+        costs=None,
     ):
         if dataset is None and lengths is None:
             raise ValueError('One of dataset and lengths must be provided.')
@@ -76,20 +239,254 @@ class LengthGroupedSampler(Sampler):
                 )
             lengths = [len(feature[model_input_name]) for feature in dataset]
         elif isinstance(lengths, torch.Tensor):
-            logger.info(
-                'If lengths is a torch.Tensor, LengthGroupedSampler will be slow. Converting lengths to List[int]...'
-            )
-            lengths = lengths.tolist()
+            lengths = lengths.numpy()
         self.world_size = world_size
-        self.lengths = lengths
+        # One int32 array, grouped with vectorized operations
+        self.lengths = np.asarray(lengths, dtype=np.int32)
+        self.costs = None if costs is None else np.asarray(costs, dtype=np.int32)
         self.generator = generator
+        self.mixture = mixture
+        # With a seed, every epoch has its own generator and can be replayed on resume
+        self.seed = seed
+        self.epoch = 0
+        self.start_index = 0
+        if seed is not None:
+            self.set_epoch(0)
 
     def __len__(self):
-        return len(self.lengths)
+        return len(self.mixture) if self.mixture is not None else len(self.lengths)
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+        if self.seed is not None:
+            self.generator = torch.Generator().manual_seed(self.seed + epoch)
+
+    def skip(self, num_samples):
+        """Start the next iteration at position `num_samples`, without grouping the skipped indices."""
+        self.start_index = num_samples
 
     def __iter__(self):
-        indices = get_length_grouped_indices(self.lengths, self.batch_size, self.world_size, generator=self.generator)
-        return iter(indices)
+        start, self.start_index = self.start_index, 0
+        indices = None
+        if self.mixture is not None:
+            self.mixture.set_epoch(self.epoch)
+            indices = self.mixture.plan()
+        blocks = iter_length_grouped_indices(
+            self.lengths, self.batch_size, self.world_size, generator=self.generator, start=start, indices=indices,
+            costs=self.costs,
+        )
+        for block in blocks:
+            yield from block.tolist()
+
+
+class TokenBudgetBatchSampler(Sampler):
+    r"""
+    Batch sampler whose batches fit a budget of padded tokens and of ViT tiles, instead of a
+    fixed number of samples.
+
+    Every epoch, the indices are shuffled and sorted by length within megabatches, then cut
+    greedily into batches: a batch is closed when the next sample would take the padded
+    tokens (batch size times longest sample) over `max_tokens`, or the tiles over `max_tiles`.
+    The batches are planned identically on every rank, shuffled, and dealt round-robin.
+    Every epoch deals the number of rounds of the first one, so that all ranks run the same
+    steps and the Trainer can count epochs from the step: the tail of a longer epoch is
+    dropped, and a shorter one deals some of its batches again.
+    With `modalities`, a megabatch is sorted by modality group first, and a batch never
+    straddles two groups. With `mixture`, every epoch batches the plan of the `MixtureSampler`,
+    which keeps its weights and repeats, instead of a permutation of all the indices.
+    """
+
+    def __init__(
+        self,
+        lengths,
+        num_tiles,
+        max_tokens: int,
+        max_tiles: Optional[int] = None,
+        world_size: int = 1,
+        rank: int = 0,
+        seed: int = 0,
+        megabatch_size: int = 4096,
+        modalities=None,
+        mixture: Optional[MixtureSampler] = None,
+    ):
+        self.lengths = np.asarray(lengths, dtype=np.int64)
+        self.modalities = None if modalities is None else np.asarray(modalities)
+        self.num_tiles = np.asarray(num_tiles, dtype=np.int64)
+        self.max_tokens = max_tokens
+        self.max_tiles = max_tiles
+        self.world_size = world_size
+        self.rank = rank
+        self.seed = seed
+        self.megabatch_size = megabatch_size
+        self.mixture = mixture
+        self.epoch = 0
+        self.start_index = 0
+        self.num_rounds = None
+        self._batches = None
+
+    def set_epoch(self, epoch):
+        if epoch != self.epoch:
+            self.epoch, self._batches = epoch, None
+
+    def skip(self, num_batches):
+        """Start the next iteration at batch `num_batches` of the epoch of this rank."""
+        self.start_index = num_batches
+
+    def plan_batches(self, epoch):
+        rng = np.random.default_rng([self.seed, epoch])
+        if self.mixture is not None:
+            self.mixture.set_epoch(epoch)
+            indices = self.mixture.plan()
+        else:
+            indices = rng.permutation(len(self.lengths))
+        batches = []
+        for start in range(0, len(indices), self.megabatch_size):
+            megabatch = indices[start:start + self.megabatch_size]
+            if self.modalities is None:
+                megabatch = megabatch[np.argsort(-self.lengths[megabatch], kind='stable')]
+            else:
+                megabatch = megabatch[np.lexsort((-self.lengths[megabatch], self.modalities[megabatch]))]
+            batch, longest, tiles, group = [], 0, 0, None
+            for index in megabatch.tolist():
+                length, tile = self.lengths[index], self.num_tiles[index]
+                over_tokens = (len(batch) + 1) * max(longest, length) > self.max_tokens
+                over_tiles = self.max_tiles is not None and tiles + tile > self.max_tiles
+                new_group = self.modalities is not None and self.modalities[index] != group
+                if batch and (over_tokens or over_tiles or new_group):
+                    batches.append(batch)
+                    batch, longest, tiles = [], 0, 0
+                batch.append(index)
+                longest, tiles = max(longest, length), tiles + tile
+                group = None if self.modalities is None else self.modalities[index]
+            if batch:
+                batches.append(batch)
+        return [batches[i] for i in rng.permutation(len(batches))]
+
+    def batches(self):
+        if self._batches is None:
+            batches = self.plan_batches(self.epoch)
+            if self.num_rounds is None:
+                first_batches = batches if self.epoch == 0 else self.plan_batches(0)
+                self.num_rounds = len(first_batches) // self.world_size
+            order = np.resize(np.arange(len(batches)), self.num_rounds * self.world_size)
+            self._batches = [batches[i] for i in order[self.rank::self.world_size]]
+        return self._batches
+
+    def __len__(self):
+        return len(self.batches())
+
+    def __iter__(self):
+        start, self.start_index = self.start_index, 0
+        return iter(self.batches()[start:])
+
+
+class SeededRandomSampler(Sampler):
+    r"""
+    Random permutation of the dataset, drawn from `seed` and the epoch, so that every rank
+    draws the same one and resuming can start it at any position with `skip`.
+    """
+
+    def __init__(self, num_samples: int, seed: int = 0):
+        self.num_samples = num_samples
+        self.seed = seed
+        self.epoch = 0
+        self.start_index = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def skip(self, num_samples):
+        """Start the next iteration at position `num_samples` of the epoch."""
+        self.start_index = num_samples
+
+    def __len__(self):
+        return self.num_samples
+
+    def __iter__(self):
+        start, self.start_index = self.start_index, 0
+        indices = np.random.default_rng([self.seed, self.epoch]).permutation(self.num_samples)
+        for block_start in range(start, len(indices), LENGTH_GROUPED_BLOCK_SIZE):
+            yield from indices[block_start:block_start + LENGTH_GROUPED_BLOCK_SIZE].tolist()
+
+
+class ModalityGroupedSampler(Sampler):
+    r"""
+    Sampler whose per-device batches each hold a single modality group (see
+    `ConcatDataset.modality_groups`), so that every step runs one fully batched ViT path.
+
+    Every epoch starts from a seeded permutation, or from the plan of `mixture` to keep its
+    weights and repeats, and is cut into single-group megabatches by `group_by_modality`;
+    with `lengths`, the samples are also grouped by length within the megabatches, and split
+    between the ranks on `costs` when given.
+    """
+
+    def __init__(
+        self,
+        modalities,
+        batch_size: int,
+        world_size: int,
+        lengths=None,
+        mixture: Optional[MixtureSampler] = None,
+        seed: int = 0,
+        costs=None,
+    ):
+        self.modalities = np.asarray(modalities)
+        self.batch_size = batch_size
+        self.world_size = world_size
+        self.lengths = None if lengths is None else np.asarray(lengths, dtype=np.int32)
+        self.costs = None if costs is None else np.asarray(costs, dtype=np.int32)
+        self.mixture = mixture
+        self.seed = seed
+        self.epoch = 0
+        self.start_index = 0
+        self._indices = None
+
+    def set_epoch(self, epoch):
+        if epoch != self.epoch:
+            self.epoch, self._indices = epoch, None
+
+    def skip(self, num_samples):
+        """Start the next iteration at position `num_samples` of the epoch."""
+        self.start_index = num_samples
+
+    def indices(self):
+        if self._indices is None:
+            rng = np.random.default_rng([self.seed, self.epoch])
+            if self.mixture is not None:
+                self.mixture.set_epoch(self.epoch)
+                indices = self.mixture.plan()
+            else:
+                indices = rng.permutation(len(self.modalities))
+            self._indices = group_by_modality(
+                indices, self.modalities, self.batch_size, self.world_size, rng, lengths=self.lengths,
+                costs=self.costs,
+            )
+        return self._indices
+
+    def __len__(self):
+        return len(self.indices())
+
+    def __iter__(self):
+        start, self.start_index = self.start_index, 0
+        indices = self.indices()
+        for block_start in range(start, len(indices), LENGTH_GROUPED_BLOCK_SIZE):
+            yield from indices[block_start:block_start + LENGTH_GROUPED_BLOCK_SIZE].tolist()
+
+
+def concat_lengths(datasets):
+    """
+    Return the token lengths of the samples of `datasets`, to group them, and their costs, to
+    split the megabatches between the ranks: the `cost` of the datasets that have one (tokens
+    plus weighted ViT tiles), else their length. Both are int32 arrays; `dataset.length` may
+    be a memory-mapped index.
+    """
+    lengths = np.concatenate([np.asarray(dataset.length, dtype=np.int32) for dataset in datasets])
+    if not any(hasattr(dataset, 'cost') for dataset in datasets):
+        return lengths, lengths
+    costs = np.concatenate([
+        np.asarray(getattr(dataset, 'cost', dataset.length), dtype=np.int32) for dataset in datasets
+    ])
+    return lengths, costs
 
 
 # patch trainer
@@ -97,10 +494,26 @@ def _get_train_sampler(self) -> Optional[torch.utils.data.Sampler]:
     if self.train_dataset is None or not has_length(self.train_dataset):
         return None
     # Build the sampler.
+    mixture = None
+    if isinstance(self.train_dataset, WeightedConcatDataset):
+        mixture = MixtureSampler(
+            [len(dataset) for dataset in self.train_dataset.datasets],
+            self.train_dataset.num_samples,
+            seed=self.args.seed,
+        )
+    modalities = self.train_dataset.modality_groups() if hasattr(self.train_dataset, 'modality_groups') else None
+    lengths, costs = concat_lengths(self.train_dataset.datasets) if self.args.group_by_length else (None, None)
+    if modalities is not None:
+        return ModalityGroupedSampler(
+            modalities,
+            self.args.train_batch_size,
+            world_size=self.args.world_size * self.args.gradient_accumulation_steps,
+            lengths=lengths,
+            mixture=mixture,
+            seed=self.args.seed,
+            costs=costs,
+        )
     if self.args.group_by_length:
-        lengths = []
-        for dataset in self.train_dataset.datasets:
-            lengths = lengths + dataset.length
         model_input_name = self.tokenizer.model_input_names[0] if self.tokenizer is not None else None
         return LengthGroupedSampler(
             self.args.train_batch_size,
@@ -109,9 +522,14 @@ def _get_train_sampler(self) -> Optional[torch.utils.data.Sampler]:
             dataset=self.train_dataset,
             lengths=lengths,
             model_input_name=model_input_name,
+            seed=self.args.seed,
+            mixture=mixture,
+            costs=costs,
         )
+    elif mixture is not None:
+        return mixture
     else:
-        return RandomSampler(self.train_dataset)
+        return SeededRandomSampler(len(self.train_dataset), seed=self.args.seed)
 
 
 def replace_train_sampler():
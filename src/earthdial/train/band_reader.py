@@ -0,0 +1,106 @@
+"""
+Zero-copy access to the multi-band columns of the shard datasets.
+
+Band columns (`Array2D`/`Array3D`/... or nested `Sequence` features) are read in
+Arrow format and exposed as numpy views over the Arrow buffers, in their stored
+dtype (e.g. uint16/float16). The only copy on the way to the model is the float32
+buffer that is normalized in place by the transform.
+"""
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import torch
+
+
+def _is_list_type(arrow_type):
+    return (pa.types.is_list(arrow_type) or pa.types.is_large_list(arrow_type)
+            or pa.types.is_fixed_size_list(arrow_type))
+
+
+def _is_band_type(arrow_type):
+    # Nested lists of numbers, including the Array2D/Array3D/... extension types
+    if isinstance(arrow_type, pa.ExtensionType):
+        arrow_type = arrow_type.storage_type
+    if not _is_list_type(arrow_type):
+        return False
+    while _is_list_type(arrow_type):
+        arrow_type = arrow_type.value_type
+    return pa.types.is_integer(arrow_type) or pa.types.is_floating(arrow_type)
+
+
+def band_columns(raw_data, columns):
+    """Return the columns of `columns` that hold band arrays in the Arrow schema of `raw_data`."""
+    schema = raw_data.data.schema
+    return [column for column in columns if _is_band_type(schema.field(column).type)]
+
+
+def arrow_to_band_array(column):
+    """
+    Convert an Arrow column of rectangular nested lists into a `[rows, *shape]` numpy array.
+
+    The result is a read-only view over the Arrow buffer when the values have no nulls,
+    otherwise a copy.
+    """
+    if isinstance(column, pa.ChunkedArray):
+        column = column.combine_chunks()
+    if isinstance(column.type, pa.ExtensionType):
+        column = column.storage
+    shape = [len(column)]
+    while _is_list_type(column.type):
+        lengths = pc.list_value_length(column)
+        bounds = pc.min_max(lengths)
+        if bounds["min"].as_py() != bounds["max"].as_py():
+            raise ValueError("Band arrays must be rectangular")
+        shape.append(bounds["min"].as_py() or 0)
+        column = column.flatten()
+    values = column.to_numpy(zero_copy_only=column.null_count == 0)
+    return values.reshape(shape)
+
+
+def read_band_rows(band_records, indices):
+    """
+    Read the band columns of the rows `indices` from an Arrow-formatted dataset view.
+
+    Args:
+        band_records (Dataset): Dataset projected on the band columns, with format "arrow".
+        indices (int | list): A row index or a list of row indices.
+
+    Returns:
+        dict | list: For an int, a dict of band arrays; for a list, one dict per row.
+    """
+    table = band_records[indices]
+    arrays = {name: arrow_to_band_array(table.column(name)) for name in table.column_names}
+    if isinstance(indices, int):
+        return {name: array[0] for name, array in arrays.items()}
+    return [{name: array[j] for name, array in arrays.items()} for j in range(len(indices))]
+
+
+def stack_bands(images):
+    """Stack band arrays along a new first axis, without a copy for a single image."""
+    if len(images) == 1:
+        return np.asarray(images[0])[None]
+    return np.stack([np.asarray(image) for image in images])
+
+
+def band_tensor(array):
+    """
+    Convert a band array into a float32 tensor that the transform can normalize in place.
+
+    Strided views (e.g. channel reordering) are kept as strides. The float32 conversion is
+    the only copy, and read-only Arrow views are always copied rather than written to. A
+    list of channel-first band arrays, e.g. views of several columns, is cast while it is
+    concatenated along the channels, still in a single copy.
+    """
+    if isinstance(array, (list, tuple)):
+        arrays = [np.asarray(bands) for bands in array]
+        tensor = np.empty((sum(len(bands) for bands in arrays), *arrays[0].shape[1:]), dtype=np.float32)
+        start = 0
+        for bands in arrays:
+            tensor[start:start + len(bands)] = bands
+            start += len(bands)
+        return torch.from_numpy(tensor)
+    array = np.asarray(array)
+    if array.dtype != np.float32 or not array.flags.writeable:
+        array = array.astype(np.float32)
+    return torch.from_numpy(array)
@@ -45,6 +45,36 @@ UHI="[uhi]"
 L8_MS_30="[l8_ms_30]"
 
 HYPER_RGB_3="[hyper_rgb_3]"
+# Tokens added to the tokenizer for fine-tuning; their ids follow this order
+SPECIAL_TOKENS = [
+    IMG_START_TOKEN,
+    IMG_END_TOKEN,
+    IMG_CONTEXT_TOKEN,
+    QUAD_START_TOKEN,
+    QUAD_END_TOKEN,
+    REF_START_TOKEN,
+    REF_END_TOKEN,
+    BOX_START_TOKEN,
+    BOX_END_TOKEN,
+    BOX_START_TOKEN,
+    BOX_END_TOKEN,
+    S2_RGB_10_TOKEN,
+    L8_RGB_30_TOKEN,
+    S2_MS_10_TOKEN,
+    HIGH_RGB_05_TOKEN,
+    HIGH_RGB_05_TEMP_TOKEN,
+    HIGH_RGBI_05,
+    S1_VH_10_TOKEN,
+    S1_VH_1_TOKEN,
+    TREECLASSIFY,
+    GROUNDING,
+    REFER,
+    CLASSIFY,
+    IDENTIFY,
+    CAPTION,
+    CHANGEDET, UHI, L8_MS_30, HYPER_RGB_3, S1_VH_TEMP_10, MB_TOKEN_START, MB_TOKEN_END
+]
+
 IMAGENET_MEAN = (0.485, 0.456, 0.406)
 IMAGENET_STD = (0.229, 0.224, 0.225)
 CLIP_MEAN = (0.4814546, 0.4578275, 0.40821073)
@@ -64,4 +94,7 @@ rgbi_mean=0
 rgbi_std=255
 
 L8_MEAN=(1685.9217528110576, 2576.6100969824315, 3412.410682967383,4061.91785557694, 4908.372486703946, 4252.256712562256,4252.256712562256,4252.256712562256)
-L8_STD=(359.7262632109024, 418.76947482788194, 568.2571089787482,626.040956183579, 978.8922439362542, 866.6750990367983,866.6750990367983,866.6750990367983)
\ No newline at end of file
+L8_STD=(359.7262632109024, 418.76947482788194, 568.2571089787482,626.040956183579, 978.8922439362542, 866.6750990367983,866.6750990367983,866.6750990367983)
+
+# image modality tags returned by the shard datasets alongside pixel_values, owned by the model
+from earthdial.model.modality import MULTIBAND_MODALITY, RGB_MODALITY  # noqa: E402,F401
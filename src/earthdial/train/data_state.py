@@ -0,0 +1,163 @@
+"""
+Exact mid-epoch resume of the training data stream.
+
+Every checkpoint holds a `data_state_{rank}.json` per rank: the sampler that orders the
+epochs, the settings that its order depends on, and the failed and skipped sample
+counters of the rank. On resume, the samplers are positioned directly at the step of
+the checkpoint (`set_epoch` and `skip`), and streams fast-forward from their position,
+so the Trainer does not replay the consumed batches. Quarantined rows need no state:
+their sidecar files already outlive the run.
+
+The position is derived from the checkpoint's `global_step` the way the Trainer derives
+its own epoch, so a resumed run draws the same samples as an uninterrupted one.
+"""
+
+import json
+import logging
+import os
+
+from transformers import TrainerCallback
+from transformers.trainer_utils import PREFIX_CHECKPOINT_DIR
+
+from .quarantine import restore_sample_counters, sample_counters
+from .shard_stream import WeightedStreamDataset, stream_position
+
+logger = logging.getLogger(__name__)
+
+DATA_STATE_NAME = "data_state_{}.json"
+# Settings that the order of the samples depends on; the workers only matter to streams
+DATA_STATE_SETTINGS = (
+    "per_device_train_batch_size",
+    "gradient_accumulation_steps",
+    "world_size",
+    "seed",
+    "dataloader_num_workers",
+)
+
+
+def data_sampler(dataloader):
+    """
+    Return the sampler of `dataloader` that can be positioned with `skip`, or None.
+
+    It is found through the batch samplers that wrap it, e.g. the batch sampler shard of
+    an accelerate dataloader; a batch sampler of the rank's own batches is returned itself.
+    """
+    sampler = getattr(dataloader, "batch_sampler", None)
+    while sampler is not None and not hasattr(sampler, "skip"):
+        sampler = getattr(sampler, "batch_sampler", None) or getattr(sampler, "sampler", None)
+    return sampler
+
+
+def position_sampler(sampler, global_step, num_batches, gradient_accumulation_steps, samples_per_batch):
+    """
+    Position `sampler` at the optimizer step `global_step`.
+
+    Args:
+        sampler (Sampler): A sampler with `skip`, and `set_epoch` if its order changes by epoch.
+        global_step (int): Optimizer steps already taken.
+        num_batches (int): Batches of an epoch on a rank (`len(train_dataloader)`).
+        gradient_accumulation_steps (int): Batches per optimizer step.
+        samples_per_batch (int): Indices of the sampler consumed per batch of a rank; 1 for a
+            batch sampler, the batch size times the number of ranks for a sample sampler.
+
+    Returns:
+        tuple: The epoch and the position in it, in sampler items.
+    """
+    steps_per_epoch = max(num_batches // gradient_accumulation_steps, 1)
+    epoch, step = divmod(global_step, steps_per_epoch)
+    position = step * gradient_accumulation_steps * samples_per_batch
+    if hasattr(sampler, "set_epoch"):
+        sampler.set_epoch(epoch)
+    sampler.skip(position)
+    return epoch, position
+
+
+class DataStateCallback(TrainerCallback):
+    """Save the data state with every checkpoint, and position the data stream on resume."""
+
+    def __init__(self):
+        self.resume_state = None
+
+    def load(self, checkpoint, args, stream=False):
+        """
+        Read the data state of `checkpoint` and prepare to resume from it.
+
+        Args:
+            checkpoint (str): The checkpoint directory.
+            args (TrainingArguments): The arguments of the resumed run.
+            stream (bool): Whether the training dataset is a `WeightedStreamDataset`. Streams
+                also resume from checkpoints without data state, from their `global_step`.
+
+        Returns:
+            bool: Whether the data stream is positioned directly; the Trainer's replay of the
+                consumed batches is then unnecessary (`ignore_data_skip`).
+        """
+        path = os.path.join(checkpoint, DATA_STATE_NAME.format(args.process_index))
+        if not os.path.exists(path):
+            if not stream:
+                logger.warning(f"No data state in {checkpoint}, the Trainer replays the consumed batches")
+                return False
+            with open(os.path.join(checkpoint, "trainer_state.json")) as f:
+                self.resume_state = {"global_step": json.load(f)["global_step"], "sampler": "stream"}
+            return True
+        with open(path) as f:
+            data_state = json.load(f)
+        # The stream of a rank is split between its DataLoader workers
+        settings = DATA_STATE_SETTINGS if stream else DATA_STATE_SETTINGS[:-1]
+        changed = [name for name in settings if data_state[name] != getattr(args, name)]
+        if data_state["sampler"] is None or changed:
+            reason = f"changed {', '.join(changed)}" if changed else "a sampler without skip"
+            logger.warning(f"The data state of {checkpoint} cannot be resumed ({reason}), "
+                           "the Trainer replays the consumed batches")
+            return False
+        restore_sample_counters(data_state["sample_counters"])
+        self.resume_state = data_state
+        return True
+
+    def on_train_begin(self, args, state, control, train_dataloader=None, **kwargs):
+        if self.resume_state is None:
+            return
+        data_state, self.resume_state = self.resume_state, None
+        global_step = data_state["global_step"]
+        dataset = train_dataloader.dataset
+        if isinstance(dataset, WeightedStreamDataset):
+            dataset.load_state_dict(stream_position(
+                global_step * args.gradient_accumulation_steps,
+                args.per_device_train_batch_size,
+                args.dataloader_num_workers,
+            ))
+            logger.info(f"Resumed the data stream at step {global_step}")
+            return
+        sampler = data_sampler(train_dataloader)
+        if sampler is None or type(sampler).__name__ != data_state["sampler"]:
+            raise ValueError(f"Cannot resume the data state of {data_state['sampler']} "
+                             f"with {type(sampler).__name__}")
+        if len(train_dataloader) != data_state["num_batches"]:
+            logger.warning(f"The epoch has {len(train_dataloader)} batches instead of "
+                           f"{data_state['num_batches']}, the resumed order is not exact")
+        if sampler is train_dataloader.batch_sampler:
+            samples_per_batch = 1
+        else:
+            samples_per_batch = args.per_device_train_batch_size * args.world_size
+        epoch, position = position_sampler(
+            sampler, global_step, len(train_dataloader), args.gradient_accumulation_steps, samples_per_batch
+        )
+        logger.info(f"Resumed {type(sampler).__name__} at epoch {epoch}, position {position}")
+
+    def on_save(self, args, state, control, train_dataloader=None, **kwargs):
+        if train_dataloader is None:
+            return
+        stream = isinstance(train_dataloader.dataset, WeightedStreamDataset)
+        sampler = None if stream else data_sampler(train_dataloader)
+        data_state = {
+            "global_step": state.global_step,
+            "sampler": "stream" if stream else (type(sampler).__name__ if sampler is not None else None),
+            "num_batches": None if stream else len(train_dataloader),
+            "sample_counters": sample_counters(),
+        }
+        data_state.update({name: getattr(args, name) for name in DATA_STATE_SETTINGS})
+        checkpoint = os.path.join(args.output_dir, f"{PREFIX_CHECKPOINT_DIR}-{state.global_step}")
+        # Like the RNG states, every rank writes its own file, also on nodes without the model files
+        os.makedirs(checkpoint, exist_ok=True)
+        with open(os.path.join(checkpoint, DATA_STATE_NAME.format(args.process_index)), "w") as f:
+            json.dump(data_state, f)
@@ -18,19 +18,38 @@ from PIL import ImageFile
 ImageFile.LOAD_TRUNCATED_IMAGES = True
 
 # Project-Specific Imports
+from earthdial.train.constants import MULTIBAND_MODALITY, RGB_MODALITY
 from earthdial.train.dataset import (
     build_transform,
     dynamic_preprocess,
-    preprocess,
-    preprocess_internlm,
-    preprocess_mpt,
-    preprocess_phi3,
+    random_jpeg_degradation,
 )
+from earthdial.train.band_reader import band_columns, band_tensor, read_band_rows, stack_bands
+from earthdial.train.length_index import (
+    dataset_fingerprint,
+    load_or_build_token_lengths,
+    load_or_build_vit_tiles,
+    sample_vit_tiles,
+)
+from earthdial.train.pretokenize import (
+    PRETOKENIZED_COLUMNS,
+    expand_image_spans,
+    get_preprocess_function,
+    load_pretokenized_settings,
+    read_token_rows,
+)
+from earthdial.train.profiler import data_stage, record_stage, register_profiled_name, stage_clock
+from earthdial.train.quarantine import (
+    QuarantineIndex,
+    check_sample_attempts,
+    increment_sample_counter,
+)
+from earthdial.train.tiling import RGB_NORMALIZE_STATS, tile_image
 
 # Third-Party Libraries
 from torch.utils.data import Dataset
-from datasets import load_from_disk
-from PIL import ImageFile, UnidentifiedImageError
+from datasets import Image as ImageFeature, load_from_disk
+from PIL import Image, ImageFile, UnidentifiedImageError
 import cv2
 
 class ShardDataLoader(Dataset):
@@ -39,8 +58,11 @@ class ShardDataLoader(Dataset):
     Designed for supervised fine-tuning with features like dynamic image size, token grouping, 
     and distributed training support.
 
+    Multi-band samples are returned as normalized band tensors tagged with
+    `MULTIBAND_MODALITY`; the band-group ViT passes run inside the model, so
+    the dataset never holds a reference to it.
+
     Attributes:
-        model (object): The model instance to be used during data processing.
         logger (logging.Logger): Logger for tracking dataset-related events.
         template_name (str): The name of the template used for data preprocessing.
         meta (dict): Metadata containing dataset configurations like paths, keys, etc.
@@ -52,6 +74,7 @@ class ShardDataLoader(Dataset):
         is_train (bool): Flag to indicate whether the dataset is for training or evaluation.
         pad2square (bool): Whether to pad images to square dimensions.
         group_by_length (bool): Whether to group samples by token length.
+        use_packed_ds (bool): Whether samples are packed; they are then left unpadded.
         dynamic_image_size (bool): Enable dynamic resizing of images during preprocessing.
         use_thumbnail (bool): Whether to use thumbnails instead of full images.
         min_dynamic_patch (int): Minimum number of dynamic patches.
@@ -64,11 +87,17 @@ class ShardDataLoader(Dataset):
         image_key (str): Key to access images in the dataset.
         conversations_key (str): Key to access conversations in the dataset.
         length (list): Precomputed token lengths for samples.
+        vit_tile_cost (float): Compute of a ViT tile in LLM tokens; 0 balances the ranks on token lengths only.
+        vit_tiles (np.ndarray): ViT passes of every sample (tiles times band groups), with `vit_tile_cost`.
+        cost (np.ndarray): LLM tokens plus weighted ViT passes of every sample, with `vit_tile_cost`;
+            the samples are grouped by `length` and the ranks balanced on `cost`.
+        modality_signature (tuple): `(modality, bands, images)` shared by all the samples of the dataset.
+        pretokenized (dict): Build settings of the pre-tokenized columns read instead of the
+            conversations, or None to tokenize online (see `earthdial.train.pretokenize`).
     """
 
     def __init__(
         self,
-        model,
         logger,
         template_name,
         meta,
@@ -80,6 +109,7 @@ class ShardDataLoader(Dataset):
         is_train=True,
         pad2square=False,
         group_by_length=False,
+        use_packed_ds=False,
         dynamic_image_size=False,
         use_thumbnail=False,
         min_dynamic_patch=1,
@@ -88,9 +118,11 @@ class ShardDataLoader(Dataset):
         repeat_time=1,
         normalize_type="imagenet",
         random_seed=0,
+        vit_tile_cost=0.0,
     ):
         super(ShardDataLoader, self).__init__()
         self.ds_name = ds_name
+        register_profiled_name(ds_name)
         self.tokenizer = tokenizer
         self.template_name = template_name
         self.num_image_token = num_image_token
@@ -99,7 +131,6 @@ class ShardDataLoader(Dataset):
         self.pad2square = pad2square
         self.sampling_method = sampling_method
         self.normalize_type = normalize_type
-        self.model = model
         self.logger=logger
 
         # Distributed training configuration
@@ -109,12 +140,37 @@ class ShardDataLoader(Dataset):
         # Load metadata and raw data
         if not os.path.exists(meta["annotation"]):
             raise FileNotFoundError(f"Error: File not found - {meta['annotation']}")
-        self.raw_data = load_from_disk(meta["annotation"])
+        self.annotation = meta["annotation"]
+        self.raw_data = load_from_disk(self.annotation)
+        self.quarantine = QuarantineIndex(self.annotation, dataset_fingerprint(self.raw_data))
+        self.pretokenized = None
         if len(self.raw_data) == 0:
             logger.info("Error: Raw data is empty.")
         else:
             self.image_key = meta["image_key"]
             self.conversations_key = meta["conversation"]
+            self.pretokenized = load_pretokenized_settings(
+                self.annotation, self.raw_data, tokenizer, template_name, self.conversations_key, logger
+            )
+            if self.pretokenized:
+                # The token columns replace the conversations; image spans are expanded per sample
+                self.token_records = self.raw_data.select_columns(list(PRETOKENIZED_COLUMNS)).with_format("arrow")
+                logger.info(f"Reading the pre-tokenized conversations of {self.ds_name}")
+            # Column-projected views: a row read decodes only the columns used by the sample.
+            # Band columns are read in Arrow format and exposed as zero-copy numpy views.
+            self.band_keys = band_columns(self.raw_data, self.record_columns())
+            self.records = self.raw_data.select_columns(
+                [key for key in self.record_columns() if key not in self.band_keys]
+            )
+            # Encoded images are read as bytes and decoded per sample (see `decode_record`)
+            self.image_features = {
+                key: feature for key, feature in self.records.features.items()
+                if isinstance(feature, ImageFeature) and feature.decode
+            }
+            for key in self.image_features:
+                self.records = self.records.cast_column(key, ImageFeature(decode=False))
+            if self.band_keys:
+                self.band_records = self.raw_data.select_columns(self.band_keys).with_format("arrow")
             logger.info(f"Loaded shard dataset: {self.ds_name} with length: {len(self.raw_data)}")
 
         if "normalization" in meta:
@@ -126,51 +182,95 @@ class ShardDataLoader(Dataset):
         self.cached_data_dict = {}
         self.tcs_loader = tcs_loader
         self.group_by_length = group_by_length
+        self.use_packed_ds = use_packed_ds
         self.dynamic_image_size = dynamic_image_size
         self.use_thumbnail = use_thumbnail
         self.min_dynamic_patch = min_dynamic_patch
         self.max_dynamic_patch = max_dynamic_patch
 
-        if self.group_by_length:
+        # Upper bound of the ViT passes of a sample (tiles times band groups), for batch budgets
+        tiles_per_image = self.max_dynamic_patch + int(self.use_thumbnail) if self.dynamic_image_size else 1
+        band_groups = -(-getattr(self, "no_bands", 3) // 3)
+        self.max_num_tiles = len(meta["image_key"].split(",")) * tiles_per_image * band_groups
+
+        # Samples can share a batch only with the same ViT path and pixel layout
+        no_bands = getattr(self, "no_bands", 3)
+        num_images = len(meta["image_key"].split(",")) if str(ds_name).strip().startswith("Change") else 1
+        self.modality_signature = (MULTIBAND_MODALITY if no_bands != 3 else RGB_MODALITY, no_bands, num_images)
+
+        # Packing plans its packs from the same token lengths
+        if self.group_by_length or self.use_packed_ds:
             self._compute_token_lengths(logger, random_seed)
+        # The length-grouped sampler balances the ranks on the LLM tokens plus the ViT passes
+        if self.group_by_length and vit_tile_cost:
+            self._compute_sample_costs(logger, vit_tile_cost)
 
         gc.collect()
 
     def _compute_token_lengths(self, logger, random_seed):
-        """Compute or retrieve token lengths for efficient data grouping."""
-        self.conv2length = {}
-        self.length = []
-        start_time = time.time()
-
-        for data_item1 in self.raw_data[self.conversations_key]:
-            if self.ds_name.strip().startswith("Naip"):
-                data_item = json.loads(data_item1)
-            else:
-                data_item = {"conversations": json.loads(data_item1)}
-
-            if "length" in data_item:
-                token_length = data_item["length"]
-            else:
-                conversations = "\n".join([temp["value"] for temp in data_item["conversations"]])
-                str_length = len(conversations)
-
-                if str_length not in self.conv2length:
-                    token_length = self.tokenizer(
-                        conversations, return_tensors="pt", padding=False, truncation=False
-                    ).input_ids.size(1)
-                    self.conv2length[str_length] = (
-                        token_length + self.num_image_token * (self.max_dynamic_patch + self.use_thumbnail)
-                    )
-                else:
-                    token_length = self.conv2length[str_length]
-
-            self.length.append(token_length)
-
-        total_time = time.time() - start_time
-        logger.info(f"Token length computation time for {len(self.raw_data)} samples: {total_time:.2f} seconds")
+        """Load the persistent token-length index of the shard, building it on first use."""
+        self.length = load_or_build_token_lengths(
+            self.raw_data,
+            self.annotation,
+            self.tokenizer,
+            self.conversations_key,
+            self.ds_name,
+            self.num_image_token,
+            # Without dynamic resolution every image is a single tile
+            self.max_dynamic_patch if self.dynamic_image_size else 1,
+            self.use_thumbnail and self.dynamic_image_size,
+            logger=logger,
+        )
         gc.collect()
 
    
+    def _compute_sample_costs(self, logger, vit_tile_cost):
+        """
+        Estimate the compute of every sample: its LLM tokens plus `vit_tile_cost` per ViT pass.
+
+        The tiles of the `Image` columns are read from the `num_tiles` column of a pre-tokenized
+        shard or from the persistent tile index of the shard; band arrays and images without
+        dynamic resolution are a single tile. The image tokens of the token length are
+        corrected to the actual tiles.
+        """
+        tiling = {
+            "dynamic_image_size": self.dynamic_image_size,
+            "min_dynamic_patch": self.min_dynamic_patch,
+            "max_dynamic_patch": self.max_dynamic_patch,
+            "image_size": self.image_size,
+            "use_thumbnail": self.use_thumbnail,
+        }
+        if self.pretokenized and self.pretokenized.get("tiling") == tiling:
+            # Counted when the shard was pre-tokenized, with the same tiling
+            tiles = self.raw_data.data.column("num_tiles").to_numpy()
+        else:
+            tiles = sample_vit_tiles(
+                self.raw_data,
+                self.image_key,
+                self.ds_name,
+                self.dynamic_image_size,
+                self.max_dynamic_patch,
+                lambda columns, max_dynamic_patch: load_or_build_vit_tiles(
+                    self.raw_data,
+                    self.annotation,
+                    columns,
+                    self.min_dynamic_patch,
+                    max_dynamic_patch,
+                    self.image_size,
+                    self.use_thumbnail,
+                    self.ds_name,
+                    logger=logger,
+                ),
+            )
+        band_groups = -(-getattr(self, "no_bands", 3) // 3)
+        self.vit_tiles = tiles * band_groups
+        tokens = np.asarray(self.length, dtype=np.float64)
+        if not str(self.ds_name).strip().startswith("Naip"):
+            # The length index counts the image tokens of the largest tiling; count the actual ones
+            tiles_per_image = self.max_dynamic_patch + int(self.use_thumbnail) if self.dynamic_image_size else 1
+            tokens += self.num_image_token * (tiles - tiles_per_image)
+        self.cost = (np.maximum(tokens, 1) + vit_tile_cost * self.vit_tiles).astype(np.int32)
+
     def __len__(self):
         """
         Get the total number of data samples in the raw dataset.
@@ -194,15 +294,38 @@ class ShardDataLoader(Dataset):
         Returns:
             function: The selected preprocessing function.
         """
-        if self.template_name == "Hermes-2":
-            preprocess_function = preprocess_mpt
-        elif self.template_name == "internlm2-chat":
-            preprocess_function = preprocess_internlm
-        elif self.template_name == "phi3-chat":
-            preprocess_function = preprocess_phi3
-        else:
-            preprocess_function = preprocess
-        return preprocess_function
+        return get_preprocess_function(self.template_name)
+
+    def tokenize(self, data_item, num_image_tokens, num_image=1):
+        """
+        Tokenize the conversations of a data item, with `num_image_tokens[k]` tokens for image `k`.
+
+        Pre-tokenized samples only have their image spans expanded.
+
+        Returns:
+            dict: The `input_ids`, `labels` and `attention_mask` of the sample.
+        """
+        if "input_ids" in data_item:
+            with data_stage("tokenize", self.ds_name):
+                return expand_image_spans(
+                    data_item["input_ids"],
+                    data_item["labels"],
+                    self.tokenizer,
+                    num_image_tokens,
+                    pad_to_max_length=not (self.group_by_length or self.use_packed_ds),
+                )
+        preprocess_function = self.get_preprocess_function()
+        ret = preprocess_function(
+            self.template_name,
+            [deepcopy(data_item["conversations"])],
+            self.tokenizer,
+            num_image_tokens,
+            group_by_length=self.group_by_length,
+            use_packed_ds=self.use_packed_ds,
+            ds_name=self.ds_name,
+            num_image=num_image,
+        )
+        return dict(input_ids=ret["input_ids"][0], labels=ret["labels"][0], attention_mask=ret["attention_mask"][0])
 
     def get_transform(self):
         """
@@ -225,6 +348,48 @@ class ShardDataLoader(Dataset):
         )
         return transform
     
+    def use_tile_engine(self, image):
+        """
+        Check whether `image` can go through the tensor tile engine.
+
+        The engine covers PIL RGB images with a standard RGB normalization; band arrays,
+        grayscale images and padded-to-square inputs keep the transform pipeline.
+        """
+        return (
+            self.no_bands == 3
+            and isinstance(image, Image.Image)
+            # Grayscale keeps its single channel in the transform pipeline
+            and image.mode != "L"
+            and self.image_key != "tif_ms"
+            and self.normalize_type in RGB_NORMALIZE_STATS
+            and not self.pad2square
+        )
+
+    def tile(self, image, max_num):
+        """
+        Tile and normalize an RGB image with the tensor tile engine.
+
+        During training the random JPEG degradation of the transform pipeline is applied to
+        every tile, with its own quality, as in the transform pipeline.
+
+        Args:
+            image (PIL.Image): The RGB image.
+            max_num (int): Maximum number of tiles.
+
+        Returns:
+            torch.Tensor: The tiles, `[n_tiles, 3, image_size, image_size]`.
+        """
+        return tile_image(
+            image,
+            min_num=self.min_dynamic_patch,
+            max_num=max_num,
+            image_size=self.image_size,
+            use_thumbnail=self.use_thumbnail,
+            normalize_type=self.normalize_type,
+            dynamic=self.dynamic_image_size,
+            tile_transform=random_jpeg_degradation if self.is_train else None,
+        )
+
     def multi_modal_get_item(self, data_item):
         """
         Process a single data item to prepare it for multi-modal model input.
@@ -239,52 +404,69 @@ class ShardDataLoader(Dataset):
         # Build the transformation function
         transform = self.get_transform()
 
-        # Ensure the first conversation contains an image placeholder
-        if "<image>" not in data_item["conversations"][0]["value"]:
+        # Ensure the first conversation contains an image placeholder (pre-tokenized samples have it)
+        if "conversations" in data_item and "<image>" not in data_item["conversations"][0]["value"]:
             data_item["conversations"][0]["value"] = (
                 "<image>\n" + data_item["conversations"][0]["value"]
             )
 
         image = data_item["image"]
+        start = stage_clock()
 
-        # Determine image patches based on dynamic image size or the default behavior
-        if self.dynamic_image_size and self.image_key != "tif_ms":
-            images = dynamic_preprocess(
-                image,
-                min_num=self.min_dynamic_patch,
-                max_num=self.max_dynamic_patch,
-                image_size=self.image_size,
-                use_thumbnail=self.use_thumbnail,
-            )
+        if self.use_tile_engine(image):
+            # RGB fast path: one resize, one unfold and one fused normalize for all tiles
+            pixel_values = self.tile(image, self.max_dynamic_patch)
+            record_stage("tile", self.ds_name, start)
+            image_modality = RGB_MODALITY
+            num_patches = pixel_values.size(0)
         else:
-            images = [image]  # Use the original image as a single patch
-
-        # Handle multi-band images
-        if self.no_bands != 3:
-            if self.image_key == "tif_ms" or str(self.ds_name).strip().startswith("STARCOP"):
-                # Handle multi-spectral or special datasets
-                pixel_values_ms = torch.tensor(np.array(images), dtype=torch.float32).unsqueeze(0)
-                pixel_values_norm = [transform(image) for image in pixel_values_ms]
-                pixel_values = torch.stack(pixel_values_norm)
-            elif self.image_key == "rgbi":
-                # Handle RGBI images
-                pixel_values_ms = torch.tensor(np.array(images), dtype=torch.float32).unsqueeze(0)
-                pixel_values_norm = [transform(image) for image in pixel_values_ms]
-                pixel_values = torch.stack(pixel_values_norm)
+            # Determine image patches based on dynamic image size or the default behavior
+            if self.dynamic_image_size and self.image_key != "tif_ms":
+                images = dynamic_preprocess(
+                    image,
+                    min_num=self.min_dynamic_patch,
+                    max_num=self.max_dynamic_patch,
+                    image_size=self.image_size,
+                    use_thumbnail=self.use_thumbnail,
+                )
             else:
-                # Handle other types of datasets like SAR or NIR or Methane plume
-                images = torch.tensor(np.array(images), dtype=torch.float32)
+                images = [image]  # Use the original image as a single patch
+            record_stage("tile", self.ds_name, start)
+            start = stage_clock()
+
+            # Handle multi-band images
+            if self.no_bands != 3:
+                if str(self.ds_name).strip().startswith("STARCOP"):
+                    # The band views of the STARCOP columns are cast into one float32 tensor
+                    pixel_values_ms = band_tensor(images[0]).unsqueeze(0)
+                    pixel_values_norm = [transform(image) for image in pixel_values_ms]
+                    pixel_values = torch.stack(pixel_values_norm)
+                elif self.image_key == "tif_ms":
+                    # Handle multi-spectral datasets
+                    pixel_values_ms = band_tensor(stack_bands(images)).unsqueeze(0)
+                    pixel_values_norm = [transform(image) for image in pixel_values_ms]
+                    pixel_values = torch.stack(pixel_values_norm)
+                elif self.image_key == "rgbi":
+                    # Handle RGBI images
+                    pixel_values_ms = band_tensor(stack_bands(images)).unsqueeze(0)
+                    pixel_values_norm = [transform(image) for image in pixel_values_ms]
+                    pixel_values = torch.stack(pixel_values_norm)
+                else:
+                    # Handle other types of datasets like SAR or NIR or Methane plume
+                    images = band_tensor(stack_bands(images))
+                    pixel_values = [transform(image) for image in images]
+                    pixel_values = torch.stack(pixel_values)
+
+                # Band-group ViT features are extracted batch-wise by the model
+                image_modality = MULTIBAND_MODALITY
+                num_patches = pixel_values.size(0)
+            else:
+                # Apply transformation to the image(s) and stack into a tensor
                 pixel_values = [transform(image) for image in images]
                 pixel_values = torch.stack(pixel_values)
-
-            # Extract features using the model's ViT and obtain the embedding space
-            pixel_values = self.model.sequential_vit_features(pixel_values, 'bilinear')
-            num_patches = pixel_values.size(0)
-        else:
-            # Apply transformation to the image(s) and stack into a tensor
-            pixel_values = [transform(image) for image in images]
-            pixel_values = torch.stack(pixel_values)
-            num_patches = pixel_values.size(0)
+                image_modality = RGB_MODALITY
+                num_patches = pixel_values.size(0)
+            record_stage("transform", self.ds_name, start)
 
         # Ensure a single patch for non-dynamic image size
         if not self.dynamic_image_size:
@@ -292,26 +474,15 @@ class ShardDataLoader(Dataset):
                 num_patches == 1
             ), f"The number of patches should be 1, but got {num_patches}."
 
-        # Select the appropriate preprocessing function
-        preprocess_function = self.get_preprocess_function()
-
-        # Preprocess the conversations and generate input features
-        ret = preprocess_function(
-            self.template_name,
-            [deepcopy(data_item["conversations"])],
-            self.tokenizer,
-            [self.num_image_token * num_patches],
-            group_by_length=self.group_by_length,
-            ds_name=self.ds_name,
-        )
+        # Tokenize the conversations and generate input features
+        ret = self.tokenize(data_item, [self.num_image_token * num_patches])
 
         # Prepare the final return dictionary
         ret = dict(
-            input_ids=ret["input_ids"][0],
-            labels=ret["labels"][0],
-            attention_mask=ret["attention_mask"][0],
+            **ret,
             pixel_values=pixel_values,
             image_flags=torch.tensor([1] * num_patches, dtype=torch.long),
+            image_modality=torch.tensor([image_modality] * num_patches, dtype=torch.long),
         )
         return ret
 
@@ -331,128 +502,238 @@ class ShardDataLoader(Dataset):
 
         images, num_tiles = [], []  # Initialize containers for processed images and tile counts
         num_image = len(data_item["image"])  # Number of images in the data item
-
-        # Process each image in the data item
-        for each_image in data_item["image"]:
-            image = each_image
-            if self.dynamic_image_size:
-                # Dynamically preprocess the image into multiple patches
-                image = dynamic_preprocess(
-                    image,
-                    min_num=self.min_dynamic_patch,
-                    max_num=max(1, self.max_dynamic_patch // num_image),
-                    image_size=self.image_size,
-                    use_thumbnail=self.use_thumbnail,
-                )
-                images += image
-                num_tiles.append(len(image))  # Record the number of tiles per image
-            else:
-                # Use the original image as a single patch
-                images.append(image)
-                num_tiles.append(1)
-
-        # Handle multi-band temporal images
-        if self.no_bands != 3:
-            images = torch.tensor(np.array(images), dtype=torch.float32)
-            pixel_values = [transform(image) for image in images]
-            pixel_values = torch.stack(pixel_values)
-            self.logger.info("Passing to model Vit ", pixel_values.size())
-            # Extract features using the model's ViT and obtain the embedding space
-            pixel_values = self.model.sequential_vit_features(pixel_values, 'bilinear')
-            self.logger.info("Final ViT ", pixel_values.size())
+        start = stage_clock()
+
+        if all(self.use_tile_engine(image) for image in data_item["image"]):
+            # RGB fast path: each image is tiled, augmented and normalized as tensors
+            for each_image in data_item["image"]:
+                tiles = self.tile(each_image, max(1, self.max_dynamic_patch // num_image))
+                images.append(tiles)
+                num_tiles.append(tiles.size(0))
+            pixel_values = torch.cat(images)
+            record_stage("tile", self.ds_name, start)
+            image_modality = RGB_MODALITY
             num_patches = pixel_values.size(0)
         else:
-            # Transform and stack image tensors for RGB inputs
-            pixel_values = [transform(image) for image in images]
-            pixel_values = torch.stack(pixel_values)
-            num_patches = pixel_values.size(0)
-
-        # Select the appropriate preprocessing function based on the template name
-        preprocess_function = self.get_preprocess_function()
+            # Process each image in the data item
+            for each_image in data_item["image"]:
+                image = each_image
+                if self.dynamic_image_size:
+                    # Dynamically preprocess the image into multiple patches
+                    image = dynamic_preprocess(
+                        image,
+                        min_num=self.min_dynamic_patch,
+                        max_num=max(1, self.max_dynamic_patch // num_image),
+                        image_size=self.image_size,
+                        use_thumbnail=self.use_thumbnail,
+                    )
+                    images += image
+                    num_tiles.append(len(image))  # Record the number of tiles per image
+                else:
+                    # Use the original image as a single patch
+                    images.append(image)
+                    num_tiles.append(1)
+            record_stage("tile", self.ds_name, start)
+            start = stage_clock()
+
+            # Handle multi-band temporal images
+            if self.no_bands != 3:
+                images = band_tensor(stack_bands(images))
+                pixel_values = [transform(image) for image in images]
+                pixel_values = torch.stack(pixel_values)
+                # Band-group ViT features are extracted batch-wise by the model
+                image_modality = MULTIBAND_MODALITY
+                num_patches = pixel_values.size(0)
+            else:
+                # Transform and stack image tensors for RGB inputs
+                pixel_values = [transform(image) for image in images]
+                pixel_values = torch.stack(pixel_values)
+                image_modality = RGB_MODALITY
+                num_patches = pixel_values.size(0)
+            record_stage("transform", self.ds_name, start)
 
         # Prepare token counts for each image based on the number of tiles
         num_image_tokens = [self.num_image_token * num_tile for num_tile in num_tiles]
 
-        # Preprocess the conversations and generate input features
-        ret = preprocess_function(
-            self.template_name,
-            [deepcopy(data_item["conversations"])],
-            self.tokenizer,
-            num_image_tokens,
-            group_by_length=self.group_by_length,
-            ds_name=self.ds_name,
-            num_image=num_image,
-        )
+        # Tokenize the conversations and generate input features
+        ret = self.tokenize(data_item, num_image_tokens, num_image=num_image)
 
         # Prepare the final return dictionary
         ret = dict(
-            input_ids=ret["input_ids"][0],
-            labels=ret["labels"][0],
-            attention_mask=ret["attention_mask"][0],
+            **ret,
             pixel_values=pixel_values,
             image_flags=torch.tensor([1] * num_patches, dtype=torch.long),
+            image_modality=torch.tensor([image_modality] * num_patches, dtype=torch.long),
         )
         return ret
 
 
+    def record_columns(self):
+        """
+        Return the columns read for every sample: the image column(s) and the conversation column,
+        unless the shard is pre-tokenized.
+        """
+        columns = self.image_key.split(",") + ([] if self.pretokenized else [self.conversations_key])
+        return list(dict.fromkeys(columns))
+
+    def fetch_record(self, i):
+        """
+        Read the projected record of row `i`, with its band columns as numpy views.
+        """
+        record = self.records[i]
+        if self.band_keys:
+            record.update(read_band_rows(self.band_records, i))
+        if self.pretokenized:
+            record.update(read_token_rows(self.token_records, i))
+        return record
+
+    def fetch_records(self, indices):
+        """
+        Read the projected records of the rows `indices` with one columnar read per view.
+        """
+        columns = self.records[indices]
+        records = [{key: values[j] for key, values in columns.items()} for j in range(len(indices))]
+        if self.band_keys:
+            for record, bands in zip(records, read_band_rows(self.band_records, indices)):
+                record.update(bands)
+        if self.pretokenized:
+            for record, tokens in zip(records, read_token_rows(self.token_records, indices)):
+                record.update(tokens)
+        return records
+
+    def decode_record(self, record):
+        """
+        Decode the encoded image columns of a fetched record in place.
+
+        The rows are read with undecoded images, so that a broken image fails its own
+        sample and not the batched read.
+        """
+        with data_stage("decode", self.ds_name):
+            for key, feature in self.image_features.items():
+                record[key] = feature.decode_example(record[key])
+        return record
+
+    def build_data_item(self, record):
+        """
+        Build the data item of one sample from its projected record.
+
+        Args:
+            record (dict): A row of `self.records`, where every image column is decoded once.
+
+        Returns:
+            dict: A dictionary with the `image` (or list of images) and the `conversations`, or
+                the pre-tokenized `input_ids` and `labels`.
+        """
+        if self.pretokenized:
+            data_item = {"input_ids": record["input_ids"], "labels": record["labels"]}
+        else:
+            conversations = json.loads(record[self.conversations_key])
+            if str(self.ds_name).strip().startswith("Naip"):
+                # NAIP Dataset: the conversations are nested in the annotation
+                conversations = conversations["conversations"]
+            data_item = {"conversations": conversations}
+        data_item["image"] = self.build_image(record)
+        return data_item
+
+    def build_image(self, record):
+        """
+        Build the image, or list of temporal images, of one sample from its projected record.
+        """
+        ds_name = str(self.ds_name).strip()
+
+        if ds_name.startswith("Change_SAR"):
+            # Change_SAR Dataset: channel-first strided views of each temporal image
+            return [
+                np.asarray(record[img_key]).transpose(2, 0, 1)
+                for img_key in self.image_key.split(",")
+            ]
+
+        if ds_name.startswith("Change"):
+            # Change Dataset: directly use the temporal image objects
+            return [record[img_key] for img_key in self.image_key.split(",")]
+
+        if ds_name.startswith("STARCOP"):
+            # STARCOP Dataset: channel-first views of the RGB and plume bands, combined into
+            # one float32 tensor of `no_bands` channels by `band_tensor`
+            image_objects = [np.asarray(record[img_key]) for img_key in self.image_key.split(",")]
+            rgb, plume = image_objects[0].transpose(2, 0, 1), image_objects[1]
+            bands = [rgb, plume[None] if plume.ndim == 2 else plume[:1]]
+            if self.no_bands > 4:
+                # Missing bands are zero
+                bands.append(np.broadcast_to(np.zeros((), dtype=rgb.dtype), (self.no_bands - 4, *rgb.shape[1:])))
+            return bands
+
+        # Default (and NAIP): the image column
+        return record[self.image_key]
+
     def __getitem__(self, i) -> Dict[str, torch.Tensor]:
         i = i % len(self.raw_data)  # Ensure 'i' is within dataset bounds
+        return self.get_item(i)
+
+    def __getitems__(self, indices):
+        """
+        Fetch a batch of samples with a single columnar read of their rows.
 
+        The rows are then decoded and transformed one by one, so a broken sample is
+        retried on its own exactly as in `__getitem__`. If the batched read itself fails,
+        every sample falls back to the per-index path.
+
+        Args:
+            indices (list): Indices of the samples in the batch.
+
+        Returns:
+            list: The processed samples, in the order of `indices`.
+        """
+        indices = [i % len(self.raw_data) for i in indices]
+        # Quarantined rows are left out of the read; get_item replaces them
+        clean_indices = [i for i in indices if i not in self.quarantine]
+        try:
+            with data_stage("fetch", self.ds_name, count=len(clean_indices)):
+                records = dict(zip(clean_indices, self.fetch_records(clean_indices)))
+        except Exception as e:
+            logging.info(f"Batched read failed for dataset: {self.ds_name}, falling back to per-sample reads. {e}")
+            records = {}
+        return [self.get_item(i, records.get(i)) for i in indices]
+
+    def get_item(self, i, record=None):
+        """
+        Process the sample at index `i`, retrying with a random index on failure.
+
+        Rows whose content fails to decode are quarantined, and quarantined rows are skipped
+        without being read. Other errors fail the sample without quarantining its row. A
+        `RuntimeError` is raised after `MAX_SAMPLE_ATTEMPTS` skipped or failed rows in a row,
+        e.g. when every row is quarantined.
+
+        Args:
+            i (int): Index of the sample in the dataset.
+            record (dict, optional): The already fetched projected row of `i`.
+
+        Returns:
+            dict: The processed sample.
+        """
+        start = stage_clock()
+        attempts = 0
         while True:
+            check_sample_attempts(attempts, self.quarantine, len(self.raw_data), self.ds_name)
+            attempts += 1
+            if i in self.quarantine:
+                # Known bad row: skip it without reading or decoding it
+                increment_sample_counter("skipped")
+                i, record = random.randint(0, len(self.raw_data) - 1), None
+                continue
             try:
-                # Determine the dataset type and prepare the data item accordingly
-                if str(self.ds_name).strip().startswith("Naip"):
-                    # NAIP Dataset: Load image and conversation
-                    data_item = {
-                        "image": self.raw_data[i][self.image_key],
-                        "conversations": json.loads(self.raw_data[i][self.conversations_key])["conversations"],
-                    }
-                elif str(self.ds_name).strip().startswith("Change_SAR"):
-                    # Change_SAR Dataset: Handle multiple image keys and process them
-                    image_list = self.image_key.split(",")
-                    image_objects = [
-                        np.transpose(np.array(self.raw_data[i][img_key]), (2, 0, 1))
-                        for img_key in image_list
-                    ]
-                    data_item = {
-                        "image": image_objects,
-                        "conversations": json.loads(self.raw_data[i][self.conversations_key]),
-                    }
-                elif str(self.ds_name).strip().startswith("Change"):
-                    # Change Dataset: Directly access and store image objects
-                    image_list = self.image_key.split(",")
-                    image_objects = [self.raw_data[i][img_key] for img_key in image_list]
-                    data_item = {
-                        "image": image_objects,
-                        "conversations": json.loads(self.raw_data[i][self.conversations_key]),
-                    }
-                elif str(self.ds_name).strip().startswith("STARCOP"):
-                    # STARCOP Dataset: Combine images into a single array with 4 channels
-                    image_list = self.image_key.split(",")
-                    patch_size=512
-                    image_objects = [np.array(self.raw_data[i][img_key]) for img_key in image_list]
-
-                    combined_image = np.zeros((self.no_bands, patch_size, patch_size))  # Initialize combined image
-                    combined_image[:3, :, :] = np.transpose(image_objects[0], (2, 0, 1))  # RGB
-                    if len(image_objects[1].shape) == 2:
-                        combined_image[3, :, :] = image_objects[1]
-                    else:
-                        combined_image[3, :, :] = image_objects[1][0, :, :]
-                    data_item = {
-                        "image": combined_image,
-                        "conversations": json.loads(self.raw_data[i][self.conversations_key]),
-                    }
-                else:
-                    # Default: Load image and conversation
-                    data_item = {
-                        "image": self.raw_data[i][self.image_key],
-                        "conversations": json.loads(self.raw_data[i][self.conversations_key]),
-                    }
-
-                # Validate conversations; retry with a random index if missing
-                if not data_item["conversations"]:
+                # Read the projected row once and build the data item from it
+                if record is None:
+                    with data_stage("fetch", self.ds_name):
+                        record = self.fetch_record(i)
+                data_item = self.build_data_item(self.decode_record(record))
+
+                # Validate conversations (or their tokens); retry with a random index if missing
+                empty = len(data_item["input_ids"]) == 0 if self.pretokenized else not data_item["conversations"]
+                if empty:
                     logging.error(f"Empty conversations at index {i} for dataset: {self.ds_name}")
-                    i = random.randint(0, len(self.raw_data) - 1)
+                    self.quarantine.add(i, "EmptyConversations")
+                    i, record = random.randint(0, len(self.raw_data) - 1), None
                     continue
 
                 # Determine the processing function based on the presence and type of 'image' or 'video'
@@ -476,8 +757,12 @@ class ShardDataLoader(Dataset):
 
                 logging.info(f"Error loading item {i} from dataset: {self.ds_name}")
                 logging.info(str(e))
+                # Only decoding errors quarantine the row; transient IO errors and bugs are counted
+                self.quarantine.record_failure(i, e)
 
                 # Retry with a random index
-                i = random.randint(0, len(self.raw_data) - 1)
+                i, record = random.randint(0, len(self.raw_data) - 1), None
 
+        # The sample stage includes its retries
+        record_stage("sample", self.ds_name, start)
         return ret
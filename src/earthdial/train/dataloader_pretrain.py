@@ -19,6 +19,26 @@ from dataclasses import dataclass, field
 from typing import Dict, Optional
 from PIL import ImageFile
 ImageFile.LOAD_TRUNCATED_IMAGES = True
+from earthdial.train.constants import MULTIBAND_MODALITY, RGB_MODALITY
+from earthdial.train.band_reader import band_columns, band_tensor, read_band_rows, stack_bands
+from earthdial.train.length_index import dataset_fingerprint, load_or_build_token_lengths
+from earthdial.train.profiler import data_stage, record_stage, register_profiled_name, stage_clock
+from earthdial.train.quarantine import (
+    QuarantineIndex,
+    check_sample_attempts,
+    increment_sample_counter,
+)
+from earthdial.train.shard_stream import (
+    STREAM_PIECE_ROWS,
+    STREAM_READ_ROWS,
+    STREAM_SHUFFLE_BUFFER,
+    consumed_samples,
+    open_data_file,
+    shuffle_buffer,
+    split_pieces,
+    stream_consumer,
+    stream_data_files,
+)
 from earthdial.train.dataset import (
     ConcatDataset,
     TCSLoader,
@@ -29,9 +49,11 @@ from earthdial.train.dataset import (
     preprocess_internlm,
     preprocess_mpt,
     preprocess_phi3,
+    random_jpeg_degradation,
 )
+from earthdial.train.tiling import RGB_NORMALIZE_STATS, tile_image
 import cv2
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, IterableDataset
 from datasets import load_from_disk, concatenate_datasets
 from PIL import Image, ImageFile, PngImagePlugin, UnidentifiedImageError
 from datafusion import DataFusion
@@ -41,7 +63,6 @@ class ShardDataLoader_pretrain(Dataset):
 
     def __init__(
         self,
-        model,
         logger,
         template_name,
         meta,
@@ -66,6 +87,7 @@ class ShardDataLoader_pretrain(Dataset):
     ):
         super(ShardDataLoader_pretrain, self).__init__()
         self.ds_name = ds_name
+        register_profiled_name(ds_name)
         self.tokenizer = tokenizer
         self.template_name = template_name
         self.num_image_token = num_image_token
@@ -83,7 +105,6 @@ class ShardDataLoader_pretrain(Dataset):
         self.min_num_frame = min_num_frame
         self.sampling_method = sampling_method
         self.normalize_type=normalize_type
-        self.model=model
         # distributed
         total_ranks = torch.distributed.get_world_size()
         current_rank = torch.distributed.get_rank()
@@ -109,8 +130,24 @@ class ShardDataLoader_pretrain(Dataset):
             end_line = start_line + lines_per_rank  # Ending line for the current rank
             logger.info(f'start_line: {start_line}, end_line: {end_line}')
 
+            # Index the lengths on the full dataset so every rank shares one sidecar
+            if group_by_length:
+                length = load_or_build_token_lengths(
+                    raw_data1,
+                    meta["annotation"],
+                    tokenizer,
+                    meta["conversation"],
+                    self.ds_name,
+                    num_image_token,
+                    max_dynamic_patch,
+                    use_thumbnail,
+                    logger=logger,
+                )
+
             # Assign the appropriate lines to the current rank
             self.raw_data = raw_data1.select(range(start_line,end_line))
+            # Rows are quarantined by their index in the full dataset
+            self.quarantine = QuarantineIndex(meta["annotation"], dataset_fingerprint(raw_data1), offset=start_line)
             logger.info(f"Loaded shard dataset: {self.ds_name} with length: {len(self.raw_data)}")
             # Clear raw_data1 to free memory
             del raw_data1
@@ -125,6 +162,13 @@ class ShardDataLoader_pretrain(Dataset):
             self.image_key = meta["image_key"]
             logger.info(f"Loaded shard dataset: {self.ds_name} with length: {len(self.raw_data)}")
             self.conversations_key = meta["conversation"] 
+            # Column-projected views; band columns are read as zero-copy numpy views over Arrow
+            self.band_keys = band_columns(self.raw_data, self.record_columns())
+            self.records = self.raw_data.select_columns(
+                [key for key in self.record_columns() if key not in self.band_keys]
+            )
+            if self.band_keys:
+                self.band_records = self.raw_data.select_columns(self.band_keys).with_format("arrow")
             self.rng = np.random.default_rng(seed=random_seed)
            # self.raw_data = self.raw_data.shuffle(seed=random_seed)
         if "normalization" in meta:
@@ -154,60 +198,16 @@ class ShardDataLoader_pretrain(Dataset):
         self.min_dynamic_patch = min_dynamic_patch
         self.max_dynamic_patch = max_dynamic_patch
 
-        # If the precomputed length does not exist, roughly estimate the length of
-        # each sample to improve the efficiency of group_by_length.
-        if self.group_by_length:
-            self.conv2length = {}
-            # Using a dictionary to speed up token length calculation
-            self.length = []
-
-            # Start timing
-            start_time = time.time()
+        # Samples can share a batch only with the same ViT path and pixel layout
+        no_bands = getattr(self, "no_bands", 3)
+        num_images = len(meta["image_key"].split(",")) if str(ds_name).strip().startswith("Change") else 1
+        self.modality_signature = (MULTIBAND_MODALITY if no_bands != 3 else RGB_MODALITY, no_bands, num_images)
 
-            for data_item1 in self.raw_data[self.conversations_key]:
-                # Extract conversations from the data item
-                if(str(self.ds_name).strip().startswith("Naip")):
-                    data_item=json.loads(data_item1)
-                else:
-                    data_item = {
-                        "conversations": json.loads(data_item1),
-                    }
+        # The token lengths come from the persistent index of the full dataset,
+        # sliced to the lines of the current rank.
+        if self.group_by_length:
+            self.length = length[start_line:end_line]
 
-                # Check if the length is precomputed
-                if "length" in data_item:
-                    token_length = data_item["length"]
-                else:
-                    # Compute token length using the tokenizer
-                    conversations = "\n".join(
-                        [temp["value"] for temp in data_item["conversations"]]
-                    )
-                    str_length = len(conversations)
-
-                    # Check if the length for this string has been computed before
-                    if str_length not in self.conv2length:
-                        token_length = tokenizer(
-                            conversations,
-                            return_tensors="pt",
-                            padding=False,
-                            truncation=False,
-                        ).input_ids.size(1)
-                        self.conv2length[str_length] = (
-                            token_length
-                            + num_image_token * (max_dynamic_patch + use_thumbnail)
-                        )
-                    else:
-                        token_length = self.conv2length[str_length]
-
-                # Append the computed or retrieved token length to the length list
-                self.length.append(token_length)
-
-            # Calculate the total time taken
-            total_time = time.time() - start_time
-
-            # Log the total time taken
-            logger.info(
-                f"Total time taken to compute token length  {len(self.raw_data)} samples: {total_time:.2f} seconds"
-            )
             gc.collect()
     
    
@@ -279,6 +279,31 @@ class ShardDataLoader_pretrain(Dataset):
             normalize_type=self.normalize_type,
         )
         return transform
+    def use_tile_engine(self, image):
+        # PIL RGB images with a standard RGB normalization go through the tensor tile engine
+        return (
+            getattr(self, "no_bands", 3) == 3
+            and isinstance(image, Image.Image)
+            # Grayscale keeps its single channel in the transform pipeline
+            and image.mode != "L"
+            and self.image_key != "tif_ms"
+            and self.normalize_type in RGB_NORMALIZE_STATS
+            and not self.pad2square
+        )
+
+    def tile(self, image, max_num):
+        # The random JPEG degradation of training is applied to every tile, as in the transform pipeline
+        return tile_image(
+            image,
+            min_num=self.min_dynamic_patch,
+            max_num=max_num,
+            image_size=self.image_size,
+            use_thumbnail=self.use_thumbnail,
+            normalize_type=self.normalize_type,
+            dynamic=self.dynamic_image_size,
+            tile_transform=random_jpeg_degradation if self.is_train else None,
+        )
+
     def multi_modal_get_item(self, data_item):
         # Build transformation function
         transform = self.get_transform()
@@ -289,67 +314,79 @@ class ShardDataLoader_pretrain(Dataset):
                 "<image>\n" + data_item["conversations"][0]["value"]
             )
         image = data_item["image"]
+        start = stage_clock()
 
-        if self.dynamic_image_size & (not self.image_key == "tif_ms"):
-            # If dynamic image size is enabled, preprocess the image dynamically
-            images = dynamic_preprocess(
-                image,
-                min_num=self.min_dynamic_patch,
-                max_num=self.max_dynamic_patch,
-                image_size=self.image_size,
-                use_thumbnail=self.use_thumbnail,
-            )
+        if self.use_tile_engine(image):
+            # RGB fast path: one resize, one unfold and one fused normalize for all tiles
+            pixel_values = self.tile(image, self.max_dynamic_patch)
+            record_stage("tile", self.ds_name, start)
+            image_modality = RGB_MODALITY
+            num_patches = pixel_values.size(0)
         else:
-            # Otherwise, use the original image as a single patch
-            images = [image]
-        if self.no_bands != 3:
-            if self.image_key == "tif_ms":
-                # pixel_values_ms = self.convert_ms_bands(images)
-                # # image_ms_tensor = torch.tensor(result_array, dtype=torch.float32)
-                # pixel_values_ms = pixel_values_ms.unsqueeze(0)
-                # pixel_values_norm = [transform(image) for image in pixel_values_ms]
-                # pixel_values= torch.stack(pixel_values_norm)
-                pixel_values_ms=torch.tensor(np.array(images),dtype=torch.float32)
-                # image_ms_tensor = torch.tensor(pixel_values_ms_1, dtype=torch.float32)
-                pixel_values_ms = pixel_values_ms.unsqueeze(0)
-                pixel_values_norm = [transform(image) for image in pixel_values_ms]
-                pixel_values= torch.stack(pixel_values_norm)
-            elif self.image_key == "rgbi":
-                pixel_values_ms=torch.tensor(np.array(images),dtype=torch.float32)
-                # image_ms_tensor = torch.tensor(pixel_values_ms_1, dtype=torch.float32)
-                pixel_values_ms = pixel_values_ms.unsqueeze(0)
-                pixel_values_norm = [transform(image) for image in pixel_values_ms]
-                pixel_values= torch.stack(pixel_values_norm)
+            if self.dynamic_image_size & (not self.image_key == "tif_ms"):
+                # If dynamic image size is enabled, preprocess the image dynamically
+                images = dynamic_preprocess(
+                    image,
+                    min_num=self.min_dynamic_patch,
+                    max_num=self.max_dynamic_patch,
+                    image_size=self.image_size,
+                    use_thumbnail=self.use_thumbnail,
+                )
             else:
-                #print("Reading datasets............", self.ds_name)
-                # pixel_values_ms=torch.tensor(np.array(images),dtype=torch.float32)
-                # pixel_values_ms = pixel_values_ms.unsqueeze(0)
-                pixel_values = [transform(image) for image in images]
-                pixel_values = torch.stack(pixel_values)
+                # Otherwise, use the original image as a single patch
+                images = [image]
+            record_stage("tile", self.ds_name, start)
+            start = stage_clock()
+            if self.no_bands != 3:
+                if self.image_key == "tif_ms":
+                    # pixel_values_ms = self.convert_ms_bands(images)
+                    # # image_ms_tensor = torch.tensor(result_array, dtype=torch.float32)
+                    # pixel_values_ms = pixel_values_ms.unsqueeze(0)
+                    # pixel_values_norm = [transform(image) for image in pixel_values_ms]
+                    # pixel_values= torch.stack(pixel_values_norm)
+                    pixel_values_ms = band_tensor(stack_bands(images))
+                    # image_ms_tensor = torch.tensor(pixel_values_ms_1, dtype=torch.float32)
+                    pixel_values_ms = pixel_values_ms.unsqueeze(0)
+                    pixel_values_norm = [transform(image) for image in pixel_values_ms]
+                    pixel_values= torch.stack(pixel_values_norm)
+                elif self.image_key == "rgbi":
+                    pixel_values_ms = band_tensor(stack_bands(images))
+                    # image_ms_tensor = torch.tensor(pixel_values_ms_1, dtype=torch.float32)
+                    pixel_values_ms = pixel_values_ms.unsqueeze(0)
+                    pixel_values_norm = [transform(image) for image in pixel_values_ms]
+                    pixel_values= torch.stack(pixel_values_norm)
+                else:
+                    #print("Reading datasets............", self.ds_name)
+                    # pixel_values_ms=torch.tensor(np.array(images),dtype=torch.float32)
+                    # pixel_values_ms = pixel_values_ms.unsqueeze(0)
+                    pixel_values = [transform(image) for image in images]
+                    pixel_values = torch.stack(pixel_values)
             
-            # Apply Vit and get the embedding space..
-            pixel_values=self.model.sequential_vit_features(pixel_values,'bilinear')
-            num_patches = pixel_values.size(0)
+                # The model runs the band-group ViT passes for the whole batch
+                image_modality = MULTIBAND_MODALITY
+                num_patches = pixel_values.size(0)
         
-        # if self.image_key == "tif_ms":
-        #     pixel_values_ms = self.convert_ms_bands(images)
-        #     # image_ms_tensor = torch.tensor(result_array, dtype=torch.float32)
-        #     pixel_values_ms = pixel_values_ms.unsqueeze(0)
-        #     pixel_values_norm = [transform(image) for image in pixel_values_ms]
-        #     pixel_values_norm = torch.stack(pixel_values_norm)
-        #     # apply Vit and get the embedding space..
-        #     pixel_values = self.vit(pixel_values_norm)
-        #     #pixel_values = pixel_values.unsqueeze(0)
-        #     #print("MS fusion: ", pixel_values.shape)
+            # if self.image_key == "tif_ms":
+            #     pixel_values_ms = self.convert_ms_bands(images)
+            #     # image_ms_tensor = torch.tensor(result_array, dtype=torch.float32)
+            #     pixel_values_ms = pixel_values_ms.unsqueeze(0)
+            #     pixel_values_norm = [transform(image) for image in pixel_values_ms]
+            #     pixel_values_norm = torch.stack(pixel_values_norm)
+            #     # apply Vit and get the embedding space..
+            #     pixel_values = self.vit(pixel_values_norm)
+            #     #pixel_values = pixel_values.unsqueeze(0)
+            #     #print("MS fusion: ", pixel_values.shape)
             
-        #     # Ensure that there is only one patch if dynamic image size is not enabled
-        #     num_patches = pixel_values_ms.size(0)
-        else:
-            # Apply the transformation to each image and stack the results into a tensor
-            pixel_values = [transform(image) for image in images]
-            pixel_values = torch.stack(pixel_values)
-            # Ensure that there is only one patch if dynamic image size is not enabled
-            num_patches = pixel_values.size(0)
+            #     # Ensure that there is only one patch if dynamic image size is not enabled
+            #     num_patches = pixel_values_ms.size(0)
+            else:
+                # Apply the transformation to each image and stack the results into a tensor
+                pixel_values = [transform(image) for image in images]
+                pixel_values = torch.stack(pixel_values)
+                image_modality = RGB_MODALITY
+                # Ensure that there is only one patch if dynamic image size is not enabled
+                num_patches = pixel_values.size(0)
+            record_stage("transform", self.ds_name, start)
 
         if not self.dynamic_image_size:
             assert (
@@ -376,6 +413,7 @@ class ShardDataLoader_pretrain(Dataset):
             attention_mask=ret["attention_mask"][0],
             pixel_values=pixel_values,
             image_flags=torch.tensor([1] * num_patches, dtype=torch.long),
+            image_modality=torch.tensor([image_modality] * num_patches, dtype=torch.long),
         )
         return ret
     def multi_modal_get_item_old(self, data_item):
@@ -437,6 +475,7 @@ class ShardDataLoader_pretrain(Dataset):
             attention_mask=ret["attention_mask"][0],
             pixel_values=pixel_values,
             image_flags=torch.tensor([1] * num_patches, dtype=torch.long),
+            image_modality=torch.tensor([RGB_MODALITY] * num_patches, dtype=torch.long),
         )
         return ret
 
@@ -449,27 +488,40 @@ class ShardDataLoader_pretrain(Dataset):
             
         images, num_tiles = [], []
         num_image = len(data_item["image"])
-        for each_image in data_item["image"]:
-            # Merge the image path
-            # Load the image using tcs_loader if available, otherwise use PIL
-            image = each_image
-            if (
-                self.dynamic_image_size
-            ):  # If dynamic image size is enabled, preprocess the image dynamically
-                image = dynamic_preprocess(
-                    image,
-                    min_num=self.min_dynamic_patch,
-                    max_num=max(1, self.max_dynamic_patch // num_image),
-                    image_size=self.image_size,
-                    use_thumbnail=self.use_thumbnail,
-                )
-                images += image
-                num_tiles.append(len(image))
-            else:  # Otherwise, use the original image as a single patch
-                images.append(image)
-                num_tiles.append(1)
-        pixel_values = [transform(image) for image in images]
-        pixel_values = torch.stack(pixel_values)
+        start = stage_clock()
+        if all(self.use_tile_engine(image) for image in data_item["image"]):
+            # RGB fast path: each image is tiled, augmented and normalized as tensors
+            for each_image in data_item["image"]:
+                tiles = self.tile(each_image, max(1, self.max_dynamic_patch // num_image))
+                images.append(tiles)
+                num_tiles.append(tiles.size(0))
+            pixel_values = torch.cat(images)
+            record_stage("tile", self.ds_name, start)
+        else:
+            for each_image in data_item["image"]:
+                # Merge the image path
+                # Load the image using tcs_loader if available, otherwise use PIL
+                image = each_image
+                if (
+                    self.dynamic_image_size
+                ):  # If dynamic image size is enabled, preprocess the image dynamically
+                    image = dynamic_preprocess(
+                        image,
+                        min_num=self.min_dynamic_patch,
+                        max_num=max(1, self.max_dynamic_patch // num_image),
+                        image_size=self.image_size,
+                        use_thumbnail=self.use_thumbnail,
+                    )
+                    images += image
+                    num_tiles.append(len(image))
+                else:  # Otherwise, use the original image as a single patch
+                    images.append(image)
+                    num_tiles.append(1)
+            record_stage("tile", self.ds_name, start)
+            start = stage_clock()
+            pixel_values = [transform(image) for image in images]
+            pixel_values = torch.stack(pixel_values)
+            record_stage("transform", self.ds_name, start)
         num_patches = pixel_values.size(0)
 
         # Select the appropriate preprocessing function based on the template name
@@ -494,6 +546,7 @@ class ShardDataLoader_pretrain(Dataset):
             attention_mask=ret["attention_mask"][0],
             pixel_values=pixel_values,
             image_flags=torch.tensor([1] * num_patches, dtype=torch.long),
+            image_modality=torch.tensor([RGB_MODALITY] * num_patches, dtype=torch.long),
         )
         return ret
    
@@ -519,45 +572,83 @@ class ShardDataLoader_pretrain(Dataset):
             transformed_conversations.append(conversation_entry)
         return transformed_conversations
 
+    def record_columns(self):
+        # Image column(s) and conversation column read for every sample
+        columns = self.image_key.split(",") + [self.conversations_key]
+        return list(dict.fromkeys(columns))
+
+    def fetch_record(self, i):
+        # Projected record of row `i`, with its band columns as numpy views
+        record = self.records[i]
+        if self.band_keys:
+            record.update(read_band_rows(self.band_records, i))
+        return record
+
+    def fetch_records(self, indices):
+        # Projected records of the rows `indices`, with one columnar read per view
+        columns = self.records[indices]
+        records = [{key: values[j] for key, values in columns.items()} for j in range(len(indices))]
+        if self.band_keys:
+            for record, bands in zip(records, read_band_rows(self.band_records, indices)):
+                record.update(bands)
+        return records
+
+    def build_data_item(self, record):
+        # Build the data item of one sample from its projected record
+        conversations = json.loads(record[self.conversations_key])
+        if(str(self.ds_name).strip().startswith("Naip")):
+            return {"image": record[self.image_key], "conversations": conversations["conversations"]}
+        if(str(self.ds_name).strip().startswith("Change")):
+            image_objects = [record[img_key] for img_key in self.image_key.split(",")]
+            return {"image": image_objects, "conversations": conversations}
+        return {"image": record[self.image_key], "conversations": conversations}
+
+    def build_sample(self, record):
+        # Build the model inputs of one sample from its projected record
+        data_item = self.build_data_item(record)
+        if 'image' in data_item :
+            if (type(data_item['image']) == list) & (str(self.ds_name).strip().startswith("Change")):
+                return self.multi_modal_multi_image_get_item(data_item)
+            return self.multi_modal_get_item(data_item)
+        elif 'video' in data_item and data_item['video'] is not None and data_item['video'] != '':
+            return self.video_get_item(data_item)
+        return self.pure_text_get_item(data_item)
+
     def __getitem__(self, i) -> Dict[str, torch.Tensor]:
         i = i % len(self.raw_data)
+        return self.get_item(i)
+
+    def __getitems__(self, indices):
+        # One columnar read for the rows of the batch; decoding and retries stay per sample
+        indices = [i % len(self.raw_data) for i in indices]
+        # Quarantined rows are left out of the read; get_item replaces them
+        clean_indices = [i for i in indices if i not in self.quarantine]
+        try:
+            with data_stage("fetch", self.ds_name, count=len(clean_indices)):
+                records = dict(zip(clean_indices, self.fetch_records(clean_indices)))
+        except Exception as e:
+            logging.info(f"Batched read failed, falling back to per-sample reads. the dataset is: {self.ds_name}, {e}")
+            records = {}
+        return [self.get_item(i, records.get(i)) for i in indices]
+
+    def get_item(self, i, record=None):
+        start = stage_clock()
+        attempts = 0
         while True:
+            # Give up after MAX_SAMPLE_ATTEMPTS skipped or failed rows, e.g. all quarantined
+            check_sample_attempts(attempts, self.quarantine, len(self.raw_data), self.ds_name)
+            attempts += 1
+            if i in self.quarantine:
+                # Known bad row: skip it without reading or decoding it
+                increment_sample_counter("skipped")
+                i, record = random.randint(0, len(self.raw_data) - 1), None
+                continue
             try:
-                # if self.image_key in self.raw_data[i]:
-                #     image = self.raw_data[i][self.image_key]
-                # else:
-                #     print(f"Key '{self.image_key}' not found in entry {i} for {self.ds_name}. Available keys: {self.raw_data[i].keys()}")
-                    
-                if(str(self.ds_name).strip().startswith("Naip")):
-                        data_item = {
-                        "image": self.raw_data[i][self.image_key],
-                        "conversations": json.loads(self.raw_data[i][self.conversations_key])["conversations"],
-                                }
-                elif(str(self.ds_name).strip().startswith("Change")):
-                        image_list = self.image_key.split(",")
-                        # Access and store each image object dynamically
-                        image_objects = [self.raw_data[i][img_key] for img_key in image_list] 
-                        data_item = {
-                        "image": image_objects,
-                        "conversations": json.loads(self.raw_data[i][self.conversations_key])
-                        }
-                else:
-                        data_item = {
-                        "image": self.raw_data[i][self.image_key],
-                        "conversations": json.loads(
-                            self.raw_data[i][self.conversations_key]
-                        ),
-                                    }
-                    
-                if 'image' in data_item :
-                    if (type(data_item['image']) == list) & (str(self.ds_name).strip().startswith("Change")):
-                        ret = self.multi_modal_multi_image_get_item(data_item)
-                    else:
-                        ret = self.multi_modal_get_item(data_item)
-                elif 'video' in data_item and data_item['video'] is not None and data_item['video'] != '':
-                    ret = self.video_get_item(data_item)
-                else:
-                    ret = self.pure_text_get_item(data_item)
+                # Read the projected row once and build the data item from it
+                if record is None:
+                    with data_stage("fetch", self.ds_name):
+                        record = self.fetch_record(i)
+                ret = self.build_sample(record)
                 break
             # except Exception as e:
             #     print(e, self.ds_name, flush=True)
@@ -566,28 +657,171 @@ class ShardDataLoader_pretrain(Dataset):
                     logging.info(f"Truncated image at index {i}, skipping... the dataset is: {self.ds_name}")
                 if not isinstance(e, UnidentifiedImageError):
                     traceback.print_exc()
-                logging.info(e, self.ds_name, flush=True)
-                if not isinstance(e, UnidentifiedImageError):
-                    traceback.print_exc()
-                if(str(self.ds_name).strip().startswith("Naip")):
-                        data_item = {
-                        "image": self.raw_data[i][self.image_key],
-                        "conversations": json.loads(self.raw_data[i][self.conversations_key])["conversations"],
-                                }
-                else:
-                    data_item = {
-                    "image": self.raw_data[i][self.image_key],
-                    "conversations": json.loads(
-                        self.raw_data[i][self.conversations_key]
-                    ),
-                }
+                logging.info(f"{e}, the dataset is: {self.ds_name}")
                 logging.info(f'Failed to load image from id: {i}, the dataset is: {self.ds_name}')
-                i = random.randint(0, len(self.raw_data) - 1)
+                # Only rows that fail to decode are quarantined; IO errors and bugs are counted
+                self.quarantine.record_failure(i, e)
+                i, record = random.randint(0, len(self.raw_data) - 1), None
+        record_stage("sample", self.ds_name, start)
         return ret
         
                 # if not isinstance(e, UnidentifiedImageError):
                 #     traceback.print_exc()
 
+class ShardStreamDataset_pretrain(ShardDataLoader_pretrain, IterableDataset):
+    """
+    Streaming variant of `ShardDataLoader_pretrain`, enabled with `"streaming": true` in the meta file.
+
+    Rows are streamed from the memory-mapped Arrow files, split between the
+    `(rank, DataLoader worker)` pairs, and shuffled through a bounded buffer; see
+    `shard_stream`. Samples are built by the `ShardDataLoader_pretrain` methods.
+    The stream has no length and never ends: training needs `--max_steps`.
+    """
+
+    def __init__(
+        self,
+        logger,
+        template_name,
+        meta,
+        tokenizer,
+        tcs_loader,
+        ds_name,
+        num_image_token,
+        image_size=224,
+        is_train=True,
+        pad2square=False,
+        group_by_length=False,
+        dynamic_image_size=False,
+        use_thumbnail=False,
+        min_dynamic_patch=1,
+        max_dynamic_patch=6,
+        repeat_time=1,
+        normalize_type="imagenet",
+        random_seed=0,
+    ):
+        IterableDataset.__init__(self)
+        self.ds_name = ds_name
+        register_profiled_name(ds_name)
+        self.tokenizer = tokenizer
+        self.template_name = template_name
+        self.num_image_token = num_image_token
+        self.image_size = image_size
+        self.is_train = is_train
+        self.pad2square = pad2square
+        self.normalize_type = normalize_type
+        self.tcs_loader = tcs_loader
+        # Streams have no random access, hence no length-grouped sampler
+        if group_by_length:
+            logger.info(f"group_by_length is ignored for the streaming dataset: {self.ds_name}")
+        self.group_by_length = False
+        self.dynamic_image_size = dynamic_image_size
+        self.use_thumbnail = use_thumbnail
+        self.min_dynamic_patch = min_dynamic_patch
+        self.max_dynamic_patch = max_dynamic_patch
+        self.random_seed = random_seed
+        self.shuffle_buffer = meta.get("shuffle_buffer", STREAM_SHUFFLE_BUFFER)
+        self.position = None
+
+        self.image_key = meta["image_key"]
+        self.conversations_key = meta["conversation"]
+        if "normalization" in meta:
+            self.normalize_type = meta["normalization"]
+        if "bands" in meta:
+            self.no_bands = meta["bands"]
+
+        # Only the file list and row counts are kept; rows are read while streaming
+        self.data_files = stream_data_files(meta["annotation"])
+        self.file_rows = []
+        for path in self.data_files:
+            data_file = open_data_file(path)
+            self.file_rows.append(len(data_file))
+        self.num_rows = sum(self.file_rows)
+        self.band_keys = band_columns(data_file, self.record_columns())
+        del data_file
+        # Same sidecar as the map-style dataset; loading only memory-maps the files
+        self.quarantine = QuarantineIndex(meta["annotation"], dataset_fingerprint(load_from_disk(meta["annotation"])))
+        logger.info(f"Streaming shard dataset: {self.ds_name} with {self.num_rows} rows in {len(self.data_files)} files")
+
+    def __len__(self):
+        raise TypeError(f"The streaming dataset {self.ds_name} has no length")
+
+    def load_state_dict(self, position):
+        # Position from `shard_stream.stream_position`, applied on the next iteration
+        self.position = position
+
+    def __iter__(self):
+        _, _, worker_id, _ = stream_consumer()
+        return self.iter_samples(skip=consumed_samples(self.position, worker_id))
+
+    def read_rows(self, consumer, num_consumers):
+        # Rows of the pieces dealt to `consumer`, epoch after epoch, as (row index, record)
+        piece_rows = max(1, min(STREAM_PIECE_ROWS, self.num_rows // num_consumers))
+        pieces = split_pieces(self.file_rows, piece_rows)
+        if len(pieces) < num_consumers:
+            raise ValueError(
+                f"The streaming dataset {self.ds_name} has {self.num_rows} rows for {num_consumers} consumers"
+            )
+        columns = [key for key in self.record_columns() if key not in self.band_keys]
+        epoch, file_idx = 0, None
+        while True:
+            # Same piece order on every consumer; each takes every num_consumers-th piece
+            order = np.random.default_rng([self.random_seed, epoch]).permutation(len(pieces))
+            for piece_idx in order[consumer::num_consumers]:
+                piece_file_idx, first_row, start, stop = pieces[piece_idx]
+                if piece_file_idx != file_idx:
+                    file_idx = piece_file_idx
+                    data_file = open_data_file(self.data_files[file_idx])
+                    records = data_file.select_columns(columns)
+                    if self.band_keys:
+                        band_records = data_file.select_columns(self.band_keys).with_format("arrow")
+                for block_start in range(start, stop, STREAM_READ_ROWS):
+                    block_stop = min(block_start + STREAM_READ_ROWS, stop)
+                    block = records[block_start:block_stop]
+                    rows = [{key: values[j] for key, values in block.items()} for j in range(block_stop - block_start)]
+                    if self.band_keys:
+                        for record, bands in zip(rows, read_band_rows(band_records, list(range(block_start, block_stop)))):
+                            record.update(bands)
+                    for j, record in enumerate(rows):
+                        yield first_row + block_start + j, record
+            epoch += 1
+
+    def iter_samples(self, skip=0):
+        """
+        Yield the samples of the calling consumer.
+
+        Args:
+            skip (int): Number of samples to fast-forward over, without decoding them.
+        """
+        consumer, num_consumers, _, _ = stream_consumer()
+        rng = np.random.default_rng([self.random_seed, consumer])
+        attempts = 0
+        for i, record in shuffle_buffer(self.read_rows(consumer, num_consumers), self.shuffle_buffer, rng):
+            # Quarantined rows yield nothing, whether they failed in this run or an earlier one
+            if i in self.quarantine:
+                if not skip:
+                    increment_sample_counter("skipped")
+                    attempts += 1
+                    check_sample_attempts(attempts, self.quarantine, self.num_rows, self.ds_name)
+                continue
+            if skip:
+                skip -= 1
+                continue
+            try:
+                start = stage_clock()
+                sample = self.build_sample(record)
+                record_stage("sample", self.ds_name, start)
+            except Exception as e:
+                if not isinstance(e, UnidentifiedImageError):
+                    traceback.print_exc()
+                logging.info(f"{e}, the dataset is: {self.ds_name}")
+                logging.info(f'Failed to load image from id: {i}, the dataset is: {self.ds_name}')
+                self.quarantine.record_failure(i, e)
+                attempts += 1
+                check_sample_attempts(attempts, self.quarantine, self.num_rows, self.ds_name)
+                continue
+            attempts = 0
+            yield sample
+
 # class ShardDataLoader(Dataset):
 #     """Dataset for loading data using hugging face data loader for the supervised fine-tuning."""
 
@@ -1,4 +1,5 @@
 import io
+from functools import lru_cache
 
 from transformers.trainer_pt_utils import LabelSmoother
 
@@ -14,15 +15,18 @@ import torch
 import torchvision.transforms as T
 import transformers
 from decord import VideoReader
-from earthdial.conversation import get_conv_template
+from earthdial.conversation import SeparatorStyle, get_conv_template, get_template_tokens, tokenize_prompts
 from PIL import Image
-from torch.utils.data import ConcatDataset, WeightedRandomSampler
+from torch.utils.data import ConcatDataset as _ConcatDataset
 from torchvision.transforms.functional import InterpolationMode
 import torch.nn.functional as F
 
+from .profiler import record_stage, stage_clock
 from .constants import (CLIP_MEAN, CLIP_STD, IMAGENET_MEAN, IMAGENET_STD,
-                        IMG_CONTEXT_TOKEN, IMG_END_TOKEN, IMG_START_TOKEN,
+                        IMG_CONTEXT_TOKEN,
                         SIGLIP_MEAN, SIGLIP_STD,S2_MEAN,S2_STD,S1_MEAN,S1_STD,rgbi_mean,rgbi_std,L8_MEAN,L8_STD)
+from .image_tokens import insert_image_placeholders, splice_image_tokens
+from .tiling import find_closest_aspect_ratio, get_tile_grid
 
 # try:
 #     from petrel_client.client import Client
@@ -159,18 +163,92 @@ def read_frames_folder(
     return frames
 
 
-class WeightedConcatDataset(ConcatDataset):
-    def __init__(self, datasets, weights):
+class ConcatDataset(_ConcatDataset):
+    """`ConcatDataset` that forwards batched `__getitems__` calls to its datasets."""
+
+    # Budget of the training batches, in padded tokens and ViT tiles (see TokenBudgetBatchSampler);
+    # None keeps batches of `per_device_train_batch_size` samples
+    max_batch_tokens = None
+    max_batch_tiles = None
+
+    def __init__(self, datasets):
         super().__init__(datasets)
-        self.weights = torch.DoubleTensor(weights)
-        self.total_size = sum(len(d) for d in datasets)
-        self.sampler = WeightedRandomSampler(weights=self.weights, num_samples=self.total_size, replacement=True)
+        # Dataset of every index, for O(1) lookups instead of a bisect per sample; built
+        # before the DataLoader workers fork, so that they share it
+        sizes = np.diff(self.cumulative_sizes, prepend=0)
+        self.dataset_index = np.repeat(np.arange(len(sizes), dtype=np.min_scalar_type(len(sizes))), sizes)
+        self.dataset_offsets = np.asarray([0] + self.cumulative_sizes[:-1], dtype=np.int64)
+
+    def modality_groups(self):
+        """
+        Return the modality group of every index, from the `modality_signature` of the datasets,
+        or None when all the datasets share one and batches need no grouping.
+        """
+        signatures = [getattr(dataset, 'modality_signature', None) for dataset in self.datasets]
+        unique = list(dict.fromkeys(signatures))
+        if len(unique) <= 1:
+            return None
+        groups = np.asarray([unique.index(signature) for signature in signatures],
+                            dtype=np.min_scalar_type(len(unique)))
+        return groups[self.dataset_index]
+
+    def __getitem__(self, idx):
+        if idx < 0:
+            idx += len(self)
+        dataset_idx = int(self.dataset_index[idx])
+        return self.datasets[dataset_idx][idx - int(self.dataset_offsets[dataset_idx])]
+
+    def __getitems__(self, indices):
+        # Group the batch by dataset, keeping the position of each sample in the batch
+        indices = np.asarray(indices, dtype=np.int64)
+        indices[indices < 0] += len(self)
+        dataset_ids = self.dataset_index[indices]
+        sample_ids = indices - self.dataset_offsets[dataset_ids]
+
+        batch = [None] * len(indices)
+        for dataset_idx in np.unique(dataset_ids).tolist():
+            positions = np.flatnonzero(dataset_ids == dataset_idx).tolist()
+            sample_indices = sample_ids[positions].tolist()
+            dataset = self.datasets[dataset_idx]
+            if hasattr(dataset, '__getitems__'):
+                samples = dataset.__getitems__(sample_indices)
+            else:
+                samples = [dataset[sample_idx] for sample_idx in sample_indices]
+            for pos, sample in zip(positions, samples):
+                batch[pos] = sample
+        return batch
 
-    def __iter__(self):
-        return iter(self.sampler)
 
-    def __len__(self):
-        return self.total_size
+class WeightedConcatDataset(ConcatDataset):
+    """
+    Mixture of datasets, drawn by `MixtureSampler` (see train_sampler_patch).
+
+    The size of each dataset is scaled by its `repeat_time`, and an epoch of the summed
+    scaled sizes is shared between the datasets in proportion to `weights ** (1 / temperature)`.
+    A dataset drawn more often than its size is repeated, one shuffled pass after the
+    other; no sample is copied.
+
+    Args:
+        datasets (list): The datasets.
+        weights (list, optional): Sampling weight of each dataset; the scaled sizes by default.
+        repeat_times (list, optional): Size factor of each dataset; below 1 it subsamples.
+        temperature (float): Flattens the weights above 1, e.g. 2 for square-root sampling.
+    """
+
+    def __init__(self, datasets, weights=None, repeat_times=None, temperature=1.0):
+        super().__init__(datasets)
+        sizes = np.asarray([len(d) for d in datasets], dtype=np.float64)
+        repeat_times = np.ones(len(datasets)) if repeat_times is None else np.asarray(repeat_times, dtype=np.float64)
+        scaled_sizes = sizes * repeat_times
+        weights = scaled_sizes if weights is None else np.asarray(weights, dtype=np.float64)
+        weights = weights ** (1.0 / temperature)
+        self.weights = weights / weights.sum()
+        # Largest-remainder rounding, so that the epoch keeps the total scaled size
+        quota = self.weights * round(scaled_sizes.sum())
+        num_samples = np.floor(quota).astype(np.int64)
+        remainder = round(scaled_sizes.sum()) - num_samples.sum()
+        num_samples[np.argsort(num_samples - quota, kind='stable')[:remainder]] += 1
+        self.num_samples = num_samples
 
 
 def pil_loader(img_str):
@@ -235,6 +313,11 @@ def simulate_jpeg_degradation(quality):
 qualities = list(range(75, 101))
 jpeg_degrade_functions = {quality: simulate_jpeg_degradation(quality) for quality in qualities}
 
+
+def random_jpeg_degradation(img):
+    # Same augmentation as the `T.RandomChoice` over `jpeg_degrade_functions` in `build_transform`
+    return jpeg_degrade_functions[random.choice(qualities)](img)
+
 # Custom transform for resizing a multi-channel image tensor
 class MultiChannelResize:
     def __init__(self, size, interpolation=InterpolationMode.BICUBIC):
@@ -248,7 +331,23 @@ class MultiChannelResize:
             img = img.unsqueeze(0)
         img = F.interpolate(img, size=(self.size, self.size), mode=self.interpolation.value, align_corners=False)
         return img.squeeze(0)  # Remove the batch dimension to return (C, H, W)
-    
+
+
+# Normalization of multi-band float tensors with precomputed per-band statistics
+class BandNormalize:
+    def __init__(self, mean, std):
+        self.mean = torch.as_tensor(mean, dtype=torch.float32).view(-1, 1, 1)
+        self.inv_std = 1.0 / torch.as_tensor(std, dtype=torch.float32).view(-1, 1, 1)
+
+    def __call__(self, img):
+        # Normalize in place; other dtypes (e.g. compact uint16/float16 bands) get a new float32 buffer
+        if img.dtype != self.mean.dtype:
+            img = img.to(self.mean.dtype)
+        return img.sub_(self.mean).mul_(self.inv_std)
+
+
+# Transforms are stateless, so one pipeline per configuration is built and shared by all datasets
+@lru_cache(maxsize=None)
 def build_transform(is_train, input_size, pad2square=False, normalize_type='imagenet'):
     if normalize_type == 'imagenet':
         MEAN, STD = IMAGENET_MEAN, IMAGENET_STD
@@ -275,13 +374,13 @@ def build_transform(is_train, input_size, pad2square=False, normalize_type='imag
            transform = T.Compose([
                 T.Resize((input_size, input_size), interpolation=InterpolationMode.BICUBIC),
                 T.ToTensor(),
-                T.Normalize(mean=S2_MEAN, std=S2_STD)
+                BandNormalize(mean=S2_MEAN, std=S2_STD)
             ])
         elif normalize_type=="s1":
                 transform = T.Compose([
                         T.Lambda(lambda img: img if img.mode == 'L' else img.convert('RGB')),
                         T.Resize((input_size, input_size), interpolation=InterpolationMode.BICUBIC),
-                        T.Normalize(mean=S1_MEAN, std=S1_STD)
+                        BandNormalize(mean=S1_MEAN, std=S1_STD)
                     ])
         else:
             transform = T.Compose([
@@ -296,34 +395,34 @@ def build_transform(is_train, input_size, pad2square=False, normalize_type='imag
         if pad2square is False:  # now we use this transform function by default
             if normalize_type=="s2_l2a":
                 transform = T.Compose([
-                        T.Normalize(mean=S2_MEAN, std=S2_STD),
+                        BandNormalize(mean=S2_MEAN, std=S2_STD),
                         MultiChannelResize(input_size)
                     ])
             elif normalize_type=="s2_norm":
                 transform = T.Compose([
-                        T.Normalize(mean=MEAN, std=STD),
+                        BandNormalize(mean=MEAN, std=STD),
                         MultiChannelResize(input_size)
                     ])
             elif normalize_type=="l8_norm":
                 transform = T.Compose([
-                        T.Normalize(mean=MEAN, std=STD),
+                        BandNormalize(mean=MEAN, std=STD),
                         MultiChannelResize(input_size)
                     ])
             elif normalize_type=="rgbm_norm":
                 transform = T.Compose([
-                        T.Normalize(mean=MEAN, std=STD),
+                        BandNormalize(mean=MEAN, std=STD),
                         MultiChannelResize(input_size)
                     ])
             elif normalize_type=="tree_norm":
                 transform = T.Compose([
-                        T.Normalize(mean=rgbi_mean, std=rgbi_std),
+                        BandNormalize(mean=rgbi_mean, std=rgbi_std),
                         MultiChannelResize(input_size)
                     ])
             elif normalize_type=="s1":
                 transform = T.Compose([
                         T.ToTensor(),
                         T.Lambda(lambda x: x.unsqueeze(0) if x.ndim == 2 else x),  # Add channel dim if grayscale
-                        T.Normalize(mean=S1_MEAN, std=S1_STD),
+                        BandNormalize(mean=S1_MEAN, std=S1_STD),
                         T.Resize((input_size, input_size), interpolation=InterpolationMode.BICUBIC)
                     ])
             
@@ -346,6 +445,126 @@ def build_transform(is_train, input_size, pad2square=False, normalize_type='imag
     return transform
 
 
+@lru_cache(maxsize=None)
+def assistant_boundaries(tokenizer, template_name):
+    """
+    Token ids that delimit the answers of a conversation template, for single-pass label masking.
+
+    Returns:
+        tuple | None: The ids of the assistant header (`<|assistant|>\\n`, `<|im_start|>assistant\\n`,
+            `<bot>:`) and the id of the single token closing every answer (`<|end|>`, `<|im_end|>`,
+            `</s>`); None when the template or tokenizer does not have such tokens. For the MPT
+            templates they are the cached `role_ids` and `sep_ids` of `get_template_tokens`.
+    """
+    conv = get_conv_template(template_name)
+    if conv.sep_style == SeparatorStyle.MPT:
+        template_tokens = get_template_tokens(template_name, tokenizer)
+        if template_tokens is not None:
+            # The cached ids of the assistant header and of the separator closing every message
+            header_ids, sep_ids = template_tokens.role_ids[1], template_tokens.sep_ids
+            if len(sep_ids) != 1 or not header_ids or sep_ids[0] in header_ids:
+                return None
+            return header_ids, sep_ids[0]
+        header, close = conv.roles[1], conv.sep
+    elif conv.sep_style == SeparatorStyle.INTERNVL_ZH:
+        header, close = conv.roles[1] + ':', conv.sep
+    elif conv.sep_style == SeparatorStyle.ADD_COLON_TWO:
+        header, close = conv.roles[1] + ':', conv.sep2
+    else:
+        return None
+    close_id = tokenizer.convert_tokens_to_ids(close)
+    if close_id is None or close_id == tokenizer.unk_token_id:
+        return None
+    header_ids = tokenizer(header, add_special_tokens=False).input_ids
+    # Legacy sentencepiece tokenizers prepend a lone '▁' to a text starting with a special token
+    while header_ids and tokenizer.convert_ids_to_tokens(header_ids[0]) == '▁':
+        header_ids = header_ids[1:]
+    if not header_ids or close_id in header_ids:
+        return None
+    return tuple(header_ids), close_id
+
+
+def mask_assistant_spans(target, total_len, boundaries, num_answers, truncated):
+    """
+    Mask, in place, every token of a tokenized conversation but its answers and their closing token.
+
+    The answers are found in the ids themselves: each starts after an assistant header and ends
+    with the first closing token that follows it. The conversation is tokenized only once.
+
+    Args:
+        target (torch.Tensor): The labels of one sample, a copy of its input ids.
+        total_len (int): Number of tokens before the padding.
+        boundaries (tuple): Header ids and closing id, from `assistant_boundaries`.
+        num_answers (int): Assistant messages in the conversation.
+        truncated (bool): Whether the conversation was truncated to `model_max_length`.
+
+    Returns:
+        bool: False, with `target` untouched, when the answers found do not match the conversation;
+            the caller then masks the sample turn by turn.
+    """
+    header_ids, close_id = boundaries
+    ids = target[:total_len].numpy()
+    header = np.asarray(header_ids, dtype=ids.dtype)
+    if len(ids) < len(header):
+        starts = np.zeros(0, dtype=np.int64)
+    else:
+        windows = np.lib.stride_tricks.sliding_window_view(ids, len(header))
+        starts = np.flatnonzero((windows == header).all(axis=1)) + len(header)
+    if len(starts) != num_answers and not (truncated and len(starts) < num_answers):
+        return False
+    closes = np.flatnonzero(ids == close_id)
+    following = np.searchsorted(closes, starts)
+    ends = np.append(closes, total_len - 1)[following] + 1
+    # Only the last answer of a truncated sample may be left open, and answers never overlap
+    open_answers = following == len(closes)
+    if open_answers[:-1].any() or (open_answers[-1:].any() and not truncated):
+        return False
+    if (ends[:-1] > starts[1:] - len(header)).any():
+        return False
+    keep = np.zeros(len(target) + 1, dtype=np.int64)
+    np.add.at(keep, starts, 1)
+    np.add.at(keep, ends, -1)
+    target[torch.from_numpy(np.cumsum(keep[:-1]) == 0)] = IGNORE_TOKEN_ID
+    return True
+
+
+def tokenize_conversations(conversations, tokenizer, template_name, padding):
+    """
+    Tokenize rendered conversations, truncated to `tokenizer.model_max_length` and padded as `padding`.
+
+    The ids of the system prompt of the template are cached (`get_template_tokens`), so only the turns
+    are tokenized; the ids are those of the whole conversations tokenized at once.
+    """
+    max_length = tokenizer.model_max_length
+    if tokenizer.truncation_side != 'right':
+        return tokenizer(
+            conversations, return_tensors='pt', padding=padding, max_length=max_length, truncation=True,
+        ).input_ids
+    input_ids = tokenize_prompts(tokenizer, conversations, template_name, max_length=max_length)
+    return tokenizer.pad(
+        {'input_ids': input_ids}, padding=padding, max_length=max_length, return_tensors='pt',
+    )['input_ids']
+
+
+def splice_image_spans(input_ids, targets, tokenizer, num_image_token_list, num_image):
+    """
+    Splice the image tokens into conversations tokenized with one context marker per image.
+
+    The samples are cut to `tokenizer.model_max_length` once spliced, so their truncation and
+    padding are those of the conversations tokenized with all their image tokens.
+    """
+    img_context_token_id = tokenizer.convert_tokens_to_ids(IMG_CONTEXT_TOKEN)
+    max_length = tokenizer.model_max_length
+    spliced_ids, spliced_targets = [], []
+    for ids, target in zip(input_ids, targets):
+        ids, target = splice_image_tokens(ids, img_context_token_id, num_image_token_list[:num_image], target)
+        spliced_ids.append(ids[:max_length])
+        spliced_targets.append(target[:max_length])
+    input_ids = torch.nn.utils.rnn.pad_sequence(spliced_ids, batch_first=True, padding_value=tokenizer.pad_token_id)
+    targets = torch.nn.utils.rnn.pad_sequence(spliced_targets, batch_first=True, padding_value=IGNORE_TOKEN_ID)
+    return input_ids, targets
+
+
 def preprocess(
         template_name,
         sources,
@@ -357,11 +576,12 @@ def preprocess(
         ds_name: str = None,
         num_image: int = 1
 ) -> Dict:
+    start = stage_clock()
     conv = get_conv_template(template_name)
     roles = {'human': conv.roles[0], 'gpt': conv.roles[1]}
 
     # Apply prompt templates
-    conversations = []
+    conversations, num_answers = [], []
     for i, source in enumerate(sources):
         if roles[source[0]['from']] != conv.roles[0]:
             # Skip the first one if it is not from human
@@ -373,32 +593,32 @@ def preprocess(
             assert role == conv.roles[j % 2], f'{i}'
             conv.append_message(role, sentence['value'])
         conversations.append(conv.get_prompt())
+        num_answers.append(sum(role == conv.roles[1] for role, _ in conv.messages))
 
     if not text_only:
-        new_conversations = []
-        for conversation in conversations:
-            for i in range(num_image):
-                image_tokens = f'{IMG_START_TOKEN}{IMG_CONTEXT_TOKEN * num_image_token_list[i]}{IMG_END_TOKEN}'
-                conversation = conversation.replace('<image>', image_tokens, 1)
-            new_conversations.append(conversation)
-        conversations = new_conversations
+        # One context marker per image; the image tokens are spliced into the ids once masked
+        conversations = [insert_image_placeholders(conversation, num_image) for conversation in conversations]
+
+    record_stage('template', ds_name, start)
+    start = stage_clock()
 
     # Tokenize conversations
-    input_ids = tokenizer(
-        conversations,
-        return_tensors='pt',
+    input_ids = tokenize_conversations(
+        conversations, tokenizer, template_name,
         padding=False if group_by_length or use_packed_ds else 'max_length',
-        max_length=tokenizer.model_max_length,
-        truncation=True,
-    ).input_ids
+    )
     targets = input_ids.clone()
 
     # assert conv.sep_style == SeparatorStyle.ADD_COLON_TWO
 
     # Mask targets. Only compute loss on the assistant outputs.
     sep = conv.sep + conv.roles[1] + ': '
-    for conversation, target in zip(conversations, targets):
+    boundaries = assistant_boundaries(tokenizer, template_name)
+    for conversation, target, answers in zip(conversations, targets, num_answers):
         total_len = int(target.ne(tokenizer.pad_token_id).sum())
+        truncated = total_len >= tokenizer.model_max_length
+        if boundaries and mask_assistant_spans(target, total_len, boundaries, answers, truncated):
+            continue
 
         turns = conversation.split(conv.sep2)
         cur_len = 1
@@ -444,6 +664,9 @@ def preprocess(
                 )
                 sys.stdout.flush()
 
+    if not text_only:
+        input_ids, targets = splice_image_spans(input_ids, targets, tokenizer, num_image_token_list, num_image)
+    record_stage('tokenize', ds_name, start)
     return dict(
         input_ids=input_ids,
         labels=targets,
@@ -462,11 +685,12 @@ def preprocess_mpt(
         ds_name: str = None,
         num_image: int = 1
 ) -> Dict:
+    start = stage_clock()
     conv = get_conv_template(template_name)
     roles = {'human': conv.roles[0], 'gpt': conv.roles[1]}
 
     # Apply prompt templates
-    conversations = []
+    conversations, num_answers = [], []
     for i, source in enumerate(sources):
         if roles[source[0]['from']] != conv.roles[0]:
             # Skip the first one if it is not from human
@@ -478,30 +702,30 @@ def preprocess_mpt(
             assert role == conv.roles[j % 2], f'{i}'
             conv.append_message(role, sentence['value'])
         conversations.append(conv.get_prompt())
+        num_answers.append(sum(role == conv.roles[1] for role, _ in conv.messages))
 
     if not text_only:
-        new_conversations = []
-        for conversation in conversations:
-            for i in range(num_image):
-                image_tokens = f'{IMG_START_TOKEN}{IMG_CONTEXT_TOKEN * num_image_token_list[i]}{IMG_END_TOKEN}'
-                conversation = conversation.replace('<image>', image_tokens, 1)
-            new_conversations.append(conversation)
-        conversations = new_conversations
+        # One context marker per image; the image tokens are spliced into the ids once masked
+        conversations = [insert_image_placeholders(conversation, num_image) for conversation in conversations]
+
+    record_stage('template', ds_name, start)
+    start = stage_clock()
 
     # Tokenize conversations
-    input_ids = tokenizer(
-        conversations,
-        return_tensors='pt',
+    input_ids = tokenize_conversations(
+        conversations, tokenizer, template_name,
         padding=False if group_by_length or use_packed_ds else 'max_length',
-        max_length=tokenizer.model_max_length,
-        truncation=True,
-    ).input_ids
+    )
     targets = input_ids.clone()
 
     # Mask targets. Only compute loss on the assistant outputs.
     sep = conv.sep + conv.roles[1]  # <|im_end|><|im_start|>assistant\n
-    for conversation, target in zip(conversations, targets):
+    boundaries = assistant_boundaries(tokenizer, template_name)
+    for conversation, target, answers in zip(conversations, targets, num_answers):
         total_len = int(target.ne(tokenizer.pad_token_id).sum())
+        truncated = total_len >= tokenizer.model_max_length
+        if boundaries and mask_assistant_spans(target, total_len, boundaries, answers, truncated):
+            continue
 
         turns = conversation.split(conv.sep)
         re_turns = [conv.sep.join(turns[:3])]  # system + user + gpt
@@ -538,6 +762,9 @@ def preprocess_mpt(
                 )
                 sys.stdout.flush()
 
+    if not text_only:
+        input_ids, targets = splice_image_spans(input_ids, targets, tokenizer, num_image_token_list, num_image)
+    record_stage('tokenize', ds_name, start)
     return dict(
         input_ids=input_ids,
         labels=targets,
@@ -556,11 +783,12 @@ def preprocess_phi3(
         ds_name: str = None,
         num_image: int = 1
 ) -> Dict:
+    start = stage_clock()
     conv = get_conv_template(template_name)
     roles = {'human': conv.roles[0], 'gpt': conv.roles[1]}
 
     # Apply prompt templates
-    conversations = []
+    conversations, num_answers = [], []
     for i, source in enumerate(sources):
         try:
             # Check if source is non-empty before accessing it
@@ -577,6 +805,7 @@ def preprocess_phi3(
                 assert role == conv.roles[j % 2], f'{i}'
                 conv.append_message(role, sentence['value'])
             conversations.append(conv.get_prompt())
+            num_answers.append(sum(role == conv.roles[1] for role, _ in conv.messages))
         
         except IndexError as e:
             # Print dataset name and problematic source list for debugging
@@ -597,29 +826,31 @@ def preprocess_phi3(
     #     conversations.append(conv.get_prompt())
 
     if not text_only:
-        new_conversations = []
-        for conversation in conversations:
-            for i in range(num_image):
-                image_tokens = f'{IMG_START_TOKEN}{IMG_CONTEXT_TOKEN * num_image_token_list[i]}{IMG_END_TOKEN}'
-                conversation = conversation.replace('<image>', image_tokens, 1)
-            new_conversations.append(conversation)
-        conversations = new_conversations
+        # One context marker per image; the image tokens are spliced into the ids once masked
+        conversations = [insert_image_placeholders(conversation, num_image) for conversation in conversations]
+
+    record_stage('template', ds_name, start)
+    start = stage_clock()
 
     # Tokenize conversations
     tokenizer.padding_side = 'right'
-    input_ids = tokenizer(
-        conversations,
-        return_tensors='pt',
+    input_ids = tokenize_conversations(
+        conversations, tokenizer, template_name,
         padding=False if group_by_length or use_packed_ds else 'max_length',
-        max_length=tokenizer.model_max_length,
-        truncation=True,
-    ).input_ids
+    )
     targets = input_ids.clone()
 
     # Mask targets. Only compute loss on the assistant outputs.
     sep = conv.sep + conv.roles[1]  # <|end|>\n<|assistant|>
-    for conversation, target in zip(conversations, targets):
+    boundaries = assistant_boundaries(tokenizer, template_name)
+    endoftext_id = tokenizer.convert_tokens_to_ids('<|endoftext|>')
+    for conversation, target, answers in zip(conversations, targets, num_answers):
         total_len = int(target.ne(int(tokenizer.pad_token_id)).sum())
+        truncated = total_len >= tokenizer.model_max_length
+        if boundaries and mask_assistant_spans(target, total_len, boundaries, answers, truncated):
+            # As turn by turn, <|endoftext|> is never a label, even inside an answer
+            target[target == endoftext_id] = IGNORE_TOKEN_ID
+            continue
 
         turns = conversation.split(conv.sep)
         re_turns = [conv.sep.join(turns[:3])]  # system + user + gpt
@@ -627,7 +858,6 @@ def preprocess_phi3(
             re_turns.append(conv.sep.join(turns[conv_idx:conv_idx + 2]))  # user + gpt
         cur_len = 1
         target[:cur_len] = IGNORE_TOKEN_ID
-        endoftext_id = tokenizer.convert_tokens_to_ids('<|endoftext|>')
         target[target == endoftext_id] = IGNORE_TOKEN_ID
 
         for i, turn in enumerate(re_turns):
@@ -670,6 +900,9 @@ def preprocess_phi3(
                 )
                 sys.stdout.flush()
 
+    if not text_only:
+        input_ids, targets = splice_image_spans(input_ids, targets, tokenizer, num_image_token_list, num_image)
+    record_stage('tokenize', ds_name, start)
     return dict(
         input_ids=input_ids,
         labels=targets,
@@ -688,11 +921,12 @@ def preprocess_internlm(
         ds_name: str = None,
         num_image: int = 1
 ) -> Dict:
+    start = stage_clock()
     conv = get_conv_template(template_name)
     roles = {'human': conv.roles[0], 'gpt': conv.roles[1]}
 
     # Apply prompt templates
-    conversations = []
+    conversations, num_answers = [], []
     for i, source in enumerate(sources):
         if roles[source[0]['from']] != conv.roles[0]:
             # Skip the first one if it is not from human
@@ -705,28 +939,28 @@ def preprocess_internlm(
             sentence['value'] = sentence['value'].strip()
             conv.append_message(role, sentence['value'])
         conversations.append(conv.get_prompt())
+        num_answers.append(sum(role == conv.roles[1] for role, _ in conv.messages))
 
     if not text_only:
-        new_conversations = []
-        for conversation in conversations:
-            for i in range(num_image):
-                image_tokens = f'{IMG_START_TOKEN}{IMG_CONTEXT_TOKEN * num_image_token_list[i]}{IMG_END_TOKEN}'
-                conversation = conversation.replace('<image>', image_tokens, 1)
-            new_conversations.append(conversation)
-        conversations = new_conversations
+        # One context marker per image; the image tokens are spliced into the ids once masked
+        conversations = [insert_image_placeholders(conversation, num_image) for conversation in conversations]
+
+    record_stage('template', ds_name, start)
+    start = stage_clock()
 
     # Tokenize conversations
-    input_ids = tokenizer(
-        conversations,
-        return_tensors='pt',
+    input_ids = tokenize_conversations(
+        conversations, tokenizer, template_name,
         padding=False if group_by_length or use_packed_ds else 'max_length',
-        max_length=tokenizer.model_max_length,
-        truncation=True,
-    ).input_ids
+    )
     targets = input_ids.clone()
 
-    for conversation, target in zip(conversations, targets):
+    boundaries = assistant_boundaries(tokenizer, template_name)
+    for conversation, target, answers in zip(conversations, targets, num_answers):
         total_len = int(target.ne(tokenizer.pad_token_id).sum())  # 浦语里面 pad_token_id = eos_token_id
+        truncated = total_len >= tokenizer.model_max_length
+        if boundaries and mask_assistant_spans(target, total_len, boundaries, answers, truncated):
+            continue
         cur_len = 1
         target[:cur_len] = IGNORE_TOKEN_ID  # <s>
         parts = conversation.split(conv.roles[1])  # [UNUSED_TOKEN_146]assistant\n
@@ -760,6 +994,9 @@ def preprocess_internlm(
                 print(f'WARNING: tokenization mismatch: {cur_len} vs. {total_len}. This dataset is {ds_name}.')
                 sys.stdout.flush()
 
+    if not text_only:
+        input_ids, targets = splice_image_spans(input_ids, targets, tokenizer, num_image_token_list, num_image)
+    record_stage('tokenize', ds_name, start)
     return dict(
         input_ids=input_ids,
         labels=targets,
@@ -767,36 +1004,11 @@ def preprocess_internlm(
     )
 
 
-def find_closest_aspect_ratio(aspect_ratio, target_ratios, width, height, image_size):
-    best_ratio_diff = float('inf')
-    best_ratio = (1, 1)
-    area = width * height
-    for ratio in target_ratios:
-        target_aspect_ratio = ratio[0] / ratio[1]
-        ratio_diff = abs(aspect_ratio - target_aspect_ratio)
-        if ratio_diff < best_ratio_diff:
-            best_ratio_diff = ratio_diff
-            best_ratio = ratio
-        elif ratio_diff == best_ratio_diff:
-            if area > 0.5 * image_size * image_size * ratio[0] * ratio[1]:
-                best_ratio = ratio
-    # print(f'width: {width}, height: {height}, best_ratio: {best_ratio}')
-    return best_ratio
-
-
 def dynamic_preprocess(image, min_num=1, max_num=6, image_size=448, use_thumbnail=False):
     orig_width, orig_height = image.size
-    aspect_ratio = orig_width / orig_height
-
-    # calculate the existing image aspect ratio
-    target_ratios = set(
-        (i, j) for n in range(min_num, max_num + 1) for i in range(1, n + 1) for j in range(1, n + 1) if
-        i * j <= max_num and i * j >= min_num)
-    target_ratios = sorted(target_ratios, key=lambda x: x[0] * x[1])
 
-    # find the closest aspect ratio to the target
-    target_aspect_ratio = find_closest_aspect_ratio(
-        aspect_ratio, target_ratios, orig_width, orig_height, image_size)
+    # find the closest aspect ratio to the target (the table of ratios is cached)
+    target_aspect_ratio = get_tile_grid(orig_width, orig_height, min_num, max_num, image_size)
 
     # calculate the target width and height
     target_width = image_size * target_aspect_ratio[0]
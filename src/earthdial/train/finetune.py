@@ -13,6 +13,7 @@ import sys
 import warnings  
 
 # Third-Party Library Imports
+import numpy as np
 import torch
 import torch.multiprocessing as mp
 import torch.distributed as dist
@@ -21,7 +22,6 @@ import transformers
 from transformers import ( 
     AutoConfig,
     AutoModelForCausalLM,
-    AutoTokenizer,
     HfArgumentParser,
     Trainer,
     TrainingArguments,
@@ -36,6 +36,7 @@ from transformers.utils.logging import (
 
 # Dataclass and Typing Imports
 from dataclasses import dataclass, field 
+from functools import partial
 from typing import Optional  
 
 # Environment Variable Setup
@@ -68,53 +69,36 @@ from earthdial.model.internvl_chat import (
 # Custom patches for the training pipeline
 from earthdial.patch import (  
     concat_pad_data_collator,
+    packed_data_collator,
     replace_llama_rmsnorm_with_fused_rmsnorm,
+    replace_train_dataloader,
     replace_train_sampler,
+    replace_with_packed_flash_attn,
 )
 # Model-specific constants
 from earthdial.train.constants import (  
-    BOX_END_TOKEN,
-    BOX_START_TOKEN,
     IMG_CONTEXT_TOKEN,
-    IMG_END_TOKEN,
-    IMG_START_TOKEN,
-    QUAD_END_TOKEN,
-    QUAD_START_TOKEN,
-    REF_END_TOKEN,
-    REF_START_TOKEN,
-    S2_RGB_10_TOKEN,
-    L8_RGB_30_TOKEN,
-    HIGH_RGB_05_TOKEN,
-    HIGH_RGB_05_TEMP_TOKEN,
-    S2_MS_10_TOKEN,
-    HIGH_RGBI_05,
-    S1_VH_10_TOKEN,
-    S1_VH_1_TOKEN,
-    TREECLASSIFY,
-    GROUNDING,
-    REFER,
-    CLASSIFY,
-    IDENTIFY,
-    CAPTION,
-    CHANGEDET,
-    UHI,
-    L8_MS_30,
-    HYPER_RGB_3,
-    S1_VH_TEMP_10,
-    MB_TOKEN_START,
-    MB_TOKEN_END,
+    SPECIAL_TOKENS,
 )
 from earthdial.train.dataset import (  # Dataset management utilities
     ConcatDataset,
     TCSLoader,
     WeightedConcatDataset,
 )
+from earthdial.train.length_index import estimate_vit_tile_cost
+from earthdial.patch.train_sampler_patch import MixtureSampler
+from earthdial.train.packed_dataset import PackedDataset
+from earthdial.train.data_state import DataStateCallback
+from earthdial.train.profiler import DataProfilerCallback, data_profiler_enabled, enable_data_profiler
+from earthdial.train.quarantine import SampleCounterCallback
+from earthdial.train.tokenizer import check_special_tokens, load_tokenizer
 from earthdial.train.trainer_monkey_patch import replace_create_optimizer  # Custom optimizer patch
 from dataloader import ShardDataLoader  # Shard-based data loading utility
 
 # Replace default behavior with custom patches
 replace_llama_rmsnorm_with_fused_rmsnorm()
 replace_train_sampler()
+replace_train_dataloader()
 
 # Logging Setup
 logger = logging.getLogger(__name__)
@@ -166,6 +150,27 @@ class ModelArguments:
         default=False,
         metadata={"help": "Set to True to freeze the MLP layers of the model."},
     )
+    use_fast_tokenizer: bool = field(
+        default=False,
+        metadata={
+            "help": "Set to True to use the fast tokenizer of the LLM, checked against the slow one with "
+            "src/tools/check_fast_tokenizer.py."
+        },
+    )
+    loss_chunk_size: int = field(
+        default=0,
+        metadata={
+            "help": "Compute the training loss over chunks of this many vocabulary rows, from the hidden states "
+            "of the supervised tokens only, instead of the full logits. 0 disables it."
+        },
+    )
+    vit_chunk_size: int = field(
+        default=0,
+        metadata={
+            "help": "Run the 3-band groups of multi-band images through the ViT in chunks of this many groups, "
+            "to bound its activation memory. 0 runs all the groups of a batch at once."
+        },
+    )
     unfreeze_vit_layers: int = field(
         default=0,
         metadata={
@@ -253,6 +258,10 @@ class DataTrainingArguments:
         default=False,
         metadata={"help": "Set to True to use data resampling."},
     )
+    data_resampling_temperature: Optional[float] = field(
+        default=2.0,
+        metadata={"help": "The temperature of data resampling. Default is 2, sampling datasets by the square root of their size."},
+    )
     dynamic_image_size: Optional[bool] = field(
         default=False,
         metadata={"help": "Set to True to use dynamic image size."},
@@ -273,6 +282,40 @@ class DataTrainingArguments:
         default="imagenet",
         metadata={"help": "The normalize type for the image. Default is imagenet."},
     )
+    use_packed_ds: Optional[bool] = field(
+        default=False,
+        metadata={"help": "Set to True to pack several samples into each training sequence."},
+    )
+    max_packed_tokens: Optional[int] = field(
+        default=None,
+        metadata={"help": "The token capacity of a packed sequence. Default is max_seq_length."},
+    )
+    max_batch_tokens: Optional[int] = field(
+        default=None,
+        metadata={"help": "Build batches under this budget of padded tokens instead of a fixed batch size."},
+    )
+    max_batch_tiles: Optional[int] = field(
+        default=None,
+        metadata={"help": "The budget of ViT tiles of a batch, used with max_batch_tokens."},
+    )
+    vit_tile_cost: Optional[float] = field(
+        default=None,
+        metadata={
+            "help": "The compute of a ViT tile in LLM tokens, with which group_by_length balances the ranks. "
+            "Default is estimated from the parameter counts; 0 balances the token lengths only."
+        },
+    )
+    pad_to_multiple_of: Optional[int] = field(
+        default=None,
+        metadata={"help": "Pad the batches to a multiple of this length, e.g. 8 or 64 for tensor cores."},
+    )
+    profile_data_pipeline: Optional[bool] = field(
+        default=False,
+        metadata={
+            "help": "Set to True to log the throughput and stage latencies of the data pipeline per dataset "
+            "(also enabled by EARTHDIAL_PROFILE_DATA=1)."
+        },
+    )
 
 
 def build_datasets(
@@ -285,11 +328,16 @@ def build_datasets(
     use_thumbnail=False,
     min_dynamic_patch=1,
     max_dynamic_patch=12,
-    normalize_type="imagenet"
+    normalize_type="imagenet",
+    use_packed_ds=False,
 ):
     datasets = []
-    lengths = []
+    repeat_times = []
     ds_collections = json.loads(open(data_args.meta_path).read())
+    vit_tile_cost = data_args.vit_tile_cost
+    if group_by_length and vit_tile_cost is None:
+        vit_tile_cost = estimate_vit_tile_cost(model)
+        logger.info(f"Balancing the ranks with a ViT tile cost of {vit_tile_cost:.1f} tokens")
    # logger.info(f"Reading JSON {data_args.meta_path} file")
     for ds_idx, ds_name in enumerate(ds_collections.keys()):
        # logger.info(f"Reading JSON ID {ds_idx} file")
@@ -310,7 +358,6 @@ def build_datasets(
         else:
             max_num = max_dynamic_patch
         dataset = ShardDataLoader(
-            model,
             logger,
             data_args.conv_style,
             ds_collections[ds_name],
@@ -322,6 +369,7 @@ def build_datasets(
             is_train=ds_collections[ds_name]["data_augment"],
             pad2square=data_args.pad2square,
             group_by_length=group_by_length,
+            use_packed_ds=use_packed_ds,
             dynamic_image_size=dynamic_image_size,
             use_thumbnail=use_thumbnail,
             min_dynamic_patch=min_dynamic_patch,
@@ -329,17 +377,16 @@ def build_datasets(
             repeat_time=repeat_time,
             normalize_type=normalize_type,
             random_seed=ds_idx,
+            vit_tile_cost=vit_tile_cost or 0.0,
             )
         datasets.append(dataset)
+        repeat_times.append(repeat_time)
         logger.info(f"Added dataset: {ds_name} with length: {len(dataset)}")
-        if data_args.use_data_resampling:
-            lengths.append(math.sqrt(len(dataset)))
-        else:
-            lengths.append(len(dataset))
-    if data_args.use_data_resampling:
-        total_length = sum(lengths)
-        weights = [l / total_length for l in lengths]
-        train_dataset = WeightedConcatDataset(datasets, weights)
+    if data_args.use_data_resampling or any(repeat_time != 1 for repeat_time in repeat_times):
+        # Drawn by MixtureSampler, whose plan is also grouped by length, budgeted or packed;
+        # resampling flattens the dataset sizes by the temperature
+        temperature = data_args.data_resampling_temperature if data_args.use_data_resampling else 1.0
+        train_dataset = WeightedConcatDataset(datasets, repeat_times=repeat_times, temperature=temperature)
     else:
         train_dataset = ConcatDataset(datasets)
     return train_dataset
@@ -417,40 +464,11 @@ def main():
     # Load pretrained model, tokenizer, and image processor
     tokenizer_path = model_args.model_name_or_path or model_args.llm_path
     logger.info(f"Loading Tokenizer: {tokenizer_path}")
-    tokenizer = AutoTokenizer.from_pretrained(
-        tokenizer_path, add_eos_token=False, trust_remote_code=True, use_fast=False
-    )
+    tokenizer = load_tokenizer(tokenizer_path, use_fast=model_args.use_fast_tokenizer, add_eos_token=False)
     tokenizer.tokenizer_path = tokenizer_path
     tokenizer.model_max_length = data_args.max_seq_length
-    token_list = [
-        IMG_START_TOKEN,
-        IMG_END_TOKEN,
-        IMG_CONTEXT_TOKEN,
-        QUAD_START_TOKEN,
-        QUAD_END_TOKEN,
-        REF_START_TOKEN,
-        REF_END_TOKEN,
-        BOX_START_TOKEN,
-        BOX_END_TOKEN,
-        BOX_START_TOKEN,
-        BOX_END_TOKEN,
-        S2_RGB_10_TOKEN,
-        L8_RGB_30_TOKEN,
-        S2_MS_10_TOKEN,
-        HIGH_RGB_05_TOKEN,
-        HIGH_RGB_05_TEMP_TOKEN,
-        HIGH_RGBI_05,
-        S1_VH_10_TOKEN,
-        S1_VH_1_TOKEN,
-        TREECLASSIFY,
-        GROUNDING,
-        REFER,
-        CLASSIFY,
-        IDENTIFY,
-        CAPTION,
-        CHANGEDET,UHI,L8_MS_30,HYPER_RGB_3,S1_VH_TEMP_10,MB_TOKEN_START,MB_TOKEN_END
-    ]
-    num_new_tokens = tokenizer.add_tokens(token_list, special_tokens=True)
+    num_new_tokens = tokenizer.add_tokens(SPECIAL_TOKENS, special_tokens=True)
+    check_special_tokens(tokenizer)
     img_context_token_id = tokenizer.convert_tokens_to_ids(IMG_CONTEXT_TOKEN)
     tcs_loader = TCSLoader("~/petreloss.conf") if has_tcs_loader else None
 
@@ -563,23 +581,62 @@ def main():
         model.language_model.config.vocab_size = len(tokenizer)
 
     model.language_model.config.use_cache = False
+    model.config.loss_chunk_size = model_args.loss_chunk_size
+    model.config.vit_chunk_size = model_args.vit_chunk_size
     model.vision_model.gradient_checkpointing = True
     model.vision_model.encoder.gradient_checkpointing = True
     if model_args.grad_checkpoint:
         model.language_model._set_gradient_checkpointing()
 
+    if data_args.profile_data_pipeline:
+        # Before the datasets register their names and the DataLoader workers fork
+        enable_data_profiler()
     train_dataset = build_datasets(
         data_args,
         tokenizer,
         tcs_loader,
         model,
-        group_by_length=training_args.group_by_length,
+        # Budgeted batches need the token lengths and unpadded samples, like length grouping
+        group_by_length=training_args.group_by_length or data_args.max_batch_tokens is not None,
         dynamic_image_size=data_args.dynamic_image_size,
         use_thumbnail=data_args.use_thumbnail,
         min_dynamic_patch=data_args.min_dynamic_patch,
         max_dynamic_patch=data_args.max_dynamic_patch,
         normalize_type=data_args.normalize_type,
-    )
+        use_packed_ds=data_args.use_packed_ds,
+    )
+    data_collator = partial(
+        concat_pad_data_collator,
+        pad_to_multiple_of=data_args.pad_to_multiple_of,
+        # Worker batches are already in shared memory; pin only in the main process
+        pin_memory=training_args.dataloader_pin_memory and training_args.dataloader_num_workers == 0,
+    )
+    if data_args.max_batch_tokens is not None:
+        if data_args.use_packed_ds:
+            raise ValueError("max_batch_tokens does not support use_packed_ds")
+        train_dataset.max_batch_tokens = data_args.max_batch_tokens
+        train_dataset.max_batch_tiles = data_args.max_batch_tiles
+    if data_args.use_packed_ds:
+        # Packs already have similar lengths: they are shuffled, not grouped by length
+        training_args.group_by_length = False
+        max_packed_tokens = data_args.max_packed_tokens or data_args.max_seq_length
+        order = None
+        if isinstance(train_dataset, WeightedConcatDataset):
+            # The packs are planned once, from the samples of the first epoch of the mixture
+            order = MixtureSampler(
+                [len(dataset) for dataset in train_dataset.datasets], train_dataset.num_samples, seed=training_args.seed
+            ).plan()
+        train_dataset = PackedDataset(
+            train_dataset,
+            np.concatenate([dataset.length for dataset in train_dataset.datasets]),
+            max_packed_tokens,
+            seed=training_args.seed,
+            modalities=train_dataset.modality_groups(),
+            order=order,
+        )
+        logger.info(f"Packed the training samples into {len(train_dataset)} sequences of at most {max_packed_tokens} tokens")
+        replace_with_packed_flash_attn()
+        data_collator = packed_data_collator
 
     def _freeze_params(module):
         for param in module.parameters():
@@ -637,8 +694,16 @@ def main():
             train_dataset=train_dataset if training_args.do_train else None,
             eval_dataset=None,
             tokenizer=tokenizer,
-            data_collator=concat_pad_data_collator,
+            data_collator=data_collator,
         )
+    # Shard dataset sample counters, added to the logs before the reporting callbacks run
+    trainer.callback_handler.callbacks.insert(0, SampleCounterCallback())
+    if data_profiler_enabled():
+        # Data pipeline throughput and stage latencies, added to the logs like the counters
+        trainer.callback_handler.callbacks.insert(0, DataProfilerCallback())
+    # Sampler position and sample counters, saved with every checkpoint
+    data_state = DataStateCallback()
+    trainer.add_callback(data_state)
 
     # Training
     if training_args.do_train:
@@ -647,6 +712,9 @@ def main():
             checkpoint = training_args.resume_from_checkpoint
         elif last_checkpoint is not None:
             checkpoint = last_checkpoint
+        if checkpoint is not None and data_state.load(checkpoint, trainer.args):
+            # The data is positioned at the checkpoint directly, without replaying the consumed batches
+            trainer.args.ignore_data_skip = True
         train_result = trainer.train(resume_from_checkpoint=checkpoint)
         trainer.save_model()  # Saves the tokenizer too for easy upload
 
@@ -661,5 +729,7 @@ def main():
         trainer.save_state()
 
 if __name__ == "__main__":
-    mp.set_start_method('spawn', force=True)
+    # The DataLoader workers fork: they hold no model or CUDA state, and share the data
+    # profiler histograms and sample counters of their rank
+    mp.set_start_method('fork', force=True)
     main()
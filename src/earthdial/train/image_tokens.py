@@ -0,0 +1,45 @@
+"""
+Image spans of tokenized conversations, spliced as token ids.
+
+A conversation is tokenized with every `<image>` replaced by `<img><IMG_CONTEXT></img>`, one
+context marker per image whatever its number of tiles, and the marker is then repeated to the
+image tokens of the image on the ids. The image tokens are special tokens, so the tokens around
+a span do not depend on its length: the spliced ids are those of the expanded string, without
+building and scanning a string of `num_image_token` markers per tile.
+"""
+
+import torch
+
+from .constants import IMG_CONTEXT_TOKEN, IMG_END_TOKEN, IMG_START_TOKEN
+
+IMAGE_PLACEHOLDER = IMG_START_TOKEN + IMG_CONTEXT_TOKEN + IMG_END_TOKEN
+
+
+def insert_image_placeholders(text, num_image, placeholder=IMAGE_PLACEHOLDER):
+    """Replace the first `num_image` `<image>` of `text` with an image span of one context marker."""
+    for _ in range(num_image):
+        text = text.replace("<image>", placeholder, 1)
+    return text
+
+
+def splice_image_tokens(input_ids, img_context_token_id, num_image_tokens, *aligned):
+    """
+    Repeat the `k`-th image context marker of `input_ids` `num_image_tokens[k]` times.
+
+    Args:
+        input_ids (torch.Tensor): 1-D token ids with one context marker per image.
+        img_context_token_id (int): Id of the image context token.
+        num_image_tokens (list): Image tokens of every image, in order. Markers beyond the list,
+            and images beyond the markers (a truncated sample), are left as they are.
+        *aligned (torch.Tensor): Tensors of the same length, e.g. the labels, repeated alike.
+
+    Returns:
+        list: The spliced `input_ids`, followed by the spliced `aligned` tensors.
+    """
+    markers = torch.nonzero(input_ids == img_context_token_id).flatten()
+    num_spliced = min(len(markers), len(num_image_tokens))
+    counts = torch.ones_like(input_ids)
+    counts[markers[:num_spliced]] = torch.as_tensor(
+        num_image_tokens[:num_spliced], dtype=counts.dtype, device=counts.device
+    )
+    return [tensor.repeat_interleave(counts) for tensor in (input_ids,) + aligned]
@@ -0,0 +1,322 @@
+"""
+Persistent per-sample indexes used by `group_by_length`: token lengths and ViT tiles.
+
+The lengths of an Arrow dataset saved with `save_to_disk` are computed once with a
+batched tokenizer running in a process pool, and stored as an int32 `.npy` sidecar
+next to the dataset directory. The sidecar name encodes the dataset fingerprint, the
+tokenizer and the image-token settings, so a stale index is never picked up. At
+startup the index is memory-mapped, which keeps multi-million-row datasets cheap to
+open on every rank.
+
+The tile index counts the dynamic-resolution tiles of the images of every sample,
+from the image headers only. With the token lengths it gives the cost of a sample
+that the length-grouped sampler balances between the ranks.
+"""
+
+import hashlib
+import io
+import json
+import logging
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import torch.distributed as dist
+from PIL import Image
+
+from .tiling import get_tile_grid
+
+LENGTH_INDEX_VERSION = 1
+LENGTH_INDEX_CHUNK_SIZE = 8192
+TILE_INDEX_CHUNK_SIZE = 1024
+# Encoded images are parsed from this prefix, which holds the header of common formats
+IMAGE_HEADER_BYTES = 1 << 16
+
+_worker_tokenizer = None
+
+
+def dataset_fingerprint(raw_data):
+    """Identify the content of `raw_data`: its fingerprint, or its cache files and their mtimes."""
+    fingerprint = getattr(raw_data, "_fingerprint", None)
+    if fingerprint is None:
+        fingerprint = [(f["filename"], os.path.getmtime(f["filename"])) for f in raw_data.cache_files]
+    return fingerprint
+
+
+def length_index_key(raw_data, tokenizer, conversations_key, ds_name, num_image_token,
+                     max_dynamic_patch, use_thumbnail):
+    """
+    Build the cache key of a length index.
+
+    Args:
+        raw_data (Dataset): The Arrow dataset returned by `load_from_disk`.
+        tokenizer (object): Tokenizer used to count tokens.
+        conversations_key (str): Column holding the JSON-encoded conversations.
+        ds_name (str): Name of the dataset (selects the conversation layout).
+        num_image_token (int): Number of tokens per image tile.
+        max_dynamic_patch (int): Maximum number of dynamic tiles.
+        use_thumbnail (bool): Whether a thumbnail tile is appended.
+
+    Returns:
+        str: A hex digest identifying the index.
+    """
+    key = {
+        "version": LENGTH_INDEX_VERSION,
+        "fingerprint": dataset_fingerprint(raw_data),
+        "num_rows": len(raw_data),
+        "conversations_key": conversations_key,
+        "naip": str(ds_name).strip().startswith("Naip"),
+        "tokenizer": [type(tokenizer).__name__, getattr(tokenizer, "name_or_path", ""), len(tokenizer)],
+        "num_image_token": num_image_token,
+        "max_dynamic_patch": max_dynamic_patch,
+        "use_thumbnail": bool(use_thumbnail),
+    }
+    return hashlib.sha1(json.dumps(key, sort_keys=True).encode()).hexdigest()[:16]
+
+
+def length_index_path(annotation, key):
+    """Return the sidecar path of the length index for the dataset directory `annotation`."""
+    return f"{os.path.normpath(annotation)}.lengths-{key}.npy"
+
+
+def _init_worker(tokenizer):
+    global _worker_tokenizer
+    _worker_tokenizer = tokenizer
+
+
+def _count_tokens(args):
+    """Tokenize a chunk of serialized conversations and return their lengths."""
+    rows, naip, image_tokens = args
+    lengths = np.zeros(len(rows), dtype=np.int64)
+    texts, text_rows = [], []
+    for idx, row in enumerate(rows):
+        data_item = json.loads(row)
+        if naip:
+            if "length" in data_item:
+                lengths[idx] = data_item["length"]
+                continue
+            data_item = data_item["conversations"]
+        texts.append("\n".join(temp["value"] for temp in data_item))
+        text_rows.append(idx)
+    if texts:
+        input_ids = _worker_tokenizer(texts, padding=False, truncation=False).input_ids
+        lengths[text_rows] = [len(ids) + image_tokens for ids in input_ids]
+    return lengths
+
+
+def build_token_lengths(raw_data, tokenizer, conversations_key, ds_name, num_image_token,
+                        max_dynamic_patch, use_thumbnail, num_proc=None):
+    """
+    Compute the token length of every sample of `raw_data`.
+
+    Each length counts the tokenized conversation plus the worst-case image tokens
+    `num_image_token * (max_dynamic_patch + use_thumbnail)`, except for rows that carry
+    a precomputed `length`.
+
+    Returns:
+        np.ndarray: int32 array of length `len(raw_data)`.
+    """
+    naip = str(ds_name).strip().startswith("Naip")
+    image_tokens = num_image_token * (max_dynamic_patch + int(use_thumbnail))
+    num_proc = num_proc or min(8, os.cpu_count() or 1)
+    # Only the conversation column is read, so no image is decoded
+    conversations = raw_data.select_columns([conversations_key])
+    chunks = (
+        (conversations[start:start + LENGTH_INDEX_CHUNK_SIZE][conversations_key], naip, image_tokens)
+        for start in range(0, len(conversations), LENGTH_INDEX_CHUNK_SIZE)
+    )
+    if num_proc > 1:
+        with ProcessPoolExecutor(num_proc, initializer=_init_worker, initargs=(tokenizer,)) as executor:
+            lengths = list(executor.map(_count_tokens, chunks))
+    else:
+        _init_worker(tokenizer)
+        lengths = [_count_tokens(chunk) for chunk in chunks]
+    if not lengths:
+        return np.zeros(0, dtype=np.int32)
+    return np.concatenate(lengths).astype(np.int32)
+
+
+def _load_or_build_index(raw_data, index_path, build, description, ds_name, logger):
+    """
+    Return the memory-mapped per-sample index at `index_path`, calling `build()` to create it.
+
+    Only the global rank 0 builds and writes the index; the other ranks wait on a barrier
+    and then map the same file. If the sidecar cannot be written (e.g. read-only storage),
+    every rank falls back to an in-memory index.
+    """
+    is_distributed = dist.is_available() and dist.is_initialized()
+    values = None
+
+    if (not is_distributed or dist.get_rank() == 0) and not os.path.exists(index_path):
+        start_time = time.time()
+        values = build()
+        logger.info(f"Built {description} index for {ds_name} ({len(values)} samples) "
+                    f"in {time.time() - start_time:.2f} seconds")
+        try:
+            tmp_path = f"{index_path}.{os.getpid()}.tmp"
+            with open(tmp_path, "wb") as f:
+                np.save(f, values)
+            os.replace(tmp_path, index_path)
+            logger.info(f"Saved {description} index: {index_path}")
+        except OSError as e:
+            logger.warning(f"Could not write {description} index {index_path}: {e}")
+    if is_distributed:
+        # The other ranks map the index written by rank 0
+        dist.barrier()
+
+    if os.path.exists(index_path):
+        index = np.load(index_path, mmap_mode="r")
+        if len(index) == len(raw_data):
+            return index
+        logger.warning(f"The {description} index {index_path} does not match {ds_name}, rebuilding in memory")
+    if values is None:
+        values = build()
+    return values
+
+
+def load_or_build_token_lengths(raw_data, annotation, tokenizer, conversations_key, ds_name,
+                                num_image_token, max_dynamic_patch, use_thumbnail, logger=None,
+                                num_proc=None):
+    """
+    Return the memory-mapped token lengths of `raw_data`, building the sidecar index if needed.
+
+    Returns:
+        np.ndarray: int32 lengths, memory-mapped when the sidecar exists.
+    """
+    logger = logger or logging.getLogger(__name__)
+    key = length_index_key(raw_data, tokenizer, conversations_key, ds_name, num_image_token,
+                           max_dynamic_patch, use_thumbnail)
+    return _load_or_build_index(
+        raw_data,
+        length_index_path(annotation, key),
+        lambda: build_token_lengths(raw_data, tokenizer, conversations_key, ds_name, num_image_token,
+                                    max_dynamic_patch, use_thumbnail, num_proc=num_proc),
+        "token length",
+        ds_name,
+        logger,
+    )
+
+
+def image_columns(raw_data, columns):
+    """Return the columns of `columns` that hold encoded images (`Image` features) in `raw_data`."""
+    schema = raw_data.data.schema
+    return [
+        column for column in columns
+        if pa.types.is_struct(schema.field(column).type)
+        and schema.field(column).type.get_field_index("bytes") >= 0
+    ]
+
+
+def _image_size(header, path, read_bytes):
+    """Read the `(width, height)` of an encoded image from its header, without decoding it."""
+    if header is None:
+        with Image.open(path) as img:
+            return img.size
+    try:
+        with Image.open(io.BytesIO(header)) as img:
+            return img.size
+    except Exception:
+        # The size is not in the first bytes (e.g. a TIFF with its directory at the end)
+        with Image.open(io.BytesIO(read_bytes())) as img:
+            return img.size
+
+
+def build_vit_tiles(raw_data, columns, min_dynamic_patch, max_dynamic_patch, image_size, use_thumbnail):
+    """
+    Count the dynamic-resolution tiles of the images of every sample of `raw_data`.
+
+    Only the image headers are read. Every image of `columns` is tiled like `dynamic_preprocess`,
+    with a thumbnail tile when it is cut into several tiles and `use_thumbnail` is set.
+
+    Returns:
+        np.ndarray: int32 array of length `len(raw_data)`.
+    """
+    images = raw_data.select_columns(columns).with_format("arrow")
+    tiles = np.zeros(len(images), dtype=np.int32)
+    for start in range(0, len(images), TILE_INDEX_CHUNK_SIZE):
+        table = images[start:start + TILE_INDEX_CHUNK_SIZE]
+        for column in columns:
+            values = table.column(column).combine_chunks()
+            # Only a prefix of every encoded image leaves the Arrow buffer
+            headers = pc.binary_slice(values.field("bytes"), 0, IMAGE_HEADER_BYTES).to_pylist()
+            paths = values.field("path").to_pylist()
+            for row, (header, path) in enumerate(zip(headers, paths)):
+                width, height = _image_size(header, path, values.field("bytes")[row].as_py)
+                cols, rows = get_tile_grid(width, height, min_dynamic_patch, max_dynamic_patch, image_size)
+                tiles[start + row] += cols * rows + int(use_thumbnail and cols * rows != 1)
+    return tiles
+
+
+def sample_vit_tiles(raw_data, image_key, ds_name, dynamic_image_size, max_dynamic_patch, count_tiles):
+    """
+    Count the tiles of every sample of `raw_data`, as the shard dataset tiles its images.
+
+    The dynamic-resolution tiles of the `Image` columns are counted by
+    `count_tiles(columns, max_dynamic_patch)`, e.g. with `build_vit_tiles`; band arrays and
+    images without dynamic resolution are a single tile. A multi-image sample shares
+    `max_dynamic_patch` between its images.
+
+    Returns:
+        np.ndarray: int32 array of length `len(raw_data)`.
+    """
+    image_keys = image_key.split(",")
+    multi_image = str(ds_name).strip().startswith("Change")
+    num_images = len(image_keys) if multi_image else 1
+    dynamic_keys = []
+    if dynamic_image_size and (multi_image or image_key != "tif_ms"):
+        dynamic_keys = image_columns(raw_data, image_keys if multi_image else [image_key])
+    tiles = np.full(len(raw_data), num_images - len(dynamic_keys), dtype=np.int32)
+    if dynamic_keys:
+        tiles += count_tiles(dynamic_keys, max(1, max_dynamic_patch // num_images))
+    return tiles
+
+
+def load_or_build_vit_tiles(raw_data, annotation, columns, min_dynamic_patch, max_dynamic_patch,
+                            image_size, use_thumbnail, ds_name, logger=None):
+    """
+    Return the memory-mapped tile counts of `raw_data`, building the sidecar index if needed.
+
+    The sidecar is stored next to the token length index, under a key of the dataset
+    fingerprint and the tiling settings.
+
+    Returns:
+        np.ndarray: int32 tile counts, memory-mapped when the sidecar exists.
+    """
+    logger = logger or logging.getLogger(__name__)
+    key = {
+        "version": LENGTH_INDEX_VERSION,
+        "fingerprint": dataset_fingerprint(raw_data),
+        "num_rows": len(raw_data),
+        "columns": list(columns),
+        "min_dynamic_patch": min_dynamic_patch,
+        "max_dynamic_patch": max_dynamic_patch,
+        "image_size": image_size,
+        "use_thumbnail": bool(use_thumbnail),
+    }
+    key = hashlib.sha1(json.dumps(key, sort_keys=True).encode()).hexdigest()[:16]
+    return _load_or_build_index(
+        raw_data,
+        f"{os.path.normpath(annotation)}.tiles-{key}.npy",
+        lambda: build_vit_tiles(raw_data, columns, min_dynamic_patch, max_dynamic_patch, image_size, use_thumbnail),
+        "ViT tile",
+        ds_name,
+        logger,
+    )
+
+
+def estimate_vit_tile_cost(model):
+    """
+    Estimate the compute of one ViT tile in LLM tokens, from the parameter counts.
+
+    A forward pass costs about two FLOPs per parameter and token, so a tile of
+    `(image_size / patch_size) ** 2 + 1` patches costs that many ViT tokens.
+    """
+    vision_config = model.config.vision_config
+    num_patches = (vision_config.image_size // vision_config.patch_size) ** 2 + 1
+    # ZeRO-3 partitions the parameters; `ds_numel` keeps their full size
+    vit_params = sum(getattr(p, "ds_numel", p.numel()) for p in model.vision_model.parameters())
+    llm_params = sum(getattr(p, "ds_numel", p.numel()) for p in model.language_model.parameters())
+    return vit_params * num_patches / llm_params
@@ -0,0 +1,148 @@
+"""
+Packed supervised fine-tuning samples.
+
+Several samples, with their image tiles, are concatenated into one sequence of at
+most `max_packed_tokens` tokens. The packs are planned once, from the token-length
+index of the datasets: samples are shuffled, and each window of samples is bin-packed
+best-fit decreasing, one modality group at a time. The sampler then shuffles the packs
+like ordinary samples.
+
+A packed batch is a single row. Its attention mask is the `cu_seqlens` of its samples
+and its position ids restart at every sample, so with `replace_with_packed_flash_attn`
+each sample attends only to itself.
+"""
+
+import bisect
+
+import numpy as np
+import torch
+from torch.utils.data import Dataset
+
+from .dataset import IGNORE_TOKEN_ID
+
+PACK_WINDOW = 4096
+
+
+def best_fit_decreasing(indices, lengths, max_packed_tokens):
+    """Bin-pack `indices` best-fit decreasing and return the list of packs."""
+    # `spaces` is kept sorted to find the tightest open pack
+    indices = indices[np.argsort(-lengths[indices], kind="stable")]
+    spaces, bins = [], []
+    for index in indices.tolist():
+        length = min(int(lengths[index]), max_packed_tokens)
+        k = bisect.bisect_left(spaces, length)
+        if k == len(spaces):
+            members = [index]
+            space = max_packed_tokens - length
+        else:
+            space, members = spaces.pop(k) - length, bins.pop(k)
+            members.append(index)
+        k = bisect.bisect_left(spaces, space)
+        spaces.insert(k, space)
+        bins.insert(k, members)
+    return [np.asarray(members, dtype=np.int64) for members in bins]
+
+
+def plan_packs(lengths, max_packed_tokens, seed=0, window=PACK_WINDOW, modalities=None, order=None):
+    """
+    Group samples into packs of at most `max_packed_tokens` estimated tokens.
+
+    Args:
+        lengths (np.ndarray): Estimated token length of every sample.
+        max_packed_tokens (int): Token capacity of a pack. Longer samples get a pack of their own.
+        seed (int): Seed of the sample shuffle.
+        window (int): Number of shuffled samples packed together.
+        modalities (np.ndarray, optional): Modality group of every sample; a pack holds one group.
+        order (np.ndarray, optional): The samples to pack, in order, e.g. the plan of a
+            `MixtureSampler`; a seeded permutation of all the samples by default.
+
+    Returns:
+        list: One int64 array of sample indices per pack.
+    """
+    lengths = np.asarray(lengths, dtype=np.int64)
+    if order is None:
+        order = np.random.default_rng(seed).permutation(len(lengths))
+    packs = []
+    for start in range(0, len(order), window):
+        indices = order[start:start + window]
+        if modalities is None:
+            packs.extend(best_fit_decreasing(indices, lengths, max_packed_tokens))
+            continue
+        groups = modalities[indices]
+        for group in np.unique(groups).tolist():
+            packs.extend(best_fit_decreasing(indices[groups == group], lengths, max_packed_tokens))
+    return packs
+
+
+def pack_samples(samples):
+    """
+    Concatenate samples into one packed sample.
+
+    The first label of every sample is ignored, so that no token is predicted across a
+    sample boundary. The position ids restart at 0 at every sample; `packed_data_collator`
+    finds the sample boundaries from them, as `position_ids` is an argument of the model's
+    `forward` and is kept by the Trainer when it removes the unused columns.
+    """
+    input_ids = torch.cat([sample["input_ids"] for sample in samples])
+    labels = torch.cat([sample["labels"] for sample in samples])
+    sample_lengths = [sample["input_ids"].size(0) for sample in samples]
+    starts = np.cumsum([0] + sample_lengths[:-1])
+    labels[torch.from_numpy(starts)] = IGNORE_TOKEN_ID
+    position_ids = torch.cat([torch.arange(length, dtype=torch.long) for length in sample_lengths])
+    return dict(
+        input_ids=input_ids,
+        labels=labels,
+        position_ids=position_ids,
+        pixel_values=torch.cat([sample["pixel_values"] for sample in samples]),
+        image_flags=torch.cat([sample["image_flags"] for sample in samples]),
+        image_modality=torch.cat([sample["image_modality"] for sample in samples]),
+    )
+
+
+class PackedDataset(Dataset):
+    """
+    Dataset of packed samples over a map-style dataset.
+
+    Args:
+        dataset (Dataset): The samples to pack, e.g. a `ConcatDataset` of shard datasets.
+        lengths (np.ndarray): Estimated token length of every sample of `dataset`.
+        max_packed_tokens (int): Token capacity of a pack.
+        seed (int): Seed of the pack plan, identical on every rank.
+        modalities (np.ndarray, optional): Modality group of every sample, so that the samples
+            of a pack share their ViT path.
+        order (np.ndarray, optional): The samples to pack, e.g. the plan of a `MixtureSampler`, which
+            may repeat or leave out samples; all the samples by default.
+    """
+
+    def __init__(self, dataset, lengths, max_packed_tokens, seed=0, modalities=None, order=None):
+        super().__init__()
+        if len(lengths) != len(dataset):
+            raise ValueError(f"Got {len(lengths)} lengths for {len(dataset)} samples")
+        self.dataset = dataset
+        self.max_packed_tokens = max_packed_tokens
+        self.packs = plan_packs(lengths, max_packed_tokens, seed=seed, modalities=modalities, order=order)
+        self.pack_modalities = None if modalities is None else modalities[[pack[0] for pack in self.packs]]
+
+    def __len__(self):
+        return len(self.packs)
+
+    def modality_groups(self):
+        """Return the modality group of every pack, or None without modality groups."""
+        return self.pack_modalities
+
+    def __getitem__(self, i):
+        return self.__getitems__([i])[0]
+
+    def __getitems__(self, indices):
+        # The samples of all the packs of the batch are read in one batched call
+        members = [self.packs[i].tolist() for i in indices]
+        flat = [index for pack in members for index in pack]
+        if hasattr(self.dataset, "__getitems__"):
+            samples = self.dataset.__getitems__(flat)
+        else:
+            samples = [self.dataset[index] for index in flat]
+        packed, start = [], 0
+        for pack in members:
+            packed.append(pack_samples(samples[start:start + len(pack)]))
+            start += len(pack)
+        return packed
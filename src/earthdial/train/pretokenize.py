@@ -0,0 +1,184 @@
+"""
+Pre-tokenized conversations of the Arrow shard datasets.
+
+`src/tools/pretokenize_shards.py` tokenizes the conversations of a shard once and writes
+them back as `input_ids` and `labels` columns, with the `num_tiles` of every sample. Image
+spans are kept with one `<IMG_CONTEXT>` marker per image, which `preprocess_*` tokenizes anyway
+(see `image_tokens`), and are spliced to `num_image_token` tokens per actual tile when the
+sample is loaded, so the expanded sample is the one that `preprocess_*` would return.
+
+The settings the columns were built with are stored in `pretokenized.json` in the dataset
+directory. A shard built for another tokenizer or template is tokenized online as before.
+"""
+
+import json
+import os
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+from .constants import IMG_CONTEXT_TOKEN
+from .dataset import IGNORE_TOKEN_ID, preprocess, preprocess_internlm, preprocess_mpt, preprocess_phi3
+from .image_tokens import splice_image_tokens
+
+PRETOKENIZED_VERSION = 1
+PRETOKENIZED_NAME = "pretokenized.json"
+PRETOKENIZED_COLUMNS = ("input_ids", "labels")
+
+
+def get_preprocess_function(template_name):
+    """Return the `preprocess_*` function of the conversation template `template_name`."""
+    if template_name == "Hermes-2":
+        return preprocess_mpt
+    if template_name == "internlm2-chat":
+        return preprocess_internlm
+    if template_name == "phi3-chat":
+        return preprocess_phi3
+    return preprocess
+
+
+def tokenizer_identity(tokenizer):
+    """Identify a tokenizer and its added special tokens."""
+    return [type(tokenizer).__name__, getattr(tokenizer, "name_or_path", ""), len(tokenizer)]
+
+
+def pretokenized_settings(tokenizer, template_name, conversations_key):
+    """The settings that the pre-tokenized columns of a shard depend on."""
+    return {
+        "version": PRETOKENIZED_VERSION,
+        "template_name": template_name,
+        "tokenizer": tokenizer_identity(tokenizer),
+        "conversations_key": conversations_key,
+    }
+
+
+def load_pretokenized_settings(annotation, raw_data, tokenizer, template_name, conversations_key, logger):
+    """
+    Return the build settings of the pre-tokenized columns of a shard, or None.
+
+    None is returned when the shard has no such columns, or when they were built for
+    another tokenizer, template or conversation column; the latter is logged.
+    """
+    path = os.path.join(annotation, PRETOKENIZED_NAME)
+    if not os.path.exists(path) or not set(PRETOKENIZED_COLUMNS) <= set(raw_data.column_names):
+        return None
+    with open(path) as f:
+        settings = json.load(f)
+    expected = pretokenized_settings(tokenizer, template_name, conversations_key)
+    changed = [name for name, value in expected.items() if settings.get(name) != value]
+    if changed:
+        logger.warning(f"The pre-tokenized columns of {annotation} were built with another "
+                       f"{', '.join(changed)}, tokenizing online")
+        return None
+    return settings
+
+
+def conversation_source(conversations, ds_name, multi_image):
+    """
+    Return the turns of a JSON-encoded conversation, laid out as the shard dataset reads them.
+
+    Single-image samples get the `<image>` placeholder that `multi_modal_get_item` adds.
+    """
+    source = json.loads(conversations)
+    if str(ds_name).strip().startswith("Naip"):
+        source = source["conversations"]
+    if not source:
+        return source
+    if not multi_image and "<image>" not in source[0]["value"]:
+        source[0]["value"] = "<image>\n" + source[0]["value"]
+    return source
+
+
+def tokenize_conversations(rows, tokenizer, template_name, ds_name, num_image):
+    """
+    Tokenize serialized conversations with one image context marker per image.
+
+    Args:
+        rows (list): JSON-encoded conversations.
+        tokenizer (object): The training tokenizer, with the image tokens added.
+        template_name (str): Conversation template.
+        ds_name (str): Name of the dataset (selects the conversation layout).
+        num_image (int): Images of a sample; 1 except for multi-image datasets.
+
+    Returns:
+        dict: int32 `input_ids` and `labels` arrays per row; empty for an empty conversation.
+    """
+    preprocess_function = get_preprocess_function(template_name)
+    multi_image = str(ds_name).strip().startswith("Change")
+    input_ids, labels = [], []
+    for row in rows:
+        source = conversation_source(row, ds_name, multi_image)
+        if not source:
+            input_ids.append(np.zeros(0, dtype=np.int32))
+            labels.append(np.zeros(0, dtype=np.int32))
+            continue
+        ret = preprocess_function(
+            template_name,
+            [source],
+            tokenizer,
+            [1] * num_image,
+            group_by_length=True,
+            ds_name=ds_name,
+            num_image=num_image,
+        )
+        input_ids.append(ret["input_ids"][0].numpy().astype(np.int32))
+        labels.append(ret["labels"][0].numpy().astype(np.int32))
+    return {"input_ids": input_ids, "labels": labels}
+
+
+def read_token_rows(token_records, indices):
+    """
+    Read the pre-tokenized columns of the rows `indices` as zero-copy numpy views.
+
+    Args:
+        token_records (Dataset): Dataset projected on `input_ids` and `labels`, with format "arrow".
+        indices (int | list): A row index or a list of row indices.
+
+    Returns:
+        dict | list: For an int, a dict of int32 arrays; for a list, one dict per row.
+    """
+    table = token_records[indices]
+    rows = [{} for _ in range(table.num_rows)]
+    for name in PRETOKENIZED_COLUMNS:
+        column = table.column(name).combine_chunks()
+        # The offsets of a sliced list array index its unsliced values
+        values, offsets = column.values.to_numpy(), column.offsets.to_numpy()
+        for row, start, stop in zip(rows, offsets[:-1], offsets[1:]):
+            row[name] = values[start:stop]
+    return rows[0] if isinstance(indices, int) else rows
+
+
+def expand_image_spans(input_ids, labels, tokenizer, num_image_tokens, pad_to_max_length=False):
+    """
+    Expand the image context markers of a pre-tokenized sample into its image tokens.
+
+    Args:
+        input_ids (np.ndarray): Pre-tokenized ids, with one `<IMG_CONTEXT>` marker per image.
+        labels (np.ndarray): Pre-tokenized labels of the same length.
+        tokenizer (object): The training tokenizer.
+        num_image_tokens (list): Image tokens of every image, in order.
+        pad_to_max_length (bool): Pad to `tokenizer.model_max_length`, like `preprocess_*`
+            without `group_by_length` or packing.
+
+    Returns:
+        dict: `input_ids`, `labels` and `attention_mask` tensors, as returned by `preprocess_*`
+            for one sample.
+    """
+    input_ids, labels = splice_image_tokens(
+        torch.from_numpy(input_ids.astype(np.int64)),
+        tokenizer.convert_tokens_to_ids(IMG_CONTEXT_TOKEN),
+        num_image_tokens,
+        torch.from_numpy(labels.astype(np.int64)),
+    )
+    max_length = tokenizer.model_max_length
+    input_ids, labels = input_ids[:max_length], labels[:max_length]
+    if pad_to_max_length and len(input_ids) < max_length:
+        padding = max_length - len(input_ids)
+        input_ids = F.pad(input_ids, (0, padding), value=tokenizer.pad_token_id)
+        labels = F.pad(labels, (0, padding), value=IGNORE_TOKEN_ID)
+    return dict(
+        input_ids=input_ids,
+        labels=labels,
+        attention_mask=input_ids.ne(tokenizer.pad_token_id),
+    )
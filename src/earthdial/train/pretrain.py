@@ -22,6 +22,7 @@ import gc
 os.environ['MALLOC_TRIM_THRESHOLD_'] = '0'
 import time
 from dataclasses import dataclass, field
+from functools import partial
 from typing import Dict, Optional
 from copy import deepcopy
 
@@ -47,6 +48,7 @@ from earthdial.model.internvl_chat import (
 from earthdial.patch import (
     concat_pad_data_collator,
     replace_llama_rmsnorm_with_fused_rmsnorm,
+    replace_train_dataloader,
     replace_train_sampler,
 )
 from earthdial.train.constants import (
@@ -86,12 +88,16 @@ from earthdial.train.dataset import (
     preprocess_mpt,
     preprocess_phi3,
 )
+from earthdial.train.data_state import DataStateCallback
+from earthdial.train.profiler import DataProfilerCallback, data_profiler_enabled, enable_data_profiler
+from earthdial.train.quarantine import SampleCounterCallback
+from earthdial.train.shard_stream import WeightedStreamDataset
+from earthdial.train.tokenizer import check_special_tokens, load_tokenizer
 from earthdial.train.trainer_monkey_patch import replace_create_optimizer
 from torch.utils.data import Dataset
 from transformers import (
     AutoConfig,
     AutoModelForCausalLM,
-    AutoTokenizer,
     HfArgumentParser,
     Trainer,
     TrainingArguments,
@@ -107,6 +113,7 @@ from transformers.utils.logging import (
 # Apply necessary patches for the transformers library
 replace_llama_rmsnorm_with_fused_rmsnorm()
 replace_train_sampler()
+replace_train_dataloader()
 
 has_tcs_loader = False
 
@@ -118,11 +125,10 @@ from huggingface_hub import snapshot_download
 
 #from dataloader_pretrain import ShardDataLoader
 
-from dataloader_pretrain import ShardDataLoader_pretrain
+from dataloader_pretrain import ShardDataLoader_pretrain, ShardStreamDataset_pretrain
 import json
 import math
 import concurrent.futures
-from torch.utils.data import ConcatDataset
 from concurrent.futures import ThreadPoolExecutor
 
 
@@ -168,6 +174,27 @@ class ModelArguments:
         default=False,
         metadata={"help": "Set to True to freeze the MLP layers of the model."},
     )
+    use_fast_tokenizer: bool = field(
+        default=False,
+        metadata={
+            "help": "Set to True to use the fast tokenizer of the LLM, checked against the slow one with "
+            "src/tools/check_fast_tokenizer.py."
+        },
+    )
+    loss_chunk_size: int = field(
+        default=0,
+        metadata={
+            "help": "Compute the training loss over chunks of this many vocabulary rows, from the hidden states "
+            "of the supervised tokens only, instead of the full logits. 0 disables it."
+        },
+    )
+    vit_chunk_size: int = field(
+        default=0,
+        metadata={
+            "help": "Run the 3-band groups of multi-band images through the ViT in chunks of this many groups, "
+            "to bound its activation memory. 0 runs all the groups of a batch at once."
+        },
+    )
     unfreeze_vit_layers: int = field(
         default=0,
         metadata={
@@ -255,6 +282,10 @@ class DataTrainingArguments:
         default=False,
         metadata={"help": "Set to True to use data resampling."},
     )
+    data_resampling_temperature: Optional[float] = field(
+        default=2.0,
+        metadata={"help": "The temperature of data resampling. Default is 2, sampling datasets by the square root of their size."},
+    )
     dynamic_image_size: Optional[bool] = field(
         default=False,
         metadata={"help": "Set to True to use dynamic image size."},
@@ -275,6 +306,17 @@ class DataTrainingArguments:
         default="imagenet",
         metadata={"help": "The normalize type for the image. Default is imagenet."},
     )
+    pad_to_multiple_of: Optional[int] = field(
+        default=None,
+        metadata={"help": "Pad the batches to a multiple of this length, e.g. 8 or 64 for tensor cores."},
+    )
+    profile_data_pipeline: Optional[bool] = field(
+        default=False,
+        metadata={
+            "help": "Set to True to log the throughput and stage latencies of the data pipeline per dataset "
+            "(also enabled by EARTHDIAL_PROFILE_DATA=1)."
+        },
+    )
 
 def build_datasets(
     data_args,
@@ -290,6 +332,7 @@ def build_datasets(
 ):
     datasets = []
     lengths = []
+    repeat_times = []
     ds_collections = json.loads(open(data_args.meta_path).read())
    # logger.info(f"Reading JSON {data_args.meta_path} file")
     for ds_idx, ds_name in enumerate(ds_collections.keys()):
@@ -310,8 +353,13 @@ def build_datasets(
             )
         else:
             max_num = max_dynamic_patch
-        dataset = ShardDataLoader_pretrain(
-            model,
+        # "streaming": true reads the dataset as a stream instead of a rank slice
+        dataset_class = (
+            ShardStreamDataset_pretrain
+            if ds_collections[ds_name].get("streaming", False)
+            else ShardDataLoader_pretrain
+        )
+        dataset = dataset_class(
             logger,
             data_args.conv_style,
             ds_collections[ds_name],
@@ -332,15 +380,26 @@ def build_datasets(
             random_seed=ds_idx,
             )
         datasets.append(dataset)
-        logger.info(f"Added dataset: {ds_name} with length: {len(dataset)}")
+        repeat_times.append(repeat_time)
+        # Streams have no length; they are weighted by their number of rows
+        dataset_length = dataset.num_rows if isinstance(dataset, ShardStreamDataset_pretrain) else len(dataset)
+        logger.info(f"Added dataset: {ds_name} with length: {dataset_length}")
         if data_args.use_data_resampling:
-            lengths.append(math.sqrt(len(dataset)))
+            lengths.append(math.sqrt(dataset_length))
         else:
-            lengths.append(len(dataset))
-    if data_args.use_data_resampling:
+            lengths.append(dataset_length)
+    streaming = [isinstance(dataset, ShardStreamDataset_pretrain) for dataset in datasets]
+    if any(streaming):
+        if not all(streaming):
+            raise ValueError("Streaming datasets cannot be mixed with random-access datasets in one meta file")
         total_length = sum(lengths)
         weights = [l / total_length for l in lengths]
-        train_dataset = WeightedConcatDataset(datasets, weights)
+        train_dataset = WeightedStreamDataset(datasets, weights)
+    elif data_args.use_data_resampling or any(repeat_time != 1 for repeat_time in repeat_times):
+        # Drawn by MixtureSampler, whose plan is also grouped by length;
+        # resampling flattens the dataset sizes by the temperature
+        temperature = data_args.data_resampling_temperature if data_args.use_data_resampling else 1.0
+        train_dataset = WeightedConcatDataset(datasets, repeat_times=repeat_times, temperature=temperature)
     else:
         train_dataset = ConcatDataset(datasets)
     return train_dataset
@@ -593,9 +652,7 @@ def main():
     #         except Exception as e:
     #             print(f"Failed to delete {item_path}. Reason: {e}")
     logger.info(f"Loading Tokenizer: {tokenizer_path}")
-    tokenizer = AutoTokenizer.from_pretrained(
-        tokenizer_path, add_eos_token=False, trust_remote_code=True, use_fast=False
-    )
+    tokenizer = load_tokenizer(tokenizer_path, use_fast=model_args.use_fast_tokenizer, add_eos_token=False)
     tokenizer.tokenizer_path = tokenizer_path
     tokenizer.model_max_length = data_args.max_seq_length
     token_list = [
@@ -627,6 +684,7 @@ def main():
         CHANGEDET,
     ]
     num_new_tokens = tokenizer.add_tokens(token_list, special_tokens=True)
+    check_special_tokens(tokenizer)
     img_context_token_id = tokenizer.convert_tokens_to_ids(IMG_CONTEXT_TOKEN)
     tcs_loader = TCSLoader("~/petreloss.conf") if has_tcs_loader else None
 
@@ -739,6 +797,8 @@ def main():
         model.language_model.config.vocab_size = len(tokenizer)
 
     model.language_model.config.use_cache = False
+    model.config.loss_chunk_size = model_args.loss_chunk_size
+    model.config.vit_chunk_size = model_args.vit_chunk_size
     model.vision_model.gradient_checkpointing = True
     model.vision_model.encoder.gradient_checkpointing = True
     if model_args.grad_checkpoint:
@@ -756,6 +816,9 @@ def main():
     #     max_dynamic_patch=data_args.max_dynamic_patch,
     #     normalize_type=data_args.normalize_type
     # )
+    if data_args.profile_data_pipeline:
+        # Before the datasets register their names and the DataLoader workers fork
+        enable_data_profiler()
     train_dataset = build_datasets(
         data_args,
         tokenizer,
@@ -841,8 +904,21 @@ def main():
             train_dataset=train_dataset if training_args.do_train else None,
             eval_dataset=None,
             tokenizer=tokenizer,
-            data_collator=concat_pad_data_collator,
+            data_collator=partial(
+                concat_pad_data_collator,
+                pad_to_multiple_of=data_args.pad_to_multiple_of,
+                # Worker batches are already in shared memory; pin only in the main process
+                pin_memory=training_args.dataloader_pin_memory and training_args.dataloader_num_workers == 0,
+            ),
         )
+    # Shard dataset sample counters, added to the logs before the reporting callbacks run
+    trainer.callback_handler.callbacks.insert(0, SampleCounterCallback())
+    if data_profiler_enabled():
+        # Data pipeline throughput and stage latencies, added to the logs like the counters
+        trainer.callback_handler.callbacks.insert(0, DataProfilerCallback())
+    # Sampler position and sample counters, saved with every checkpoint
+    data_state = DataStateCallback()
+    trainer.add_callback(data_state)
 
     # Training
     if training_args.do_train:
@@ -851,6 +927,10 @@ def main():
             checkpoint = training_args.resume_from_checkpoint
         elif last_checkpoint is not None:
             checkpoint = last_checkpoint
+        stream = isinstance(train_dataset, WeightedStreamDataset)
+        if checkpoint is not None and data_state.load(checkpoint, trainer.args, stream=stream):
+            # The data is positioned at the checkpoint directly, without replaying the consumed batches
+            trainer.args.ignore_data_skip = True
         train_result = trainer.train(resume_from_checkpoint=checkpoint)
         trainer.save_model()  # Saves the tokenizer too for easy upload
 
@@ -868,7 +948,9 @@ def main():
 
 if __name__ == "__main__":
     import torch.multiprocessing as mp
-    mp.set_start_method('spawn', force=True)
+    # The DataLoader workers fork: they hold no model or CUDA state, and share the data
+    # profiler histograms and sample counters of their rank
+    mp.set_start_method('fork', force=True)
     main()
 
 # # --------------------------------------------------------
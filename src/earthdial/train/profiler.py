@@ -0,0 +1,213 @@
+"""
+Per-stage profiler of the training data pipeline.
+
+Every stage of a sample (row fetch, image decode, tiling, transforms, template, tokenization),
+the collation of a batch and the band-group ViT pass are timed per dataset name. A duration
+falls into a log-spaced histogram bin, kept in a process-local buffer and added every second
+to histograms in shared memory, which the forked DataLoader workers of a rank share.
+`DataProfilerCallback` all-reduces the histograms of the logging window across the ranks
+and adds the samples per second and the p50/p95 of every stage to the training logs.
+
+The profiler is off unless `EARTHDIAL_PROFILE_DATA=1` or `enable_data_profiler()` is called
+before the datasets are built; a disabled stage costs a global lookup.
+"""
+
+import math
+import multiprocessing
+import os
+import time
+from contextlib import nullcontext
+
+import numpy as np
+import torch
+import torch.distributed as dist
+from torch.utils.data import get_worker_info
+from transformers import TrainerCallback
+
+DATA_STAGES = ("fetch", "decode", "tile", "transform", "template", "tokenize", "sample", "collate", "vit")
+MAX_PROFILED_NAMES = 64
+# Quarter-octave bins from 1 us to about 2 minutes
+BINS_PER_OCTAVE = 4
+NUM_BINS = BINS_PER_OCTAVE * 27
+FLUSH_INTERVAL = 1.0
+# Names of the stages that do not belong to one dataset
+BATCH_NAME = "batch"
+MODEL_NAME = "model"
+OTHER_NAME = "other"
+
+_profiler = None
+_null_stage = nullcontext()
+
+
+class DataProfiler:
+    """
+    Stage histograms of this rank: `NUM_BINS` duration counts per name and stage.
+
+    Names must be registered before the DataLoader workers fork; a worker attributes the
+    stages of an unknown name to `OTHER_NAME`.
+    """
+
+    def __init__(self):
+        self.names = {}
+        self.shape = (MAX_PROFILED_NAMES, len(DATA_STAGES), NUM_BINS)
+        self.shared = multiprocessing.Array("q", int(np.prod(self.shape)))
+        self.local = np.zeros(self.shape, dtype=np.int64)
+        self.pid = os.getpid()
+        self.last_flush = time.monotonic()
+        self.device_events = []
+        for name in (BATCH_NAME, MODEL_NAME, OTHER_NAME):
+            self.register(name)
+
+    def register(self, name):
+        if name not in self.names and len(self.names) < MAX_PROFILED_NAMES:
+            self.names[name] = len(self.names)
+        return self.names.get(name, self.names.get(OTHER_NAME))
+
+    def record(self, stage, name, duration_ns, count=1):
+        if os.getpid() != self.pid:
+            # A forked worker starts with an empty buffer, not with the unflushed one of its parent
+            self.local[:] = 0
+            self.pid, self.last_flush = os.getpid(), time.monotonic()
+        slot = self.names.get(name)
+        if slot is None:
+            slot = self.register(name) if get_worker_info() is None else self.names[OTHER_NAME]
+        # The `count` samples of a batched stage share its duration
+        duration_ns = duration_ns / count
+        bin_index = int(BINS_PER_OCTAVE * math.log2(duration_ns / 1000)) if duration_ns > 1000 else 0
+        self.local[slot, DATA_STAGES.index(stage), min(bin_index, NUM_BINS - 1)] += count
+        if time.monotonic() - self.last_flush > FLUSH_INTERVAL:
+            self.flush()
+
+    def flush(self):
+        with self.shared.get_lock():
+            np.frombuffer(self.shared.get_obj(), dtype=np.int64).reshape(self.shape)[...] += self.local
+        self.local[:] = 0
+        self.last_flush = time.monotonic()
+
+    def snapshot(self):
+        """Flush this process and return the histograms of the rank."""
+        for stage, name, start, end in self.device_events:
+            end.synchronize()
+            self.record(stage, name, start.elapsed_time(end) * 1e6)
+        self.device_events = []
+        self.flush()
+        with self.shared.get_lock():
+            return np.frombuffer(self.shared.get_obj(), dtype=np.int64).reshape(self.shape).copy()
+
+
+class _StageTimer:
+    __slots__ = ("stage", "name", "count", "start")
+
+    def __init__(self, stage, name, count):
+        self.stage, self.name, self.count = stage, name, count
+
+    def __enter__(self):
+        self.start = time.perf_counter_ns()
+
+    def __exit__(self, *exc):
+        _profiler.record(self.stage, self.name, time.perf_counter_ns() - self.start, self.count)
+
+
+class _DeviceStageTimer:
+    """Time a stage of CUDA kernels with events, resolved when the logs are collected."""
+
+    def __init__(self, stage, name):
+        self.stage, self.name = stage, name
+
+    def __enter__(self):
+        self.start = torch.cuda.Event(enable_timing=True)
+        self.start.record()
+
+    def __exit__(self, *exc):
+        end = torch.cuda.Event(enable_timing=True)
+        end.record()
+        _profiler.device_events.append((self.stage, self.name, self.start, end))
+
+
+def enable_data_profiler():
+    """Turn on the data pipeline profiler; call it before the datasets are built."""
+    global _profiler
+    if _profiler is None:
+        _profiler = DataProfiler()
+
+
+def data_profiler_enabled():
+    return _profiler is not None
+
+
+def register_profiled_name(name):
+    """Register a dataset name in the parent process, so that its workers report under it."""
+    if _profiler is not None:
+        _profiler.register(str(name))
+
+
+def data_stage(stage, name, count=1):
+    """Context manager timing `stage` of the dataset `name`, for `count` samples."""
+    if _profiler is None:
+        return _null_stage
+    return _StageTimer(stage, str(name), count)
+
+
+def device_stage(stage, name=MODEL_NAME):
+    """Context manager timing the CUDA kernels of `stage` without synchronizing the device."""
+    if _profiler is None or not torch.cuda.is_available():
+        return _null_stage
+    return _DeviceStageTimer(stage, name)
+
+
+def stage_clock():
+    """Start time of a stage recorded with `record_stage`, where a context manager does not fit."""
+    return time.perf_counter_ns() if _profiler is not None else 0
+
+
+def record_stage(stage, name, start, count=1):
+    if _profiler is not None:
+        _profiler.record(stage, str(name), time.perf_counter_ns() - start, count)
+
+
+def histogram_percentile(counts, q):
+    """Return the `q` quantile, in milliseconds, of a stage histogram (the geometric bin center)."""
+    cumulative = np.cumsum(counts)
+    bin_index = int(np.searchsorted(cumulative, q * cumulative[-1]))
+    return 2 ** ((bin_index + 0.5) / BINS_PER_OCTAVE) / 1000
+
+
+class DataProfilerCallback(TrainerCallback):
+    """
+    Add the data pipeline profile of every logging window to the training logs.
+
+    Per dataset name, `data/<name>/samples_per_s` counts the samples of all ranks, and
+    `data/<name>/<stage>_p50_ms` and `_p95_ms` are the percentiles of the stage durations.
+    """
+
+    def __init__(self):
+        self.last_counts = None
+        self.last_time = time.monotonic()
+
+    def on_log(self, args, state, control, logs=None, **kwargs):
+        if _profiler is None or logs is None:
+            return
+        counts = _profiler.snapshot()
+        window = counts if self.last_counts is None else counts - self.last_counts
+        self.last_counts = counts
+        now = time.monotonic()
+        elapsed, self.last_time = now - self.last_time, now
+        if dist.is_available() and dist.is_initialized():
+            # Every rank logs at the same steps; NCCL reduces device tensors only
+            window_tensor = torch.from_numpy(window).to(args.device)
+            dist.all_reduce(window_tensor)
+            window = window_tensor.cpu().numpy()
+        sample_stage = DATA_STAGES.index("sample")
+        for name, slot in _profiler.names.items():
+            for stage_index, stage in enumerate(DATA_STAGES):
+                histogram = window[slot, stage_index]
+                if not histogram.any():
+                    continue
+                if stage_index == sample_stage:
+                    logs[f"data/{name}/samples_per_s"] = round(float(histogram.sum()) / max(elapsed, 1e-9), 2)
+                logs[f"data/{name}/{stage}_p50_ms"] = round(histogram_percentile(histogram, 0.5), 3)
+                logs[f"data/{name}/{stage}_p95_ms"] = round(histogram_percentile(histogram, 0.95), 3)
+
+
+if os.environ.get("EARTHDIAL_PROFILE_DATA", "0") == "1":
+    enable_data_profiler()
@@ -0,0 +1,230 @@
+"""
+Persistent quarantine of shard rows that fail to load.
+
+Rows whose content cannot be decoded (see `is_sample_error`) are appended, with their
+error class, to a `.quarantine-<key>.jsonl` sidecar next to the dataset directory. The
+key is built from the dataset fingerprint, like the length index, so a rewritten dataset
+starts with an empty quarantine. Appends are single `O_APPEND` writes, so DataLoader
+workers and ranks can share the file. Every reader picks up new entries periodically,
+and quarantined rows are skipped without being read or decoded, including in later
+epochs and runs. Other errors, e.g. transient IO errors, a malformed conversation or a bug
+of a transform, only fail the sample: it is counted and replaced, but not quarantined.
+
+The number of failed and skipped samples is kept in shared memory. The DataLoader workers,
+which the training entry points fork, update it, and `SampleCounterCallback` adds it to the
+training logs (see `src/tools/check_worker_stats.py`).
+"""
+
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import struct
+import time
+import zlib
+
+import pyarrow as pa
+import torch
+import torch.distributed as dist
+from PIL import Image, UnidentifiedImageError
+from transformers import TrainerCallback
+
+QUARANTINE_VERSION = 1
+QUARANTINE_REFRESH_INTERVAL = 30.0
+# Rows skipped or failed in a row before a dataset is given up on
+MAX_SAMPLE_ATTEMPTS = 1000
+
+# Errors of the content of a row: its encoded images or arrays, or its JSON
+SAMPLE_ERRORS = (
+    UnidentifiedImageError,
+    Image.DecompressionBombError,
+    SyntaxError,  # Malformed image headers
+    EOFError,
+    json.JSONDecodeError,
+    UnicodeDecodeError,
+    pa.ArrowInvalid,
+    struct.error,
+    zlib.error,
+)
+# Modules whose ValueErrors and OSErrors come from the data they decode, e.g. PIL's "not
+# enough image data" or "broken data stream"
+DECODER_MODULES = ("PIL", "tifffile", "cv2", "imageio", "rasterio")
+
+# Shared with the forked DataLoader workers of this process
+_sample_counters = {
+    "failed": multiprocessing.Value("q", 0),
+    "skipped": multiprocessing.Value("q", 0),
+}
+
+
+def is_sample_error(e):
+    """Whether `e` comes from the content of a row, which is then quarantined."""
+    if isinstance(e, SAMPLE_ERRORS):
+        return True
+    if not isinstance(e, (ValueError, OSError)):
+        return False
+    # PIL reports truncated images as plain OSErrors
+    if isinstance(e, OSError) and "truncated" in str(e):
+        return True
+    # Raised by a decoder, and not by the code using the decoded sample or by a file system
+    tb = e.__traceback__
+    while tb is not None and tb.tb_next is not None:
+        tb = tb.tb_next
+    module = tb.tb_frame.f_globals.get("__name__", "") if tb is not None else ""
+    return module.split(".")[0] in DECODER_MODULES
+
+
+def check_sample_attempts(attempts, quarantine, num_rows, ds_name):
+    """Raise once `MAX_SAMPLE_ATTEMPTS` rows in a row were quarantined or failed."""
+    if attempts >= MAX_SAMPLE_ATTEMPTS:
+        raise RuntimeError(
+            f"No sample of dataset {ds_name} could be loaded in {attempts} attempts: "
+            f"{len(quarantine)} of its {num_rows} rows are quarantined in {quarantine.path}"
+        )
+
+
+def increment_sample_counter(name):
+    counter = _sample_counters[name]
+    with counter.get_lock():
+        counter.value += 1
+
+
+def sample_counters():
+    """
+    Return the failed and skipped sample counts of this rank.
+
+    The counters are created at import, in the main process of the rank, and shared with its
+    DataLoader workers, which `finetune.py` and `pretrain.py` fork.
+    """
+    return {name: counter.value for name, counter in _sample_counters.items()}
+
+
+def restore_sample_counters(counters):
+    """Restore the failed and skipped sample counts saved with a checkpoint."""
+    for name, value in counters.items():
+        if name in _sample_counters:
+            _sample_counters[name].value = value
+
+
+def quarantine_path(annotation, fingerprint):
+    """
+    Return the quarantine sidecar path of the dataset directory `annotation`.
+
+    Args:
+        annotation (str): Path of the dataset directory.
+        fingerprint (object): JSON-serializable identity of its content, e.g. `dataset_fingerprint`.
+    """
+    key = {"version": QUARANTINE_VERSION, "fingerprint": fingerprint}
+    key = hashlib.sha1(json.dumps(key, sort_keys=True).encode()).hexdigest()[:16]
+    return f"{os.path.normpath(annotation)}.quarantine-{key}.jsonl"
+
+
+class QuarantineIndex:
+    """
+    Set of quarantined rows of a shard dataset, synchronized through its sidecar file.
+
+    Args:
+        annotation (str): Path of the dataset directory.
+        fingerprint (object): Identity of the content of the full dataset (see `quarantine_path`).
+        offset (int): Position of this dataset's first row in the full dataset, for
+            datasets that hold a slice of it.
+        refresh_interval (float): Seconds between two reads of new sidecar entries.
+    """
+
+    def __init__(self, annotation, fingerprint, offset=0, refresh_interval=QUARANTINE_REFRESH_INTERVAL):
+        self.path = quarantine_path(annotation, fingerprint)
+        self.offset = offset
+        self.refresh_interval = refresh_interval
+        self.indices = set()
+        self.writable = True
+        self._position = 0
+        self._next_refresh = 0.0
+        self.refresh()
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __contains__(self, i):
+        if time.monotonic() >= self._next_refresh:
+            self.refresh()
+        return i + self.offset in self.indices
+
+    def refresh(self):
+        """Read the entries appended to the sidecar since the last refresh."""
+        self._next_refresh = time.monotonic() + self.refresh_interval
+        try:
+            with open(self.path, "rb") as f:
+                f.seek(self._position)
+                for line in f:
+                    if not line.endswith(b"\n"):
+                        break  # Partially written entry, read it on the next refresh
+                    self._position += len(line)
+                    self.indices.add(json.loads(line)["index"])
+        except FileNotFoundError:
+            pass
+
+    def record_failure(self, i, error):
+        """
+        Count a failed sample, and quarantine its row if the error comes from its content.
+
+        Args:
+            i (int): Index of the row in this dataset.
+            error (Exception): The error raised while loading the sample.
+
+        Returns:
+            bool: Whether the row was quarantined.
+        """
+        if is_sample_error(error):
+            self.add(i, error)
+            return True
+        increment_sample_counter("failed")
+        return False
+
+    def add(self, i, error):
+        """
+        Quarantine row `i` and count it as a failed sample.
+
+        Args:
+            i (int): Index of the row in this dataset.
+            error (Exception | str): The error raised by the row, or its name.
+        """
+        increment_sample_counter("failed")
+        index = i + self.offset
+        if index in self.indices:
+            return
+        self.indices.add(index)
+        if not self.writable:
+            return
+        error_name = error if isinstance(error, str) else type(error).__name__
+        line = json.dumps({"index": index, "error": error_name}) + "\n"
+        try:
+            fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                os.write(fd, line.encode())
+            finally:
+                os.close(fd)
+        except OSError as e:
+            # e.g. read-only storage: keep quarantining in memory only
+            self.writable = False
+            logging.warning(f"Could not write quarantine file {self.path}: {e}")
+
+
+class SampleCounterCallback(TrainerCallback):
+    """
+    Add the failed and skipped sample counts of the shard datasets to the training logs.
+
+    The counts are summed over the ranks; each rank counts the samples of its DataLoader
+    workers (see `sample_counters`).
+    """
+
+    def on_log(self, args, state, control, logs=None, **kwargs):
+        if logs is None:
+            return
+        counters = sample_counters()
+        counts = torch.tensor([counters["failed"], counters["skipped"]], dtype=torch.int64)
+        if dist.is_available() and dist.is_initialized():
+            # Every rank logs at the same steps; NCCL reduces device tensors only
+            counts = counts.to(args.device)
+            dist.all_reduce(counts)
+        logs["data_failed_samples"], logs["data_skipped_samples"] = counts.tolist()
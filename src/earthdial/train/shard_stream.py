@@ -0,0 +1,155 @@
+"""
+Streaming reads of the Arrow shard datasets.
+
+A dataset written by `save_to_disk` is a list of Arrow files. The files are cut into
+row pieces, and every epoch deals the pieces, in a seeded order shared by all ranks,
+to the `(rank, DataLoader worker)` consumers. A consumer memory-maps one file at a
+time, reads its pieces in blocks and shuffles the rows through a bounded buffer, so
+the memory of a rank does not grow with the size of the dataset.
+
+Streams cycle through epochs without end; training length is set by `max_steps`.
+Their position is the number of batches consumed on a rank: on resume, every
+consumer fast-forwards over the rows it already yielded, without decoding them.
+"""
+
+import json
+import os
+
+import numpy as np
+import torch.distributed as dist
+from datasets import Dataset
+from torch.utils.data import IterableDataset, get_worker_info
+
+STREAM_PIECE_ROWS = 16384
+STREAM_READ_ROWS = 256
+STREAM_SHUFFLE_BUFFER = 1024
+# Mixture draws are made in fixed blocks so that resuming replays the same sequence
+STREAM_CHOICE_BLOCK = 4096
+
+
+def stream_data_files(annotation):
+    """Return the Arrow files of the dataset directory `annotation`, in row order."""
+    with open(os.path.join(annotation, "state.json")) as f:
+        state = json.load(f)
+    return [os.path.join(annotation, data_file["filename"]) for data_file in state["_data_files"]]
+
+
+def open_data_file(path):
+    """Memory-map one Arrow file of a dataset directory."""
+    return Dataset.from_file(path, in_memory=False)
+
+
+def split_pieces(file_rows, piece_rows):
+    """
+    Cut files into row pieces of at most `piece_rows` rows.
+
+    Args:
+        file_rows (list): Number of rows of each file.
+        piece_rows (int): Maximum rows per piece.
+
+    Returns:
+        list: `(file_idx, first_row, start, stop)` tuples, where `first_row` is the index
+            of the file's first row in the full dataset and `start:stop` the rows in the file.
+    """
+    pieces = []
+    first_row = 0
+    for file_idx, rows in enumerate(file_rows):
+        for start in range(0, rows, piece_rows):
+            pieces.append((file_idx, first_row, start, min(start + piece_rows, rows)))
+        first_row += rows
+    return pieces
+
+
+def stream_consumer():
+    """
+    Return the consumer of the calling process.
+
+    Returns:
+        tuple: `(consumer, num_consumers, worker_id, num_workers)`, with one consumer
+            per `(rank, DataLoader worker)` pair.
+    """
+    worker_info = get_worker_info()
+    worker_id, num_workers = (worker_info.id, worker_info.num_workers) if worker_info else (0, 1)
+    rank, world_size = (dist.get_rank(), dist.get_world_size()) if dist.is_initialized() else (0, 1)
+    return rank * num_workers + worker_id, world_size * num_workers, worker_id, num_workers
+
+
+def stream_position(batches, batch_size, num_workers):
+    """
+    Serializable position of a stream after `batches` batches were consumed on a rank.
+
+    Args:
+        batches (int): Batches taken from the DataLoader of the rank.
+        batch_size (int): Per-device batch size.
+        num_workers (int): DataLoader workers of the rank.
+    """
+    return {"batches": int(batches), "batch_size": int(batch_size), "num_workers": max(1, int(num_workers))}
+
+
+def consumed_samples(position, worker_id):
+    """Return the number of samples that the worker `worker_id` yielded before `position`."""
+    if not position:
+        return 0
+    # The DataLoader takes whole batches from its workers in turn
+    batches, num_workers = position["batches"], position["num_workers"]
+    worker_batches = batches // num_workers + int(worker_id < batches % num_workers)
+    return worker_batches * position["batch_size"]
+
+
+def shuffle_buffer(items, buffer_size, rng):
+    """Shuffle an iterable through a buffer of `buffer_size` items."""
+    buffer = []
+    for item in items:
+        if len(buffer) < buffer_size:
+            buffer.append(item)
+            continue
+        j = rng.integers(buffer_size)
+        yield buffer[j]
+        buffer[j] = item
+    rng.shuffle(buffer)
+    yield from buffer
+
+
+class WeightedStreamDataset(IterableDataset):
+    """
+    Mixture of streaming datasets, drawing each sample from a dataset picked by weight.
+
+    Args:
+        datasets (list): Streaming datasets with an `iter_samples(skip)` method.
+        weights (list): Sampling probability of each dataset.
+        seed (int): Seed of the draws, combined with the consumer index.
+    """
+
+    def __init__(self, datasets, weights, seed=0):
+        super().__init__()
+        self.datasets = datasets
+        self.weights = np.asarray(weights, dtype=np.float64) / np.sum(weights)
+        self.seed = seed
+        self.position = None
+        self.num_rows = sum(dataset.num_rows for dataset in datasets)
+
+    def load_state_dict(self, position):
+        self.position = position
+
+    def __iter__(self):
+        consumer, _, worker_id, _ = stream_consumer()
+        rng = np.random.default_rng([self.seed, consumer])
+        num_datasets = len(self.datasets)
+        skip = consumed_samples(self.position, worker_id)
+
+        # Replay the draws of the skipped samples to split the skip between the datasets
+        counts = np.zeros(num_datasets, dtype=np.int64)
+        for _ in range(skip // STREAM_CHOICE_BLOCK):
+            counts += np.bincount(rng.choice(num_datasets, STREAM_CHOICE_BLOCK, p=self.weights),
+                                  minlength=num_datasets)
+        choices = rng.choice(num_datasets, STREAM_CHOICE_BLOCK, p=self.weights)
+        rest = skip % STREAM_CHOICE_BLOCK
+        counts += np.bincount(choices[:rest], minlength=num_datasets)
+        choices = choices[rest:].tolist()
+
+        streams = [dataset.iter_samples(skip=int(count)) for dataset, count in zip(self.datasets, counts)]
+        while True:
+            for choice in choices:
+                yield next(streams[choice])
+            choices = rng.choice(num_datasets, STREAM_CHOICE_BLOCK, p=self.weights).tolist()
+
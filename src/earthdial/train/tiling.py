@@ -0,0 +1,148 @@
+"""
+Tensor tile engine for dynamic-resolution images.
+
+`tile_image` is the tensor counterpart of `dynamic_preprocess` followed by the
+per-tile evaluation transform: the image is resized once to the tile grid, cut
+into `[n_tiles, C, S, S]` with a single unfold, and normalized with one fused
+multiply-add. It is shared by the training datasets, the eval scripts and the
+demo worker. With a per-tile transform, e.g. the JPEG degradation of training, the
+tiles are cut by PIL, which the transform takes, and only the normalization is fused.
+"""
+
+from functools import lru_cache
+
+import numpy as np
+import torch
+import torchvision.transforms.functional as TF
+from PIL import Image
+from torchvision.transforms.functional import InterpolationMode
+
+from .constants import (CLIP_MEAN, CLIP_STD, IMAGENET_MEAN, IMAGENET_STD,
+                        SIGLIP_MEAN, SIGLIP_STD)
+
+# Normalizations supported by the tile engine (RGB images only)
+RGB_NORMALIZE_STATS = {
+    'imagenet': (IMAGENET_MEAN, IMAGENET_STD),
+    'clip': (CLIP_MEAN, CLIP_STD),
+    'siglip': (SIGLIP_MEAN, SIGLIP_STD),
+}
+
+
+@lru_cache(maxsize=None)
+def get_target_ratios(min_num, max_num):
+    """Return the `(cols, rows)` tile grids with `min_num <= cols * rows <= max_num`, sorted by tile count."""
+    target_ratios = set(
+        (i, j) for n in range(min_num, max_num + 1) for i in range(1, n + 1) for j in range(1, n + 1) if
+        i * j <= max_num and i * j >= min_num)
+    return tuple(sorted(target_ratios, key=lambda x: x[0] * x[1]))
+
+
+def find_closest_aspect_ratio(aspect_ratio, target_ratios, width, height, image_size):
+    best_ratio_diff = float('inf')
+    best_ratio = (1, 1)
+    area = width * height
+    for ratio in target_ratios:
+        target_aspect_ratio = ratio[0] / ratio[1]
+        ratio_diff = abs(aspect_ratio - target_aspect_ratio)
+        if ratio_diff < best_ratio_diff:
+            best_ratio_diff = ratio_diff
+            best_ratio = ratio
+        elif ratio_diff == best_ratio_diff:
+            if area > 0.5 * image_size * image_size * ratio[0] * ratio[1]:
+                best_ratio = ratio
+    return best_ratio
+
+
+def get_tile_grid(width, height, min_num=1, max_num=6, image_size=448):
+    """Return the `(cols, rows)` tile grid chosen for an image of size `width x height`."""
+    return find_closest_aspect_ratio(
+        width / height, get_target_ratios(min_num, max_num), width, height, image_size)
+
+
+@lru_cache(maxsize=None)
+def _normalize_params(normalize_type):
+    # (x / 255 - mean) / std == x * scale - shift
+    mean, std = RGB_NORMALIZE_STATS[normalize_type]
+    mean = torch.tensor(mean, dtype=torch.float32).view(-1, 1, 1)
+    std = torch.tensor(std, dtype=torch.float32).view(-1, 1, 1)
+    return 1.0 / (255.0 * std), mean / std
+
+
+def _resize(image, height, width):
+    # Bicubic with antialiasing matches PIL's resampling. PIL resizes the width, then the
+    # height, and rounds to uint8 levels after each pass, which clips the overshoot at edges
+    if image.size(2) != width:
+        image = TF.resize(image, [image.size(1), width], interpolation=InterpolationMode.BICUBIC, antialias=True)
+        image = image.clamp_(0, 255).round_()
+    if image.size(1) != height:
+        image = TF.resize(image, [height, width], interpolation=InterpolationMode.BICUBIC, antialias=True)
+        image = image.clamp_(0, 255).round_()
+    return image
+
+
+def _transformed_tiles(image, cols, rows, image_size, use_thumbnail, tile_transform):
+    # The uint8 tiles of `dynamic_preprocess`, cut by PIL and each passed through `tile_transform`;
+    # PIL already holds the tiles the transform takes, so the tensor resize would only add copies
+    image = image.convert('RGB')
+    resized = image.resize((cols * image_size, rows * image_size), Image.BICUBIC)
+    tiles = [
+        resized.crop((col * image_size, row * image_size, (col + 1) * image_size, (row + 1) * image_size))
+        for row in range(rows) for col in range(cols)
+    ]
+    if use_thumbnail and len(tiles) != 1:
+        tiles.append(image.resize((image_size, image_size), Image.BICUBIC))
+    pixels = np.stack([np.asarray(tile_transform(tile)) for tile in tiles])
+    return torch.empty(len(tiles), 3, image_size, image_size).copy_(torch.from_numpy(pixels).permute(0, 3, 1, 2))
+
+
+def tile_image(image, min_num=1, max_num=6, image_size=448, use_thumbnail=False,
+               normalize_type='imagenet', dynamic=True, tile_transform=None):
+    """
+    Tile and normalize an RGB image into a `[n_tiles, 3, image_size, image_size]` tensor.
+
+    Args:
+        image (PIL.Image | np.ndarray | torch.Tensor): The image; arrays are HWC uint8 and
+            tensors are CHW with values in [0, 255]. PIL images of other modes, including
+            grayscale, are converted to RGB, as the eval loaders did before tiling.
+        min_num (int): Minimum number of tiles.
+        max_num (int): Maximum number of tiles.
+        image_size (int): Side of a tile.
+        use_thumbnail (bool): Append a thumbnail of the whole image when there is more than one tile.
+        normalize_type (str): One of `RGB_NORMALIZE_STATS`.
+        dynamic (bool): If False, the image is resized to a single tile.
+        tile_transform (callable): Applied to every tile, as an RGB PIL image, before the
+            normalization, like the per-tile augmentations of the training transform (e.g.
+            `random_jpeg_degradation`). The tiles are then cut by PIL, as in `dynamic_preprocess`,
+            and `image` must be a PIL image.
+
+    Returns:
+        torch.Tensor: The normalized float32 tiles.
+    """
+    if tile_transform is not None:
+        if not isinstance(image, Image.Image):
+            raise TypeError(f'tile_transform needs a PIL image, not {type(image).__name__}')
+        width, height = image.size
+        cols, rows = get_tile_grid(width, height, min_num, max_num, image_size) if dynamic else (1, 1)
+        tiles = _transformed_tiles(image, cols, rows, image_size, use_thumbnail, tile_transform)
+        scale, shift = _normalize_params(normalize_type)
+        return tiles.mul_(scale).sub_(shift)
+
+    if isinstance(image, Image.Image):
+        image = np.asarray(image.convert('RGB'))
+    if isinstance(image, np.ndarray):
+        image = torch.from_numpy(np.ascontiguousarray(image)).permute(2, 0, 1)
+    image = image.float()
+    _, height, width = image.shape
+
+    cols, rows = get_tile_grid(width, height, min_num, max_num, image_size) if dynamic else (1, 1)
+    resized = _resize(image, rows * image_size, cols * image_size)
+    channels = resized.size(0)
+    # [C, rows*S, cols*S] -> [rows*cols, C, S, S], tiles in row-major order
+    tiles = resized.view(channels, rows, image_size, cols, image_size)
+    tiles = tiles.permute(1, 3, 0, 2, 4).reshape(rows * cols, channels, image_size, image_size)
+    if use_thumbnail and rows * cols != 1:
+        thumbnail = _resize(image, image_size, image_size)
+        tiles = torch.cat([tiles, thumbnail.unsqueeze(0)])
+
+    scale, shift = _normalize_params(normalize_type)
+    return tiles.mul_(scale).sub_(shift)
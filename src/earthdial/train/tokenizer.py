@@ -0,0 +1,60 @@
+"""
+Loading of the LLM tokenizer for training, evaluation and serving.
+
+The slow sentencepiece tokenizers are the reference. With `use_fast=True` the `tokenizers`
+implementation is loaded instead (`InternLM2TokenizerFast`, or `LlamaTokenizerFast` for Phi-3),
+which `src/tools/check_fast_tokenizer.py` checks against the slow one over the conversation
+templates. A fast tokenizer is given the padding side of its slow class unless the tokenizer
+config sets one, and each of its added tokens must encode to its own single id.
+"""
+
+import os
+
+from transformers import AutoTokenizer
+
+
+def check_special_tokens(tokenizer):
+    """
+    Check that every added token of a fast tokenizer, e.g. `SPECIAL_TOKENS` and the template role
+    tokens, encodes to its single id.
+
+    Raises:
+        ValueError: With the tokens that are split or merged with their surroundings.
+    """
+    if not tokenizer.is_fast:
+        return
+    broken = []
+    for token, token_id in tokenizer.get_added_vocab().items():
+        for text in (token, f"a {token} b"):
+            ids = tokenizer(text, add_special_tokens=False).input_ids
+            if ids.count(token_id) != 1:
+                broken.append(token)
+                break
+    if broken:
+        raise ValueError(f"The fast tokenizer does not keep these added tokens whole: {broken}")
+
+
+def load_tokenizer(path, use_fast=False, **kwargs):
+    """
+    Load the tokenizer of a model or LLM.
+
+    Args:
+        path (str): Model or LLM directory.
+        use_fast (bool): Load the fast tokenizer instead of the slow sentencepiece one.
+        **kwargs: Passed to `AutoTokenizer.from_pretrained`, e.g. `add_eos_token=False`.
+
+    Returns:
+        PreTrainedTokenizerBase: The tokenizer. Training adds `SPECIAL_TOKENS` afterwards and
+            checks them again with `check_special_tokens`.
+    """
+    if use_fast:
+        # The DataLoader workers fork after the tokenizer has been used in the main process
+        os.environ.setdefault("TOKENIZERS_PARALLELISM", "false")
+    tokenizer = AutoTokenizer.from_pretrained(path, trust_remote_code=True, use_fast=use_fast, **kwargs)
+    if tokenizer.is_fast:
+        slow_class = tokenizer.slow_tokenizer_class
+        if "padding_side" not in tokenizer.init_kwargs and slow_class is not None:
+            # InternLM2TokenizerFast pads on the left; the training labels assume the slow side
+            tokenizer.padding_side = slow_class.padding_side
+        check_special_tokens(tokenizer)
+    return tokenizer
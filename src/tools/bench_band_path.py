@@ -0,0 +1,132 @@
+"""
+Benchmark the multi-band sample path on synthetic shards, up to the normalized tensor.
+
+With `--layout tif_ms` (BigEarthNet-style uint16 band cubes), compares per sample the
+previous path (Python-formatted row, then `torch.tensor(np.array(images), dtype=torch.float32)`)
+with the zero-copy path (Arrow view from `band_reader`, then `band_tensor`).
+
+With `--layout starcop` (an HWC RGB column and a plume column), compares the float32 buffer
+filled band by band with `band_tensor` over the channel-first views of the two columns.
+
+Both modes end with the `BandNormalize` of the transform; the checksum of the normalized
+tensors of the first rows must be the same for both. Each mode runs in its own process so that the reported peak RSS belongs to that mode only.
+
+Example:
+    python src/tools/bench_band_path.py --rows 512 --bands 12 --image-size 120
+    python src/tools/bench_band_path.py --layout starcop --rows 64 --image-size 512
+"""
+import argparse
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+sys.path.append('./src')
+
+
+def build_shard(path, layout, rows, bands, image_size):
+    from datasets import Array2D, Array3D, Dataset, Features, Value
+
+    rng = np.random.default_rng(0)
+    if layout == 'tif_ms':
+        features = Features({'conversations': Value('string'),
+                             'tif_ms': Array3D(shape=(bands, image_size, image_size), dtype='uint16')})
+    else:
+        features = Features({'conversations': Value('string'),
+                             'tif_pl': Array3D(shape=(image_size, image_size, 3), dtype='float32'),
+                             'mag1c': Array2D(shape=(image_size, image_size), dtype='float32')})
+
+    def gen():
+        for _ in range(rows):
+            if layout == 'tif_ms':
+                yield {'conversations': '[]',
+                       'tif_ms': rng.integers(0, 10000, (bands, image_size, image_size), dtype=np.uint16)}
+            else:
+                yield {'conversations': '[]',
+                       'tif_pl': rng.random((image_size, image_size, 3), dtype=np.float32) * 255,
+                       'mag1c': rng.random((image_size, image_size), dtype=np.float32) * 255}
+
+    Dataset.from_generator(gen, features=features).save_to_disk(path)
+
+
+def run(mode, layout, path, repeat):
+    import torch
+    from datasets import load_from_disk
+    from earthdial.train.band_reader import band_tensor, read_band_rows, stack_bands
+    from earthdial.train.dataset import BandNormalize
+
+    raw_data = load_from_disk(path)
+    columns = ['tif_ms'] if layout == 'tif_ms' else ['tif_pl', 'mag1c']
+    band_records = raw_data.select_columns(columns).with_format('arrow')
+    if layout == 'tif_ms':
+        bands = raw_data.features['tif_ms'].shape[0]
+        normalize = BandNormalize(mean=[0] * bands, std=[10000] * bands)
+    else:
+        normalize = BandNormalize(mean=(0, 0, 0, 0), std=(255, 255, 255, 255))
+
+    if mode == 'old' and layout == 'tif_ms':
+        records = raw_data.select_columns(columns)
+
+        def sample(i):
+            images = [records[i]['tif_ms']]
+            return torch.tensor(np.array(images), dtype=torch.float32)
+    elif mode == 'new' and layout == 'tif_ms':
+        def sample(i):
+            images = [read_band_rows(band_records, i)['tif_ms']]
+            return band_tensor(stack_bands(images))
+    elif mode == 'old':
+        def sample(i):
+            # The float32 buffer filled band by band
+            record = read_band_rows(band_records, i)
+            rgb, plume = np.asarray(record['tif_pl']), np.asarray(record['mag1c'])
+            combined_image = np.zeros((4, *rgb.shape[:2]), dtype=np.float32)
+            combined_image[:3] = rgb.transpose(2, 0, 1)
+            combined_image[3] = plume
+            return band_tensor(stack_bands([combined_image]))
+    else:
+        def sample(i):
+            record = read_band_rows(band_records, i)
+            rgb, plume = np.asarray(record['tif_pl']), np.asarray(record['mag1c'])
+            return band_tensor([rgb.transpose(2, 0, 1), plume[None]]).unsqueeze(0)
+
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for i in range(len(raw_data)):
+            torch.stack([normalize(image) for image in sample(i)])
+        best = min(best, time.perf_counter() - start)
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    checksum = sum(float(torch.stack([normalize(image) for image in sample(i)]).double().sum())
+                   for i in range(min(len(raw_data), 8)))
+    print(f'{layout} {mode}: {best / len(raw_data) * 1e3:.3f} ms/sample, peak RSS {peak_rss:.0f} MiB, '
+          f'checksum {checksum:.6e}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--layout', choices=['tif_ms', 'starcop'], default='tif_ms')
+    parser.add_argument('--rows', type=int, default=512)
+    parser.add_argument('--bands', type=int, default=12)
+    parser.add_argument('--image-size', type=int, default=120)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--mode', choices=['build', 'old', 'new'], help=argparse.SUPPRESS)
+    parser.add_argument('--path', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.mode == 'build':
+        build_shard(args.path, args.layout, args.rows, args.bands, args.image_size)
+    elif args.mode:
+        run(args.mode, args.layout, args.path, args.repeat)
+    else:
+        # Every step runs in a fresh process: the peak RSS is inherited across exec
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'shard')
+            for mode in ('build', 'old', 'new'):
+                subprocess.run([sys.executable, __file__, '--mode', mode, '--path', path, '--layout', args.layout,
+                                '--rows', str(args.rows), '--bands', str(args.bands),
+                                '--image-size', str(args.image_size), '--repeat', str(args.repeat)],
+                               check=True)
@@ -0,0 +1,89 @@
+"""
+Benchmark the chunked LM-head cross-entropy against the loss over the full logits.
+
+A batch of hidden states of `--seq-len` tokens, of which `--supervised` are labelled, goes
+through the LM head and `CrossEntropyLoss` as in `InternVLChatModel.forward`, and through
+`chunked_linear_cross_entropy`. The loss and the gradients of the hidden states and LM head
+must match within `--atol`; the time and peak memory of a forward and backward are reported.
+
+Example:
+    python src/tools/bench_chunked_loss.py --seq-len 8192 --vocab-size 92553 --hidden-size 4096 \\
+        --chunk-sizes 4096 8192 16384
+"""
+import argparse
+import sys
+import time
+
+sys.path.append('./src')
+
+
+def run(loss_fn, hidden_states, weight, labels, device):
+    import torch
+
+    hidden_states = hidden_states.detach().requires_grad_()
+    weight = weight.detach().requires_grad_()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+    base = torch.cuda.memory_allocated() if device.type == 'cuda' else 0
+    start = time.perf_counter()
+    loss = loss_fn(hidden_states, weight, labels)
+    loss.backward()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    elapsed_ms = (time.perf_counter() - start) * 1e3
+    peak_mb = (torch.cuda.max_memory_allocated() - base) / 2 ** 20 if device.type == 'cuda' else float('nan')
+    return loss.detach().float(), hidden_states.grad.float(), weight.grad.float(), elapsed_ms, peak_mb
+
+
+def main(args):
+    import torch
+    import torch.nn.functional as F
+    from torch.nn import CrossEntropyLoss
+
+    from earthdial.model.internvl_chat.chunked_cross_entropy import chunked_linear_cross_entropy
+
+    device = torch.device(args.device)
+    dtype = getattr(torch, args.dtype)
+    generator = torch.Generator().manual_seed(args.seed)
+    hidden_states = torch.randn(1, args.seq_len, args.hidden_size, generator=generator).to(device, dtype)
+    weight = (torch.randn(args.vocab_size, args.hidden_size, generator=generator) * 0.02).to(device, dtype)
+    labels = torch.full((1, args.seq_len), -100, dtype=torch.long)
+    supervised = torch.randperm(args.seq_len, generator=generator)[:args.supervised]
+    labels[0, supervised] = torch.randint(args.vocab_size, (len(supervised),), generator=generator)
+    labels = labels.to(device)
+
+    def full_logits(hidden_states, weight, labels):
+        logits = F.linear(hidden_states, weight).float()
+        shift_logits = logits[..., :-1, :].contiguous().view(-1, weight.shape[0])
+        return CrossEntropyLoss()(shift_logits, labels[..., 1:].contiguous().view(-1))
+
+    loss, grad_hidden_states, grad_weight, elapsed_ms, peak_mb = run(full_logits, hidden_states, weight, labels, device)
+    print(f'{"full logits":>18}: loss {loss:.6f}, {elapsed_ms:8.1f} ms, peak {peak_mb:9.1f} MiB')
+    failed = False
+    for chunk_size in args.chunk_sizes:
+        def chunked(hidden_states, weight, labels):
+            return chunked_linear_cross_entropy(hidden_states, weight, labels, chunk_size)
+
+        result = run(chunked, hidden_states, weight, labels, device)
+        errors = [(result[0] - loss).abs().item(), (result[1] - grad_hidden_states).abs().max().item(),
+                  (result[2] - grad_weight).abs().max().item()]
+        failed |= max(errors) > args.atol
+        print(f'{f"chunks of {chunk_size}":>18}: loss {result[0]:.6f}, {result[3]:8.1f} ms, peak {result[4]:9.1f} MiB, '
+              f'max error loss {errors[0]:.2e} grad hidden {errors[1]:.2e} grad head {errors[2]:.2e}')
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--seq-len', type=int, default=8192)
+    parser.add_argument('--supervised', type=int, default=512, help='labelled tokens of the sequence')
+    parser.add_argument('--hidden-size', type=int, default=3072)
+    parser.add_argument('--vocab-size', type=int, default=32030)
+    parser.add_argument('--chunk-sizes', type=int, nargs='+', default=[4096, 8192, 16384])
+    parser.add_argument('--dtype', type=str, default='bfloat16')
+    parser.add_argument('--device', type=str, default='cuda')
+    parser.add_argument('--atol', type=float, default=1e-2)
+    parser.add_argument('--seed', type=int, default=0)
+    main(parser.parse_args())
@@ -0,0 +1,80 @@
+"""
+Benchmark the tokenization of image placeholders: string expansion against token-id splicing.
+
+For every tile count (and number of temporal images), a conversation is tokenized the former
+way, with `<IMG_CONTEXT>` written `num_image_token` times per tile into the string, and with
+one context marker per image spliced by `splice_image_tokens`. The ids must be identical; the
+time per sample is reported for both.
+
+Example:
+    python src/tools/bench_image_tokens.py --model-name-or-path pretrained/EarthDial \\
+        --num-tiles 1 7 13 --num-images 1 2
+"""
+import argparse
+import sys
+import time
+
+sys.path.append('./src')
+
+QUESTION = 'Describe the changes between the images and locate the new buildings.'
+ANSWER = 'Two buildings were built along the road: [[120, 44, 310, 198]] and [[400, 380, 512, 470]].'
+
+
+def per_sample_ms(fn, repeats):
+    fn()
+    start = time.perf_counter()
+    for _ in range(repeats):
+        fn()
+    return (time.perf_counter() - start) / repeats * 1e3
+
+
+def main(args):
+    from earthdial.conversation import get_conv_template
+    from earthdial.train.constants import IMG_CONTEXT_TOKEN, IMG_END_TOKEN, IMG_START_TOKEN, SPECIAL_TOKENS
+    from earthdial.train.image_tokens import insert_image_placeholders, splice_image_tokens
+    from earthdial.train.tokenizer import load_tokenizer
+
+    tokenizer = load_tokenizer(args.model_name_or_path, use_fast=args.use_fast_tokenizer, add_eos_token=False)
+    tokenizer.add_tokens(SPECIAL_TOKENS, special_tokens=True)
+    img_context_token_id = tokenizer.convert_tokens_to_ids(IMG_CONTEXT_TOKEN)
+
+    failed = False
+    for num_image in args.num_images:
+        conv = get_conv_template(args.conv_style)
+        conv.append_message(conv.roles[0], '<image>\n' * num_image + QUESTION)
+        conv.append_message(conv.roles[1], ANSWER)
+        prompt = conv.get_prompt()
+        for num_tiles in args.num_tiles:
+            num_image_tokens = [args.num_image_token * num_tiles] * num_image
+
+            def expand():
+                query = prompt
+                for num_tokens in num_image_tokens:
+                    query = query.replace('<image>', IMG_START_TOKEN + IMG_CONTEXT_TOKEN * num_tokens + IMG_END_TOKEN, 1)
+                return tokenizer(query, return_tensors='pt').input_ids[0]
+
+            def splice():
+                query_ids = tokenizer(insert_image_placeholders(prompt, num_image), return_tensors='pt').input_ids[0]
+                return splice_image_tokens(query_ids, img_context_token_id, num_image_tokens)[0]
+
+            identical = expand().equal(splice())
+            failed |= not identical
+            expand_ms = per_sample_ms(expand, args.repeats)
+            splice_ms = per_sample_ms(splice, args.repeats)
+            print(f'{num_image} image(s) x {num_tiles:>2} tiles ({len(splice())} tokens): '
+                  f'string {expand_ms:8.3f} ms, spliced {splice_ms:8.3f} ms, '
+                  f'{expand_ms / splice_ms:6.1f}x, ids {"identical" if identical else "DIFFERENT"}')
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model-name-or-path', type=str, required=True, help='model or LLM of the tokenizer')
+    parser.add_argument('--use-fast-tokenizer', action='store_true')
+    parser.add_argument('--conv-style', type=str, default='phi3-chat')
+    parser.add_argument('--num-image-token', type=int, default=256)
+    parser.add_argument('--num-tiles', type=int, nargs='+', default=[1, 7, 13])
+    parser.add_argument('--num-images', type=int, nargs='+', default=[1, 2])
+    parser.add_argument('--repeats', type=int, default=20)
+    main(parser.parse_args())
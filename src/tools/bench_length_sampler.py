@@ -0,0 +1,96 @@
+"""
+Benchmark the length-grouped sampler on synthetic lengths.
+
+Times the vectorized grouping (`iter_length_grouped_indices`) on each size, the start
+of an iteration resumed halfway through, and, on a smaller size, the previous
+pure-Python grouping, whose output must be identical for the same permutation.
+Each size runs in its own process so that the reported peak RSS belongs to it.
+
+Example:
+    python src/tools/bench_length_sampler.py --sizes 10000000 100000000
+"""
+import argparse
+import resource
+import subprocess
+import sys
+import time
+
+import numpy as np
+import torch
+
+sys.path.append('./src')
+
+
+def legacy_split_to_even_chunks(indices, lengths, num_chunks):
+    if len(indices) % num_chunks != 0:
+        return [indices[i::num_chunks] for i in range(num_chunks)]
+    num_indices_per_chunk = len(indices) // num_chunks
+    chunks = [[] for _ in range(num_chunks)]
+    chunks_lengths = [0 for _ in range(num_chunks)]
+    for index in indices:
+        shortest_chunk = chunks_lengths.index(min(chunks_lengths))
+        chunks[shortest_chunk].append(index)
+        chunks_lengths[shortest_chunk] += lengths[index]
+        if len(chunks[shortest_chunk]) == num_indices_per_chunk:
+            chunks_lengths[shortest_chunk] = float('inf')
+    return chunks
+
+
+def legacy_get_length_grouped_indices(lengths, batch_size, world_size, generator=None):
+    indices = torch.randperm(len(lengths), generator=generator, dtype=torch.int32)
+    megabatch_size = world_size * batch_size
+    megabatches = [indices[i: i + megabatch_size].tolist() for i in range(0, len(lengths), megabatch_size)]
+    megabatches = [sorted(megabatch, key=lambda i: lengths[i], reverse=True) for megabatch in megabatches]
+    megabatches = [legacy_split_to_even_chunks(megabatch, lengths, world_size) for megabatch in megabatches]
+    return [i for megabatch in megabatches for batch in megabatch for i in batch]
+
+
+def run(size, batch_size, world_size, legacy):
+    from earthdial.patch.train_sampler_patch import iter_length_grouped_indices
+
+    lengths = np.random.default_rng(0).integers(16, 4096, size, dtype=np.int32)
+
+    start = time.perf_counter()
+    count = sum(len(block) for block in iter_length_grouped_indices(
+        lengths, batch_size, world_size, generator=torch.Generator().manual_seed(0)))
+    full_time = time.perf_counter() - start
+    assert count == size
+
+    start = time.perf_counter()
+    next(iter_length_grouped_indices(lengths, batch_size, world_size,
+                                     generator=torch.Generator().manual_seed(0), start=size // 2))
+    resume_time = time.perf_counter() - start
+
+    line = f'{size:>11,d} samples: full epoch {full_time:7.2f} s, resume at 50% {resume_time:6.2f} s'
+    if legacy:
+        new = np.concatenate(list(iter_length_grouped_indices(
+            lengths, batch_size, world_size, generator=torch.Generator().manual_seed(0))))
+        start = time.perf_counter()
+        old = legacy_get_length_grouped_indices(lengths.tolist(), batch_size, world_size,
+                                                generator=torch.Generator().manual_seed(0))
+        legacy_time = time.perf_counter() - start
+        assert new.tolist() == old, 'vectorized order differs from the legacy order'
+        line += f', legacy {legacy_time:7.2f} s (identical order)'
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(f'{line}, peak RSS {peak_rss:.0f} MiB')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10_000_000, 100_000_000])
+    parser.add_argument('--legacy-size', type=int, default=1_000_000,
+                        help='size on which the legacy grouping is timed and compared')
+    parser.add_argument('--batch-size', type=int, default=8)
+    parser.add_argument('--world-size', type=int, default=8)
+    parser.add_argument('--run', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--legacy', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run:
+        run(args.run, args.batch_size, args.world_size, args.legacy)
+    else:
+        runs = [(args.legacy_size, True)] + [(size, False) for size in args.sizes]
+        for size, legacy in runs:
+            subprocess.run([sys.executable, __file__, '--run', str(size), '--batch-size', str(args.batch_size),
+                            '--world-size', str(args.world_size)] + (['--legacy'] if legacy else []),
+                           check=True)
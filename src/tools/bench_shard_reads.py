@@ -0,0 +1,128 @@
+"""
+Benchmark per-sample record access on synthetic multi-image shards.
+
+Compares the old access pattern of the shard datasets, which reads
+`raw_data[i][key]` once per key (each read decodes the whole row), with the
+column-projected access that reads the row once and decodes only the image
+and conversation columns used by the sample. With `--batch-size`, it also
+compares per-index projected reads with the batched columnar read of
+`__getitems__`.
+
+Example:
+    python src/tools/bench_shard_reads.py --rows 256 --images 2 --extra-columns 2
+    python src/tools/bench_shard_reads.py --images 1 --extra-columns 0 --bands 12 --batch-size 16
+"""
+import argparse
+import json
+import os
+import tempfile
+import time
+
+import numpy as np
+from datasets import Array3D, Dataset, Features, Image, Value, load_from_disk
+from PIL import Image as PILImage
+
+
+def build_shard(path, rows, images, extra_columns, image_size, bands):
+    rng = np.random.default_rng(0)
+    image_keys = [f'image_{k}' for k in range(images)]
+    extra_keys = [f'extra_{k}' for k in range(extra_columns)]
+    conversations = json.dumps([
+        {'from': 'human', 'value': '<image>\nWhat changed between the two images?'},
+        {'from': 'gpt', 'value': 'A new building was constructed.'},
+    ])
+
+    def gen():
+        for _ in range(rows):
+            row = {'conversations': conversations}
+            for key in image_keys + extra_keys:
+                if bands == 3:
+                    pixels = rng.integers(0, 255, (image_size, image_size, 3), dtype=np.uint8)
+                    row[key] = PILImage.fromarray(pixels)
+                else:
+                    row[key] = rng.random((bands, image_size, image_size), dtype=np.float32)
+            yield row
+
+    if bands == 3:
+        image_feature = Image()
+    else:
+        image_feature = Array3D(shape=(bands, image_size, image_size), dtype='float32')
+    features = Features({'conversations': Value('string'),
+                         **{key: image_feature for key in image_keys + extra_keys}})
+    Dataset.from_generator(gen, features=features).save_to_disk(path)
+    return image_keys
+
+
+def per_key_access(raw_data, image_keys, i):
+    images = [raw_data[i][key] for key in image_keys]
+    conversations = json.loads(raw_data[i]['conversations'])
+    return images, conversations
+
+
+def projected_access(records, image_keys, i):
+    record = records[i]
+    images = [record[key] for key in image_keys]
+    conversations = json.loads(record['conversations'])
+    return images, conversations
+
+
+def batched_access(records, image_keys, indices):
+    columns = records[indices]
+    rows = [{key: values[j] for key, values in columns.items()} for j in range(len(indices))]
+    return [([row[key] for key in image_keys], json.loads(row['conversations'])) for row in rows]
+
+
+def materialize(images):
+    for image in images:
+        if isinstance(image, PILImage.Image):
+            image.load()
+        else:
+            np.asarray(image, dtype=np.float32)
+
+
+def bench(fn, data, image_keys, rows, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for i in range(rows):
+            images, _ = fn(data, image_keys, i)
+            materialize(images)
+        best = min(best, time.perf_counter() - start)
+    return best / rows * 1e3
+
+
+def bench_batched(records, image_keys, rows, batch_size, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for first in range(0, rows, batch_size):
+            for images, _ in batched_access(records, image_keys, list(range(first, min(first + batch_size, rows)))):
+                materialize(images)
+        best = min(best, time.perf_counter() - start)
+    return best / rows * 1e3
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=256)
+    parser.add_argument('--images', type=int, default=2, help='image columns used per sample')
+    parser.add_argument('--extra-columns', type=int, default=2, help='image columns not used by the sample')
+    parser.add_argument('--image-size', type=int, default=448)
+    parser.add_argument('--bands', type=int, default=3, help='3 for RGB images, otherwise float band arrays')
+    parser.add_argument('--batch-size', type=int, default=0, help='also benchmark batched reads of this size')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'shard')
+        image_keys = build_shard(path, args.rows, args.images, args.extra_columns, args.image_size, args.bands)
+        raw_data = load_from_disk(path)
+        records = raw_data.select_columns(image_keys + ['conversations'])
+
+        per_key = bench(per_key_access, raw_data, image_keys, args.rows, args.repeat)
+        projected = bench(projected_access, records, image_keys, args.rows, args.repeat)
+        print(f'per-key access:   {per_key:.3f} ms/sample')
+        print(f'projected access: {projected:.3f} ms/sample ({per_key / projected:.2f}x)')
+        if args.batch_size > 0:
+            batched = bench_batched(records, image_keys, args.rows, args.batch_size, args.repeat)
+            print(f'batched access:   {batched:.3f} ms/sample ({projected / batched:.2f}x vs projected)')
@@ -0,0 +1,78 @@
+"""
+Benchmark the tokenization of rendered conversations with the cached ids of the template prefix.
+
+For every template, the conversations are tokenized whole, as `tokenizer(prompt)`, and with
+`tokenize_prompts`, which reuses the ids of the system prompt cached by `get_template_tokens`.
+The ids must be identical; the time per conversation is reported for both.
+
+Example:
+    python src/tools/bench_template_tokens.py --model-name-or-path pretrained/EarthDial \\
+        --meta-path shell/data/finetune.json --num-samples 200
+"""
+import argparse
+import sys
+import time
+
+sys.path.append('./src')
+
+from check_label_masks import EDGE_CASES, TEMPLATES, shard_conversations  # noqa: E402
+
+
+def per_prompt_ms(fn, prompts, repeats):
+    start = time.perf_counter()
+    for _ in range(repeats):
+        for prompt in prompts:
+            fn(prompt)
+    return (time.perf_counter() - start) / repeats / len(prompts) * 1e3
+
+
+def main(args):
+    from earthdial.conversation import get_conv_template, get_template_tokens, tokenize_prompts
+    from earthdial.train.constants import SPECIAL_TOKENS
+    from earthdial.train.tokenizer import load_tokenizer
+
+    tokenizer = load_tokenizer(args.model_name_or_path, use_fast=args.use_fast_tokenizer, add_eos_token=False)
+    tokenizer.add_tokens(SPECIAL_TOKENS, special_tokens=True)
+
+    sources = list(EDGE_CASES)
+    if args.meta_path:
+        sources.extend(source for _, source, _ in shard_conversations(args.meta_path, args.num_samples, args.seed))
+
+    failed = False
+    for template_name in args.templates:
+        template_tokens = get_template_tokens(template_name, tokenizer)
+        if template_tokens is None:
+            print(f'{template_name:>16}: no cacheable prefix, tokenized whole')
+            continue
+        prompts = []
+        for source in sources:
+            conv = get_conv_template(template_name)
+            for j, sentence in enumerate(source):
+                conv.append_message(conv.roles[j % 2], sentence['value'])
+            prompts.append(conv.get_prompt())
+
+        different = sum(
+            tokenize_prompts(tokenizer, [prompt], template_name)[0] != tokenizer(prompt).input_ids
+            for prompt in prompts
+        )
+        failed |= different > 0
+        whole_ms = per_prompt_ms(lambda prompt: tokenizer(prompt), prompts, args.repeats)
+        cached_ms = per_prompt_ms(lambda prompt: tokenize_prompts(tokenizer, [prompt], template_name),
+                                  prompts, args.repeats)
+        print(f'{template_name:>16}: {len(template_tokens.prefix_ids)} prefix tokens, '
+              f'whole {whole_ms:7.3f} ms, cached prefix {cached_ms:7.3f} ms, {whole_ms / cached_ms:5.2f}x, '
+              f'{different} of {len(prompts)} different')
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model-name-or-path', type=str, required=True, help='model or LLM of the tokenizer')
+    parser.add_argument('--use-fast-tokenizer', action='store_true')
+    parser.add_argument('--templates', type=str, nargs='+', default=TEMPLATES)
+    parser.add_argument('--meta-path', type=str, help='meta file of shard datasets to sample conversations from')
+    parser.add_argument('--num-samples', type=int, default=100, help='conversations sampled per dataset')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeats', type=int, default=5)
+    main(parser.parse_args())
@@ -0,0 +1,53 @@
+"""
+Micro-benchmark of the per-sample transform overhead of the shard datasets.
+
+Measures, per sample:
+  * building the training transform on every call (the previous behavior)
+    versus fetching the cached pipeline of `build_transform`;
+  * `T.Normalize` versus the precomputed in-place `BandNormalize` on a
+    multi-band float tensor.
+
+Example:
+    python src/tools/bench_transforms.py --iters 200 --bands 12 --image-size 448
+"""
+import argparse
+import sys
+import time
+
+import torch
+import torchvision.transforms as T
+
+sys.path.append('./src')
+from earthdial.train.constants import S2_MEAN, S2_STD  # noqa: E402
+from earthdial.train.dataset import BandNormalize, build_transform  # noqa: E402
+
+
+def timeit(fn, iters):
+    start = time.perf_counter()
+    for _ in range(iters):
+        fn()
+    return (time.perf_counter() - start) / iters * 1e6
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--iters', type=int, default=200)
+    parser.add_argument('--bands', type=int, default=12)
+    parser.add_argument('--image-size', type=int, default=448)
+    args = parser.parse_args()
+
+    uncached = timeit(lambda: build_transform.__wrapped__(is_train=True, input_size=args.image_size), args.iters)
+    cached = timeit(lambda: build_transform(is_train=True, input_size=args.image_size), args.iters)
+    print(f'build training transform: {uncached:.1f} us/sample, cached: {cached:.2f} us/sample')
+
+    mean, std = S2_MEAN[:args.bands], S2_STD[:args.bands]
+    bands = torch.rand(args.bands, args.image_size, args.image_size) * 4000
+    normalize = T.Normalize(mean=mean, std=std)
+    band_normalize = BandNormalize(mean, std)
+    baseline = timeit(lambda: normalize(bands.clone()), args.iters)
+    in_place = timeit(lambda: band_normalize(bands.clone()), args.iters)
+    copy_only = timeit(lambda: bands.clone(), args.iters)
+    print(f'T.Normalize:   {baseline - copy_only:.1f} us/sample')
+    print(f'BandNormalize: {in_place - copy_only:.1f} us/sample')
+    expected = normalize(bands.clone())
+    print(f'max abs difference: {(band_normalize(bands.clone()) - expected).abs().max().item():.2e}')
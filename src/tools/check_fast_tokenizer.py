@@ -0,0 +1,127 @@
+"""
+Check the fast tokenizer of an LLM against its slow sentencepiece tokenizer.
+
+Both are loaded with `load_tokenizer` and given the training `SPECIAL_TOKENS`. They must agree on:
+
+- special tokens: the id of every added token, alone and next to text, spaces and newlines;
+- prompts: the ids of every conversation rendered with every template, as the chat prompt
+  and with its image placeholders;
+- samples: `input_ids`, `labels` and `attention_mask` of `preprocess_*`, unpadded and padded
+  to the maximum length, so that the padding side is checked too;
+- decoding: the text decoded from the ids of every answer.
+
+The conversations are the edge cases of `check_label_masks.py` and, with `--meta-path`,
+samples of the shard datasets of a meta file. Any difference fails the check.
+
+Example:
+    python src/tools/check_fast_tokenizer.py --model-name-or-path pretrained/EarthDial \\
+        --meta-path shell/data/finetune.json --num-samples 200
+"""
+import argparse
+import sys
+from copy import deepcopy
+
+sys.path.append('./src')
+
+from check_label_masks import EDGE_CASES, TEMPLATES, shard_conversations  # noqa: E402
+
+CONTEXTS = ['{}', 'a{}b', ' {} ', '\n{}\n', '{}{}', 'image {}\n']
+
+
+def load(path, use_fast, max_length):
+    from earthdial.train.constants import SPECIAL_TOKENS
+    from earthdial.train.tokenizer import check_special_tokens, load_tokenizer
+
+    tokenizer = load_tokenizer(path, use_fast=use_fast, add_eos_token=False)
+    tokenizer.add_tokens(SPECIAL_TOKENS, special_tokens=True)
+    check_special_tokens(tokenizer)
+    tokenizer.model_max_length = max_length
+    return tokenizer
+
+
+def compare(name, slow, fast, failures):
+    if slow != fast:
+        failures.append(name)
+
+
+def check_special_tokens(slow, fast, failures):
+    added = sorted(set(slow.get_added_vocab()) | set(fast.get_added_vocab()))
+    for token in added:
+        compare(f'id of {token!r}', slow.convert_tokens_to_ids(token), fast.convert_tokens_to_ids(token), failures)
+        for context in CONTEXTS:
+            text = context.format(token, token)
+            compare(f'ids of {text!r}', slow(text).input_ids, fast(text).input_ids, failures)
+    return len(added)
+
+
+def check_conversation(template_name, source, num_image, slow, fast, failures):
+    from earthdial.conversation import get_conv_template
+    from earthdial.train.image_tokens import insert_image_placeholders
+    from earthdial.train.pretokenize import get_preprocess_function
+
+    conv = get_conv_template(template_name)
+    for j, sentence in enumerate(source):
+        conv.append_message(conv.roles[j % 2], sentence['value'])
+    prompt = conv.get_prompt()
+    for text in (prompt, insert_image_placeholders(prompt, num_image)):
+        compare(f'{template_name} prompt ids', slow(text).input_ids, fast(text).input_ids, failures)
+
+    preprocess_function = get_preprocess_function(template_name)
+    for group_by_length in (True, False):
+        samples = [
+            preprocess_function(
+                template_name, [deepcopy(source)], tokenizer, [4] * num_image,
+                group_by_length=group_by_length, num_image=num_image,
+            )
+            for tokenizer in (slow, fast)
+        ]
+        for key in ('input_ids', 'labels', 'attention_mask'):
+            compare(f'{template_name} {key} (group_by_length={group_by_length})',
+                    samples[0][key].tolist(), samples[1][key].tolist(), failures)
+
+    for sentence in source[1::2]:
+        ids = slow(sentence['value'], add_special_tokens=False).input_ids
+        compare(f'{template_name} decoded answer',
+                slow.decode(ids, skip_special_tokens=True), fast.decode(ids, skip_special_tokens=True), failures)
+
+
+def main(args):
+    import contextlib
+    import io
+
+    slow = load(args.model_name_or_path, False, args.max_length)
+    fast = load(args.model_name_or_path, True, args.max_length)
+    print(f'slow: {type(slow).__name__}, fast: {type(fast).__name__}, '
+          f'padding side: {slow.padding_side}/{fast.padding_side}')
+
+    failures = []
+    num_tokens = check_special_tokens(slow, fast, failures)
+    print(f'{"special tokens":>16}: {num_tokens} tokens x {len(CONTEXTS)} contexts, {len(failures)} differences')
+
+    conversations = [('edge case', source, source[0]['value'].count('<image>')) for source in EDGE_CASES]
+    if args.meta_path:
+        conversations.extend(shard_conversations(args.meta_path, args.num_samples, args.seed))
+    for template_name in args.templates:
+        before = len(failures)
+        for _, source, num_image in conversations:
+            # The turn-by-turn masking prints its mismatch warnings for both tokenizers alike
+            with contextlib.redirect_stdout(io.StringIO()):
+                check_conversation(template_name, source, num_image, slow, fast, failures)
+        print(f'{template_name:>16}: {len(conversations)} conversations, {len(failures) - before} differences')
+
+    for name in list(dict.fromkeys(failures))[:args.max_report]:
+        print(f'  differs: {name}')
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model-name-or-path', type=str, required=True, help='model or LLM of the tokenizers')
+    parser.add_argument('--templates', type=str, nargs='+', default=TEMPLATES)
+    parser.add_argument('--meta-path', type=str, help='meta file of shard datasets to sample conversations from')
+    parser.add_argument('--num-samples', type=int, default=100, help='conversations sampled per dataset')
+    parser.add_argument('--max-length', type=int, default=1024, help='truncation length of the samples')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--max-report', type=int, default=20, help='differences listed at the end')
+    main(parser.parse_args())
@@ -0,0 +1,158 @@
+"""
+Check that single-pass label masking matches the turn-by-turn masking of `preprocess_*`.
+
+`preprocess_*` mask the labels from the token ids of the conversation itself, with the
+assistant header and closing tokens of the template (`mask_assistant_spans`). The former
+path re-tokenizes every turn and instruction to find the same boundaries. Every conversation
+is masked both ways, for each template, and the labels are compared:
+
+- identical: both paths give the same labels;
+- legacy mismatch: the turn-by-turn path hit a "tokenization mismatch" and ignored the whole
+  sample; reported with the number of answers the single-pass path kept;
+- different: the labels differ otherwise, which fails the check.
+
+The conversations are built-in edge cases (multi-turn, whitespace, images, truncation) and,
+with `--meta-path`, samples of the shard datasets of a meta file. Every conversation is also
+truncated at `--truncate-fractions` of its own length, so the cut falls inside instructions,
+answers and image spans of every template (the phi3 BOS and `<|endoftext|>` masking included);
+the truncated samples are reported on their own line. The turn-by-turn path does not check
+the lengths of a truncated sample, so a cut of a conversation that is a legacy mismatch in
+full is counted as a legacy mismatch too.
+
+Example:
+    python src/tools/check_label_masks.py --model-name-or-path pretrained/EarthDial \\
+        --meta-path shell/data/finetune.json --num-samples 200
+"""
+import argparse
+import contextlib
+import io
+import json
+import sys
+from copy import deepcopy
+
+import numpy as np
+
+sys.path.append('./src')
+
+TEMPLATES = ['internvl_zh', 'Hermes-2', 'internlm2-chat', 'phi3-chat']
+
+EDGE_CASES = [
+    [{'from': 'human', 'value': '<image>\nDescribe the image.'},
+     {'from': 'gpt', 'value': 'A harbor with several ships.'}],
+    [{'from': 'human', 'value': '<image>\nHow many buildings?'}, {'from': 'gpt', 'value': '12'},
+     {'from': 'human', 'value': 'And roads?'}, {'from': 'gpt', 'value': 'Three roads cross the scene.'},
+     {'from': 'human', 'value': 'Classify the land cover.'}, {'from': 'gpt', 'value': 'Urban'}],
+    # Whitespace and newlines at the turn boundaries
+    [{'from': 'human', 'value': '<image>\n  Where is the airport? '},
+     {'from': 'gpt', 'value': '\n[[12, 40, 310, 288]]\n'}],
+    [{'from': 'human', 'value': '<image>\nList the objects.\n\n'},
+     {'from': 'gpt', 'value': 'ship\nship\n  plane'}],
+    # Non-Latin text and grounding tokens
+    [{'from': 'human', 'value': '<image>\n描述这张图片。'}, {'from': 'gpt', 'value': '一个港口。'}],
+    [{'from': 'human', 'value': '<image>\n[refer] the red roof'},
+     {'from': 'gpt', 'value': '<ref>the red roof</ref><box>[[100, 200, 300, 400]]</box>'}],
+    # A very long answer, truncated by --max-length
+    [{'from': 'human', 'value': '<image>\nCaption the scene in detail.'},
+     {'from': 'gpt', 'value': ' '.join(['The field is irrigated.'] * 400)}],
+    # Long middle answer, so a cut can drop the later turns
+    [{'from': 'human', 'value': '<image>\nWhat crops are grown?'},
+     {'from': 'gpt', 'value': ' '.join(['Rice and wheat alternate by season.'] * 20)},
+     {'from': 'human', 'value': 'Is there water?'}, {'from': 'gpt', 'value': 'Yes, a canal.'}],
+]
+
+
+def shard_conversations(meta_path, num_samples, seed):
+    """Sample conversations of every shard dataset of a meta file."""
+    from datasets import load_from_disk
+
+    from earthdial.train.pretokenize import conversation_source
+
+    with open(meta_path) as f:
+        ds_collections = json.load(f)
+    rng = np.random.default_rng(seed)
+    for ds_name, meta in ds_collections.items():
+        raw_data = load_from_disk(meta['annotation'])
+        indices = rng.choice(len(raw_data), min(num_samples, len(raw_data)), replace=False)
+        multi_image = str(ds_name).strip().startswith('Change')
+        for row in raw_data.select_columns([meta['conversation']])[indices.tolist()][meta['conversation']]:
+            source = conversation_source(row, ds_name, multi_image)
+            if source:
+                yield ds_name, source, len(meta['image_key'].split(',')) if multi_image else 1
+
+
+def mask(template_name, source, tokenizer, num_image, single_pass, max_length):
+    from earthdial.train import dataset
+    from earthdial.train.pretokenize import get_preprocess_function
+
+    tokenizer.model_max_length = max_length
+    boundaries = dataset.assistant_boundaries
+    if not single_pass:
+        dataset.assistant_boundaries = lambda tokenizer, template_name: None
+    try:
+        # The turn-by-turn path prints its mismatch warnings
+        with contextlib.redirect_stdout(io.StringIO()):
+            ret = get_preprocess_function(template_name)(
+                template_name, [deepcopy(source)], tokenizer, [4] * num_image,
+                group_by_length=True, num_image=num_image,
+            )
+    finally:
+        dataset.assistant_boundaries = boundaries
+    return ret['labels'][0]
+
+
+def main(args):
+    from earthdial.train.constants import SPECIAL_TOKENS
+    from earthdial.train.dataset import IGNORE_TOKEN_ID, assistant_boundaries
+    from earthdial.train.tokenizer import load_tokenizer
+
+    tokenizer = load_tokenizer(args.model_name_or_path, use_fast=args.use_fast_tokenizer, add_eos_token=False)
+    tokenizer.add_tokens(SPECIAL_TOKENS, special_tokens=True)
+
+    conversations = [('edge case', source, source[0]['value'].count('<image>')) for source in EDGE_CASES]
+    if args.meta_path:
+        conversations.extend(shard_conversations(args.meta_path, args.num_samples, args.seed))
+
+    failed = False
+    for template_name in args.templates:
+        if assistant_boundaries(tokenizer, template_name) is None:
+            print(f'{template_name:>16}: no single-token answer boundaries, masked turn by turn')
+            continue
+        counts = {kind: dict(identical=0, mismatches=0, recovered=0, different=[]) for kind in ('full', 'truncated')}
+        for ds_name, source, num_image in conversations:
+            full_legacy = mask(template_name, source, tokenizer, num_image, False, args.max_length)
+            max_lengths = [(args.max_length, 'full')]
+            max_lengths += [(max(2, int(len(full_legacy) * fraction)), 'truncated')
+                            for fraction in args.truncate_fractions]
+            for max_length, kind in max_lengths:
+                labels = mask(template_name, source, tokenizer, num_image, True, max_length)
+                legacy = mask(template_name, source, tokenizer, num_image, False, max_length)
+                count = counts[kind]
+                if labels.equal(legacy):
+                    count['identical'] += 1
+                elif legacy.eq(IGNORE_TOKEN_ID).all() or full_legacy.eq(IGNORE_TOKEN_ID).all():
+                    count['mismatches'] += 1
+                    count['recovered'] += int(labels.ne(IGNORE_TOKEN_ID).any())
+                else:
+                    count['different'].append(f'{ds_name} at {max_length} tokens')
+        for kind, count in counts.items():
+            different = count['different']
+            failed |= bool(different)
+            print(f'{template_name:>16} ({kind:>9}): {count["identical"]} identical, {count["mismatches"]} legacy '
+                  f'mismatches ({count["recovered"]} with answers kept), {len(different)} different'
+                  + (f' (first in {different[0]})' if different else ''))
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model-name-or-path', type=str, required=True, help='model or LLM of the tokenizer')
+    parser.add_argument('--use-fast-tokenizer', action='store_true')
+    parser.add_argument('--templates', type=str, nargs='+', default=TEMPLATES)
+    parser.add_argument('--meta-path', type=str, help='meta file of shard datasets to sample conversations from')
+    parser.add_argument('--num-samples', type=int, default=100, help='conversations sampled per dataset')
+    parser.add_argument('--max-length', type=int, default=1024, help='truncation length of the conversations')
+    parser.add_argument('--truncate-fractions', type=float, nargs='*', default=[0.1, 0.3, 0.5, 0.7, 0.9],
+                        help='also truncate every conversation at these fractions of its length')
+    parser.add_argument('--seed', type=int, default=0)
+    main(parser.parse_args())
@@ -0,0 +1,91 @@
+"""
+Check that packed batches reach the model through the Trainer's collator path.
+
+Synthetic samples are packed by `PackedDataset` and read through the dataloader of a
+`Trainer` whose model has the `forward` of `InternVLChatModel`. With the default
+`remove_unused_columns=True`, the Trainer drops every key of the samples that is not an
+argument of `forward` before `packed_data_collator` runs. Every batch must then have:
+
+- only arguments of `forward`;
+- an attention mask that is the `cu_seqlens` of the samples of its packs;
+- position ids that restart at every sample, and the first label of every sample ignored.
+
+Example:
+    python src/tools/check_packed_batch.py --num-samples 64 --max-packed-tokens 512
+"""
+import argparse
+import inspect
+import sys
+import tempfile
+
+import numpy as np
+
+sys.path.append('./src')
+
+
+def main(args):
+    import torch
+    from torch import nn
+    from transformers import Trainer, TrainingArguments
+
+    from earthdial.model.internvl_chat import InternVLChatModel
+    from earthdial.patch import packed_data_collator
+    from earthdial.train.dataset import IGNORE_TOKEN_ID
+    from earthdial.train.packed_dataset import PackedDataset
+
+    rng = np.random.default_rng(args.seed)
+    lengths = rng.integers(8, args.max_packed_tokens // 2, args.num_samples)
+    num_tiles = rng.integers(1, 4, args.num_samples)
+    samples = [
+        dict(
+            input_ids=torch.randint(3, 1000, (length,)),
+            labels=torch.randint(3, 1000, (length,)),
+            attention_mask=torch.ones(length, dtype=torch.bool),
+            pixel_values=torch.zeros(tiles, 3, 4, 4),
+            image_flags=torch.ones(tiles, dtype=torch.long),
+            image_modality=torch.zeros(tiles, dtype=torch.long),
+        )
+        for length, tiles in zip(lengths.tolist(), num_tiles.tolist())
+    ]
+    dataset = PackedDataset(samples, lengths, args.max_packed_tokens, seed=args.seed)
+
+    class Model(nn.Module):
+        # The Trainer keeps the columns named by the signature of `forward`
+        forward = InternVLChatModel.forward
+
+        def __init__(self):
+            super().__init__()
+            self.weight = nn.Parameter(torch.zeros(1))
+
+    with tempfile.TemporaryDirectory() as output_dir:
+        training_args = TrainingArguments(
+            output_dir=output_dir, per_device_train_batch_size=args.batch_size, use_cpu=True,
+            report_to=[], dataloader_num_workers=0,
+        )
+        trainer = Trainer(model=Model(), args=training_args, train_dataset=dataset, data_collator=packed_data_collator)
+        assert training_args.remove_unused_columns
+        forward_args = set(inspect.signature(InternVLChatModel.forward).parameters)
+        num_batches, num_samples = 0, 0
+        for batch in trainer.get_train_dataloader():
+            assert set(batch) <= forward_args, f'not arguments of forward: {set(batch) - forward_args}'
+            cu_seqlens = batch['attention_mask'][0].long()
+            position_ids = batch['position_ids'][0]
+            sample_lengths = (cu_seqlens[1:] - cu_seqlens[:-1]).tolist()
+            assert cu_seqlens[-1] == batch['input_ids'].shape[1] == position_ids.shape[0]
+            expected = torch.cat([torch.arange(length) for length in sample_lengths])
+            assert position_ids.equal(expected), 'the cu_seqlens do not match the position ids'
+            assert batch['labels'][0, cu_seqlens[:-1]].eq(IGNORE_TOKEN_ID).all()
+            assert batch['pixel_values'].shape[0] == batch['image_flags'].shape[0]
+            num_batches += 1
+            num_samples += len(sample_lengths)
+    assert num_samples == args.num_samples, f'{num_samples} samples read of {args.num_samples}'
+    print(f'{num_batches} packed batches of {len(dataset)} packs and {num_samples} samples: ok')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--num-samples', type=int, default=64)
+    parser.add_argument('--max-packed-tokens', type=int, default=512)
+    parser.add_argument('--batch-size', type=int, default=2, help='packs per batch')
+    parser.add_argument('--seed', type=int, default=0)
+    main(parser.parse_args())
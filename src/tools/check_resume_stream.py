@@ -0,0 +1,155 @@
+"""
+Check that resuming from a checkpoint continues the training data stream exactly.
+
+For every sampler of `train_sampler_patch`, the batches of each rank are drawn over
+several epochs without interruption, then again from a fresh sampler positioned at a
+checkpoint step by `position_sampler`, as `DataStateCallback` does on resume. The
+resumed batches must be identical to the rest of the uninterrupted run, on every rank
+and at every tested step. Sample samplers are dealt to the ranks like the Trainer's
+dataloader does (per-device batches, round-robin, incomplete rounds dropped); the token
+budget batch sampler deals its own batches.
+
+Epochs must keep the same number of batches for the Trainer to count them from the
+step; modality groups are therefore per dataset, as in the training datasets.
+
+Example:
+    python src/tools/check_resume_stream.py --num-samples 20000 --world-size 4 --epochs 3
+"""
+import argparse
+import sys
+
+import numpy as np
+
+sys.path.append('./src')
+
+
+def rank_batches(sampler, batch_size, world_size, rank):
+    """The per-device batches of `rank` in one iteration of a sample sampler."""
+    indices = np.fromiter(iter(sampler), dtype=np.int64)
+    num_rounds = len(indices) // (batch_size * world_size)
+    batches = indices[:num_rounds * batch_size * world_size].reshape(num_rounds * world_size, batch_size)
+    return [batch.tolist() for batch in batches[rank::world_size]]
+
+
+def run(make_sampler, batch_sampler, args, steps):
+    from earthdial.train.data_state import position_sampler
+
+    def epoch_batches(sampler, rank):
+        if batch_sampler:
+            return [list(batch) for batch in sampler]
+        return rank_batches(sampler, args.batch_size, args.world_size, rank)
+
+    samples_per_batch = 1 if batch_sampler else args.batch_size * args.world_size
+    for rank in range(args.world_size):
+        sampler = make_sampler(rank)
+        num_batches = len(sampler) if batch_sampler else len(sampler) // samples_per_batch
+        expected = []
+        for epoch in range(args.epochs):
+            sampler.set_epoch(epoch)
+            expected.extend(epoch_batches(sampler, rank))
+
+        steps_per_epoch = max(num_batches // args.gradient_accumulation_steps, 1)
+        for global_step in steps:
+            if global_step >= steps_per_epoch * args.epochs:
+                continue
+            sampler = make_sampler(rank)
+            first_epoch, _ = position_sampler(
+                sampler, global_step, num_batches, args.gradient_accumulation_steps, samples_per_batch
+            )
+            resumed = []
+            # The Trainer sets the epoch again before iterating; the position must survive it
+            for epoch in range(first_epoch, args.epochs):
+                sampler.set_epoch(epoch)
+                resumed.extend(epoch_batches(sampler, rank))
+            # The batches at the end of an epoch that do not fill an optimizer step are consumed too
+            step = global_step % steps_per_epoch
+            consumed = first_epoch * num_batches + step * args.gradient_accumulation_steps
+            if resumed != expected[consumed:]:
+                return f'rank {rank} diverges when resumed at step {global_step}'
+    return None
+
+
+def main(args):
+    import torch
+
+    from earthdial.patch.train_sampler_patch import (LengthGroupedSampler, MixtureSampler,
+                                                     ModalityGroupedSampler, SeededRandomSampler,
+                                                     TokenBudgetBatchSampler)
+
+    rng = np.random.default_rng(0)
+    lengths = rng.integers(64, 4096, args.num_samples).astype(np.int32)
+    tiles = rng.integers(1, 13, args.num_samples)
+    costs = (lengths + 80 * tiles).astype(np.int32)
+    # Three datasets, each of one modality group as in `ConcatDataset.modality_groups`; the
+    # mixture repeats the first and subsamples the second
+    sizes = [args.num_samples // 2, args.num_samples // 4, args.num_samples - args.num_samples * 3 // 4]
+    modalities = np.repeat(np.arange(len(sizes)), sizes)
+    mixture_samples = [sizes[0] * 3 // 2, sizes[1] // 2, sizes[2]]
+    seed = args.seed
+
+    samplers = {
+        'SeededRandomSampler': (lambda rank: SeededRandomSampler(args.num_samples, seed=seed), False),
+        'LengthGroupedSampler': (lambda rank: LengthGroupedSampler(
+            args.batch_size, world_size=args.world_size, lengths=torch.from_numpy(lengths), seed=seed), False),
+        'LengthGroupedSampler (mixture)': (lambda rank: LengthGroupedSampler(
+            args.batch_size, world_size=args.world_size, lengths=torch.from_numpy(lengths), seed=seed,
+            mixture=MixtureSampler(sizes, mixture_samples, seed=seed)), False),
+        'LengthGroupedSampler (costs)': (lambda rank: LengthGroupedSampler(
+            args.batch_size, world_size=args.world_size, lengths=torch.from_numpy(lengths), seed=seed,
+            costs=costs), False),
+        'MixtureSampler': (lambda rank: MixtureSampler(sizes, mixture_samples, seed=seed), False),
+        'ModalityGroupedSampler': (lambda rank: ModalityGroupedSampler(
+            modalities, args.batch_size, args.world_size, lengths=lengths, seed=seed), False),
+        'ModalityGroupedSampler (mixture)': (lambda rank: ModalityGroupedSampler(
+            modalities, args.batch_size, args.world_size,
+            mixture=MixtureSampler(sizes, mixture_samples, seed=seed), seed=seed), False),
+        'TokenBudgetBatchSampler': (lambda rank: TokenBudgetBatchSampler(
+            lengths, tiles, max_tokens=args.max_batch_tokens, max_tiles=args.max_batch_tiles,
+            world_size=args.world_size, rank=rank, seed=seed, modalities=modalities), True),
+        'TokenBudgetBatchSampler (mixture)': (lambda rank: TokenBudgetBatchSampler(
+            lengths, tiles, max_tokens=args.max_batch_tokens, max_tiles=args.max_batch_tiles,
+            world_size=args.world_size, rank=rank, seed=seed, modalities=modalities,
+            mixture=MixtureSampler(sizes, mixture_samples, seed=seed)), True),
+    }
+    failed = False
+    for name, (make_sampler, batch_sampler) in samplers.items():
+        error = run(make_sampler, batch_sampler, args, args.steps)
+        failed |= error is not None
+        print(f'{name:>34}: {error or "identical"}')
+
+    # The costs only split the megabatches between the ranks: every batch is still sorted by length
+    order = np.asarray(list(LengthGroupedSampler(args.batch_size, world_size=args.world_size,
+                                                 lengths=torch.from_numpy(lengths), seed=seed, costs=costs)))
+    num_batches = len(order) // args.batch_size
+    batch_lengths = lengths[order[:num_batches * args.batch_size]].reshape(num_batches, -1)
+    if (np.diff(batch_lengths, axis=1) > 0).any():
+        print('LengthGroupedSampler (costs) does not sort the batches by length')
+        failed = True
+
+    # Grouping by length reorders the samples of the mixture but keeps them all
+    sampler = LengthGroupedSampler(args.batch_size, world_size=args.world_size, lengths=torch.from_numpy(lengths),
+                                   seed=seed, mixture=MixtureSampler(sizes, mixture_samples, seed=seed))
+    mixture = MixtureSampler(sizes, mixture_samples, seed=seed)
+    for epoch in range(args.epochs):
+        sampler.set_epoch(epoch)
+        mixture.set_epoch(epoch)
+        if sorted(sampler) != sorted(mixture.plan().tolist()):
+            print(f'LengthGroupedSampler (mixture) does not draw the samples of the mixture in epoch {epoch}')
+            failed = True
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--num-samples', type=int, default=20000)
+    parser.add_argument('--batch-size', type=int, default=4)
+    parser.add_argument('--world-size', type=int, default=4)
+    parser.add_argument('--gradient-accumulation-steps', type=int, default=2)
+    parser.add_argument('--epochs', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--max-batch-tokens', type=int, default=16384)
+    parser.add_argument('--max-batch-tiles', type=int, default=48)
+    parser.add_argument('--steps', type=int, nargs='+', default=[0, 1, 37, 311, 625, 1000, 1500],
+                        help='checkpoint steps to resume from')
+    main(parser.parse_args())
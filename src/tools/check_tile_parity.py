@@ -0,0 +1,99 @@
+"""
+Compare the tensor tile engine with the PIL `dynamic_preprocess` + `build_transform` path.
+
+Images are tiled both ways; the script reports the tile counts, the max absolute difference
+of the normalized pixels (in units of 1/255 of the un-normalized range) and the time per image.
+The images are the files given on the command line, e.g. the demo gallery, or random RGB
+images of various aspect ratios.
+
+`tile_image` converts non-RGB images to RGB, as the eval loaders and the demo did before
+tiling. Every image is therefore also compared as grayscale, against the PIL path of its RGB
+conversion. The shard datasets keep grayscale images out of the tile engine (see
+`use_tile_engine`), so training still sees their single channel.
+
+With `--train`, the training transform is compared, with its random JPEG degradation of every
+tile. The tile engine is given the `RandomChoice` of the transform as its `tile_transform`, and
+both paths start from the same seed, so every tile is degraded with the same quality on both
+and the tiles must match.
+
+Example:
+    python src/tools/check_tile_parity.py --images 50 --max-num 6 --use-thumbnail
+    python src/tools/check_tile_parity.py demo/gallery/*.jpg demo/gallery/*.tif --use-thumbnail
+    python src/tools/check_tile_parity.py demo/gallery/*.jpg --use-thumbnail --train
+"""
+import argparse
+import random
+import sys
+import time
+
+import numpy as np
+import torch
+from PIL import Image
+
+sys.path.append('./src')
+from earthdial.train.constants import IMAGENET_STD  # noqa: E402
+from earthdial.train.dataset import build_transform, dynamic_preprocess  # noqa: E402
+from earthdial.train.tiling import tile_image  # noqa: E402
+
+
+def synthetic_images(num_images):
+    rng = np.random.default_rng(0)
+    for i in range(num_images):
+        width, height = rng.integers(200, 1600, size=2)
+        # Smooth random content, closer to natural images than white noise
+        pixels = rng.integers(0, 255, (height // 16 + 1, width // 16 + 1, 3), dtype=np.uint8)
+        yield f'random {i}', Image.fromarray(pixels).resize((int(width), int(height)), Image.BILINEAR)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('paths', nargs='*', help='image files; random images if none')
+    parser.add_argument('--images', type=int, default=50, help='random images, without paths')
+    parser.add_argument('--image-size', type=int, default=448)
+    parser.add_argument('--max-num', type=int, default=6)
+    parser.add_argument('--use-thumbnail', action='store_true')
+    parser.add_argument('--tolerance', type=float, default=2.0, help='max allowed difference, in 1/255 steps')
+    parser.add_argument('--train', action='store_true', help='compare the training transform, with JPEG degradation')
+    args = parser.parse_args()
+
+    if args.paths:
+        images = ((path, Image.open(path).convert('RGB')) for path in args.paths)
+    else:
+        images = synthetic_images(args.images)
+    transform = build_transform(is_train=args.train, input_size=args.image_size)
+    # The per-tile JPEG degradation of the training transform
+    tile_transform = transform.transforms[1] if args.train else None
+    std = torch.tensor(IMAGENET_STD).view(1, -1, 1, 1)
+    pil_time, tile_time, worst, num_images = 0.0, 0.0, {'RGB': 0.0, 'L': 0.0}, 0
+    for image_idx, (name, rgb_image) in enumerate(images):
+        for mode in ('RGB', 'L'):
+            image = rgb_image if mode == 'RGB' else rgb_image.convert('L')
+            reference_image = image.convert('RGB')
+
+            random.seed(image_idx)
+            start = time.perf_counter()
+            tiles = dynamic_preprocess(reference_image, max_num=args.max_num, image_size=args.image_size,
+                                       use_thumbnail=args.use_thumbnail)
+            reference = torch.stack([transform(tile) for tile in tiles])
+            pil_time += time.perf_counter() - start
+
+            random.seed(image_idx)
+            start = time.perf_counter()
+            pixel_values = tile_image(image, max_num=args.max_num, image_size=args.image_size,
+                                      use_thumbnail=args.use_thumbnail, tile_transform=tile_transform)
+            tile_time += time.perf_counter() - start
+
+            assert pixel_values.shape == reference.shape, (name, mode, pixel_values.shape, reference.shape)
+            # Rounded off the float error of the normalization, to whole 1/255 steps
+            diff = round(((pixel_values - reference) * std * 255).abs().max().item(), 3)
+            worst[mode] = max(worst[mode], diff)
+            if args.paths:
+                print(f'{name} ({mode}, {image.size[0]}x{image.size[1]}): {len(tiles)} tiles, '
+                      f'max abs difference {diff:.3f} / 255')
+        num_images += 1
+
+    print(f'PIL path:    {pil_time / (2 * num_images) * 1e3:.2f} ms/image')
+    print(f'tile engine: {tile_time / (2 * num_images) * 1e3:.2f} ms/image')
+    print(f'max abs difference: RGB {worst["RGB"]:.3f} / 255, grayscale {worst["L"]:.3f} / 255')
+    if max(worst.values()) > args.tolerance:
+        sys.exit(f'difference above tolerance {args.tolerance}')
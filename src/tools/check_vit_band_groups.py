@@ -0,0 +1,171 @@
+"""
+Check the batched band-group ViT path of multi-band images against the per-group loop.
+
+A tiny `InternVLChatModel` (a one-layer `InternVisionConfig` and a small Llama) is built on the
+CPU. For every band count and fusion mode, `sequential_vit_features` is compared with the
+reference loop it replaced, which ran every 3-band group of every sample through the ViT on
+its own, with and without `vit_chunk_size`. `extract_feature` is also run with
+`config.vit_chunk_size` set, to check that the chunked path is reached and matches the
+unchunked one. Last, a batch of 3-channel tiles tagged with both modalities must give every
+tile the features of its own modality, as batches of one modality do, and the RGB tiles a
+ViT gradient (the band-group path runs without one).
+
+Example:
+    python src/tools/check_vit_band_groups.py --bands 3 4 12 13 --batch-size 3 --vit-chunk-sizes 1 2 5
+"""
+import argparse
+import math
+import sys
+
+sys.path.append('./src')
+
+MODES = ['average', 'max', 'sum', 'bilinear']
+
+
+def legacy_bilinear_interpolate_and_concat(emds, final_size=(1024, 1024)):
+    # The fusion of a list of [1, T, D] group features of one sample, as before the batched path
+    import torch
+    import torch.nn.functional as F
+
+    num_channels = len(emds)
+    if num_channels == 1:
+        return F.interpolate(emds[0].unsqueeze(0), size=final_size, mode='bilinear', align_corners=False).squeeze(0)
+    num_rows = math.ceil(math.sqrt(num_channels))
+    num_cols = math.ceil(num_channels / num_rows)
+    adjusted_heights = [final_size[0] // num_rows] * num_rows
+    adjusted_widths = [final_size[1] // num_cols] * num_cols
+    for i in range(final_size[0] - adjusted_heights[0] * num_rows):
+        adjusted_heights[i] += 1
+    for j in range(final_size[1] - adjusted_widths[0] * num_cols):
+        adjusted_widths[j] += 1
+    resized_emds = [
+        F.interpolate(emd.unsqueeze(0), size=(adjusted_heights[i // num_cols], adjusted_widths[i % num_cols]),
+                      mode='bilinear', align_corners=False)
+        for i, emd in enumerate(emds)
+    ]
+    grid_rows = [torch.cat(resized_emds[row * num_cols:(row + 1) * num_cols], dim=-1) for row in range(num_rows)]
+    max_width = max(row.shape[-1] for row in grid_rows)
+    grid_rows = [F.pad(row, (0, max_width - row.shape[-1])) for row in grid_rows]
+    return torch.cat(grid_rows, dim=-2).squeeze(0)
+
+
+def legacy_sequential_vit_features(model, pixel_values, mm_spatial_pool_mode):
+    # One ViT call per 3-band group of every sample, as before the batched path
+    import torch
+
+    batch_size, num_channels = pixel_values.shape[:2]
+    param = next(model.vision_model.parameters())
+    vit_outputs = []
+    for batch_idx in range(batch_size):
+        single_vit_outputs = []
+        for i in range(0, num_channels, 3):
+            subset = pixel_values[batch_idx, i:i + 3]
+            if subset.shape[0] < 3:
+                subset = torch.cat([subset] + [subset[-1:]] * (3 - subset.shape[0]), dim=0)
+            subset = subset.unsqueeze(0).to(device=param.device, dtype=param.dtype)
+            single_vit_outputs.append(model.forward_vision(subset))
+        if mm_spatial_pool_mode == 'average':
+            pooled_output = torch.stack(single_vit_outputs, dim=0).mean(dim=0)
+        elif mm_spatial_pool_mode == 'max':
+            # The loop returned the (values, indices) tuple of `max`; its values are compared
+            pooled_output = torch.stack(single_vit_outputs, dim=0).max(dim=0).values
+        elif mm_spatial_pool_mode == 'sum':
+            pooled_output = torch.stack(single_vit_outputs, dim=0).sum(dim=0)
+        else:
+            pooled_output = legacy_bilinear_interpolate_and_concat(single_vit_outputs)
+        vit_outputs.append(pooled_output)
+    vision_embeds = torch.stack(vit_outputs, dim=0).squeeze(0)
+    if vision_embeds.size(0) > 1:
+        vision_embeds = vision_embeds.squeeze(1)
+    return vision_embeds
+
+
+def tiny_model(args):
+    from earthdial.model.internvl_chat import InternVLChatConfig, InternVLChatModel
+
+    # bilinear fusion always builds a 1024 x 1024 map, so the ViT is 1024 wide for extract_feature
+    vision_config = dict(
+        image_size=args.image_size, patch_size=14, hidden_size=1024, num_attention_heads=8,
+        intermediate_size=256, num_hidden_layers=1, use_flash_attn=False, norm_type='layer_norm',
+        qkv_bias=True, qk_normalization=False,
+    )
+    llm_config = dict(
+        architectures=['LlamaForCausalLM'], hidden_size=64, intermediate_size=128, num_attention_heads=4,
+        num_hidden_layers=1, vocab_size=128,
+    )
+    config = InternVLChatConfig(vision_config=vision_config, llm_config=llm_config, template='Hermes-2',
+                                select_layer=args.select_layer, ps_version='v2')
+    return InternVLChatModel(config).eval()
+
+
+def main(args):
+    import torch
+
+    torch.manual_seed(args.seed)
+    model = tiny_model(args)
+    failed = False
+    for num_bands in args.bands:
+        pixel_values = torch.randn(args.batch_size, num_bands, args.image_size, args.image_size)
+        for mode in MODES:
+            with torch.no_grad():
+                expected = legacy_sequential_vit_features(model, pixel_values, mode)
+            errors = []
+            for vit_chunk_size in [None] + args.vit_chunk_sizes:
+                output = model.sequential_vit_features(pixel_values, mode, vit_chunk_size)
+                error = (output - expected).abs().max().item() if output.shape == expected.shape else float('inf')
+                errors.append(error)
+            failed |= max(errors) > args.atol
+            print(f'{num_bands:>3} bands, {mode:>8}: {tuple(expected.shape)}, max error batched {errors[0]:.2e}, '
+                  f'chunked {max(errors[1:], default=0):.2e}')
+
+        # extract_feature reaches the chunked path through the config
+        multiband = torch.ones(args.batch_size, dtype=torch.long)
+        with torch.no_grad():
+            model.config.vit_chunk_size = 0
+            expected = model.extract_feature(pixel_values, multiband)
+            for vit_chunk_size in args.vit_chunk_sizes:
+                model.config.vit_chunk_size = vit_chunk_size
+                calls = []
+                hook = model.vision_model.register_forward_hook(lambda *_: calls.append(None))
+                output = model.extract_feature(pixel_values, multiband)
+                hook.remove()
+                num_groups = args.batch_size * math.ceil(num_bands / 3)
+                error = (output - expected).abs().max().item()
+                failed |= error > args.atol or len(calls) != math.ceil(num_groups / vit_chunk_size)
+                print(f'{num_bands:>3} bands, extract_feature with vit_chunk_size {vit_chunk_size}: '
+                      f'{len(calls)} ViT calls for {num_groups} groups, max error {error:.2e}')
+    model.config.vit_chunk_size = 0
+
+    # A batch mixing RGB tiles and 3-band multi-band tiles ('average' fuses them to the RGB shape)
+    pixel_values = torch.randn(2 * args.batch_size, 3, args.image_size, args.image_size)
+    image_modality = torch.arange(2 * args.batch_size) % 2
+    rgb = image_modality == 0
+    model.zero_grad()
+    output = model.extract_feature(pixel_values, image_modality, mm_spatial_pool_mode='average')
+    # The band-group path runs without gradients; the RGB tiles must still train the ViT
+    output[rgb].sum().backward()
+    vit_grad = sum(param.grad.abs().sum().item() for param in model.vision_model.parameters()
+                   if param.grad is not None)
+    with torch.no_grad():
+        expected = torch.empty_like(output)
+        for rows in (rgb, ~rgb):
+            expected[rows] = model.extract_feature(pixel_values[rows], image_modality[rows],
+                                                   mm_spatial_pool_mode='average')
+    error = (output.detach() - expected).abs().max().item()
+    failed |= error > args.atol or vit_grad == 0
+    print(f'mixed modality batch of {len(pixel_values)} tiles: max error {error:.2e}, '
+          f'ViT gradient of the RGB tiles {"ok" if vit_grad else "missing"}')
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--bands', type=int, nargs='+', default=[3, 4, 12, 13])
+    parser.add_argument('--batch-size', type=int, default=3)
+    parser.add_argument('--image-size', type=int, default=56)
+    parser.add_argument('--select-layer', type=int, default=-1)
+    parser.add_argument('--vit-chunk-sizes', type=int, nargs='+', default=[1, 2, 5])
+    parser.add_argument('--atol', type=float, default=1e-4)
+    parser.add_argument('--seed', type=int, default=0)
+    main(parser.parse_args())
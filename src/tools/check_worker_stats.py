@@ -0,0 +1,131 @@
+"""
+Check that the DataLoader workers report their data pipeline stages and failed samples.
+
+A synthetic shard of RGB images, some of them corrupt and some with a malformed conversation,
+is read by a `ShardDataLoader` through a DataLoader with `--num-workers` workers, started
+like the training entry points do. The logs of `DataProfilerCallback` and
+`SampleCounterCallback` must then hold the stage percentiles of the samples built in the
+workers and count the bad rows as failed or skipped samples. Only the corrupt rows may be
+quarantined: a malformed conversation fails its sample but is not a decoding error. With
+`--start-method spawn` the workers do not share the histograms and counters of their rank,
+and the check fails.
+
+Example:
+    python src/tools/check_worker_stats.py --model-name-or-path pretrained/EarthDial --num-workers 2
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+import tempfile
+from types import SimpleNamespace
+
+import numpy as np
+
+sys.path.append('./src')
+
+DS_NAME = 'check'
+# Stages of every sample of the tile engine path
+WORKER_STAGES = ['fetch', 'decode', 'tile', 'template', 'tokenize', 'sample']
+
+
+def build_shard(path, rows, corrupt_rows, malformed_rows, image_size):
+    from datasets import Dataset, Features, Image, Value
+    from PIL import Image as PILImage
+
+    rng = np.random.default_rng(0)
+    conversations = json.dumps([
+        {'from': 'human', 'value': '<image>\nDescribe the image.'},
+        {'from': 'gpt', 'value': 'A harbor with several ships.'},
+    ])
+
+    def gen():
+        for i in range(rows):
+            if i in corrupt_rows:
+                image = {'bytes': b'not an image', 'path': None}
+            else:
+                image = PILImage.fromarray(rng.integers(0, 255, (image_size, image_size, 3), dtype=np.uint8))
+            # A turn without its text raises a KeyError while the sample is built
+            yield {'conversations': '[{"from": "human"}]' if i in malformed_rows else conversations, 'image': image}
+
+    features = Features({'conversations': Value('string'), 'image': Image()})
+    Dataset.from_generator(gen, features=features).save_to_disk(path)
+
+
+def main(args):
+    import torch
+    import torch.distributed as dist
+    import torch.multiprocessing as mp
+    from torch.utils.data import DataLoader
+
+    from earthdial.train.constants import SPECIAL_TOKENS
+    from earthdial.train.dataloader import ShardDataLoader
+    from earthdial.train.profiler import DataProfilerCallback, enable_data_profiler
+    from earthdial.train.quarantine import SampleCounterCallback
+    from earthdial.train.tokenizer import load_tokenizer
+
+    mp.set_start_method(args.start_method, force=True)
+    tokenizer = load_tokenizer(args.model_name_or_path, use_fast=args.use_fast_tokenizer, add_eos_token=False)
+    tokenizer.add_tokens(SPECIAL_TOKENS, special_tokens=True)
+    tokenizer.model_max_length = args.max_length
+    rng = np.random.default_rng(args.seed)
+    bad_rows = rng.choice(args.rows, args.corrupt + args.malformed, replace=False).tolist()
+    corrupt_rows, malformed_rows = set(bad_rows[:args.corrupt]), set(bad_rows[args.corrupt:])
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        dist.init_process_group('gloo', init_method=f'file://{tmp_dir}/dist', rank=0, world_size=1)
+        annotation = os.path.join(tmp_dir, 'shard')
+        build_shard(annotation, args.rows, corrupt_rows, malformed_rows, args.image_size)
+
+        # Before the dataset registers its name and the workers start, as in training
+        enable_data_profiler()
+        meta = dict(annotation=annotation, image_key='image', conversation='conversations', repeat_time=1,
+                    data_augment=False, bands=3)
+        dataset = ShardDataLoader(
+            logging.getLogger(__name__), args.template, meta, tokenizer, None, ds_name=DS_NAME,
+            num_image_token=16, image_size=args.image_size, is_train=False, dynamic_image_size=True,
+            max_dynamic_patch=2,
+        )
+        loader = DataLoader(dataset, batch_size=args.batch_size, num_workers=args.num_workers, collate_fn=list)
+        num_samples = sum(len(batch) for batch in loader)
+        dataset.quarantine.refresh()
+        quarantined = set(dataset.quarantine.indices)
+
+        logs, training_args = {}, SimpleNamespace(device=torch.device('cpu'))
+        DataProfilerCallback().on_log(training_args, None, None, logs=logs)
+        SampleCounterCallback().on_log(training_args, None, None, logs=logs)
+        dist.destroy_process_group()
+
+    failed = False
+    for stage in WORKER_STAGES:
+        p50 = logs.get(f'data/{DS_NAME}/{stage}_p50_ms')
+        failed |= p50 is None
+        print(f'{stage:>9}: ' + (f'p50 {p50:.3f} ms, p95 {logs[f"data/{DS_NAME}/{stage}_p95_ms"]:.3f} ms'
+                                 if p50 is not None else 'not reported'))
+    bad_samples = logs['data_failed_samples'] + logs['data_skipped_samples']
+    failed |= logs['data_failed_samples'] == 0 or bad_samples < len(corrupt_rows) + len(malformed_rows)
+    failed |= quarantined != corrupt_rows
+    print(f'{num_samples} samples read by {args.num_workers} workers ({args.start_method}): '
+          f'{logs["data_failed_samples"]} failed and {logs["data_skipped_samples"]} skipped samples '
+          f'for {len(corrupt_rows)} corrupt and {len(malformed_rows)} malformed rows; '
+          f'quarantined rows {sorted(quarantined)}, corrupt rows {sorted(corrupt_rows)}')
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model-name-or-path', type=str, required=True, help='model or LLM of the tokenizer')
+    parser.add_argument('--use-fast-tokenizer', action='store_true')
+    parser.add_argument('--template', type=str, default='phi3-chat')
+    parser.add_argument('--rows', type=int, default=64)
+    parser.add_argument('--corrupt', type=int, default=4, help='rows whose image cannot be decoded')
+    parser.add_argument('--malformed', type=int, default=4, help='rows whose conversation has a turn without text')
+    parser.add_argument('--image-size', type=int, default=448)
+    parser.add_argument('--max-length', type=int, default=4096)
+    parser.add_argument('--batch-size', type=int, default=4)
+    parser.add_argument('--num-workers', type=int, default=2)
+    parser.add_argument('--start-method', type=str, default='fork', help='as set by finetune.py and pretrain.py')
+    parser.add_argument('--seed', type=int, default=0)
+    main(parser.parse_args())
@@ -0,0 +1,124 @@
+"""
+Pre-tokenize the conversations of the Arrow shard datasets of a meta file.
+
+Every dataset is written again, next to the original, with three more columns:
+`input_ids` and `labels`, tokenized with the fine-tuning tokenizer and template and
+with one image context marker per image (see `earthdial.train.pretokenize`), and
+`num_tiles`, the tiles of every sample with the given tiling. `ShardDataLoader` then
+reads the tokens instead of tokenizing the conversations every epoch. A meta file
+pointing at the new datasets is written to `--output-meta`.
+
+The tiling options and the meta file overrides (`max_dynamic_patch`, `dynamic_image`)
+must be those of the training run for `num_tiles` to be used; the tokens are valid for
+any tiling.
+
+Example:
+    python src/tools/pretokenize_shards.py --meta-path shell/data/finetune.json \\
+        --model-name-or-path pretrained/EarthDial --conv-style phi3-chat \\
+        --dynamic-image-size --use-thumbnail --max-dynamic-patch 6 \\
+        --output-meta shell/data/finetune_pretokenized.json
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+
+sys.path.append('./src')
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def pretokenize(ds_name, meta, tokenizer, args):
+    from datasets import Sequence, Value, load_from_disk
+
+    from earthdial.train.length_index import build_vit_tiles, sample_vit_tiles
+    from earthdial.train.pretokenize import PRETOKENIZED_NAME, pretokenized_settings, tokenize_conversations
+
+    raw_data = load_from_disk(meta['annotation'])
+    conversations_key = meta['conversation']
+    multi_image = str(ds_name).strip().startswith('Change')
+    num_image = len(meta['image_key'].split(',')) if multi_image else 1
+    tiling = {
+        'dynamic_image_size': meta.get('dynamic_image', args.dynamic_image_size),
+        'min_dynamic_patch': args.min_dynamic_patch,
+        'max_dynamic_patch': meta.get('max_dynamic_patch', args.max_dynamic_patch),
+        'image_size': args.force_image_size,
+        'use_thumbnail': args.use_thumbnail,
+    }
+
+    features = raw_data.features.copy()
+    features['input_ids'] = Sequence(Value('int32'))
+    features['labels'] = Sequence(Value('int32'))
+    # Only the conversation column is passed to the tokenizer; the other columns are copied
+    pretokenized = raw_data.map(
+        tokenize_conversations,
+        batched=True,
+        batch_size=args.batch_size,
+        input_columns=[conversations_key],
+        fn_kwargs=dict(tokenizer=tokenizer, template_name=args.conv_style, ds_name=ds_name, num_image=num_image),
+        features=features,
+        num_proc=args.num_proc,
+        desc=f'Tokenizing {ds_name}',
+    )
+    tiles = sample_vit_tiles(
+        raw_data,
+        meta['image_key'],
+        ds_name,
+        tiling['dynamic_image_size'],
+        tiling['max_dynamic_patch'],
+        lambda columns, max_dynamic_patch: build_vit_tiles(
+            raw_data, columns, tiling['min_dynamic_patch'], max_dynamic_patch, tiling['image_size'],
+            tiling['use_thumbnail'],
+        ),
+    )
+    pretokenized = pretokenized.add_column('num_tiles', tiles)
+
+    output = os.path.normpath(meta['annotation']) + args.output_suffix
+    pretokenized.save_to_disk(output, num_proc=args.num_proc)
+    settings = pretokenized_settings(tokenizer, args.conv_style, conversations_key)
+    settings['tiling'] = tiling
+    with open(os.path.join(output, PRETOKENIZED_NAME), 'w') as f:
+        json.dump(settings, f, indent=2)
+    logger.info(f'Pre-tokenized {ds_name} ({len(pretokenized)} samples): {output}')
+    return output
+
+
+def main(args):
+    from earthdial.train.constants import SPECIAL_TOKENS
+    from earthdial.train.tokenizer import load_tokenizer
+
+    # The tokenizer of the fine-tuning run, with the same added tokens
+    tokenizer = load_tokenizer(args.model_name_or_path, use_fast=args.use_fast_tokenizer, add_eos_token=False)
+    tokenizer.add_tokens(SPECIAL_TOKENS, special_tokens=True)
+    # Nothing is truncated here: samples are truncated after their image spans are expanded
+    tokenizer.model_max_length = sys.maxsize
+
+    with open(args.meta_path) as f:
+        ds_collections = json.load(f)
+    for ds_name in args.datasets or list(ds_collections):
+        ds_collections[ds_name] = dict(ds_collections[ds_name])
+        ds_collections[ds_name]['annotation'] = pretokenize(ds_name, ds_collections[ds_name], tokenizer, args)
+    if args.output_meta:
+        with open(args.output_meta, 'w') as f:
+            json.dump(ds_collections, f, indent=2)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--meta-path', type=str, required=True)
+    parser.add_argument('--model-name-or-path', type=str, required=True, help='model or LLM of the tokenizer')
+    parser.add_argument('--use-fast-tokenizer', action='store_true')
+    parser.add_argument('--conv-style', type=str, default='internlm2-chat')
+    parser.add_argument('--datasets', type=str, nargs='+', help='datasets of the meta file (default: all)')
+    parser.add_argument('--force-image-size', type=int, default=448)
+    parser.add_argument('--dynamic-image-size', action='store_true')
+    parser.add_argument('--use-thumbnail', action='store_true')
+    parser.add_argument('--min-dynamic-patch', type=int, default=1)
+    parser.add_argument('--max-dynamic-patch', type=int, default=12)
+    parser.add_argument('--output-suffix', type=str, default='-pretokenized')
+    parser.add_argument('--output-meta', type=str)
+    parser.add_argument('--batch-size', type=int, default=1000)
+    parser.add_argument('--num-proc', type=int, default=min(8, os.cpu_count() or 1))
+    main(parser.parse_args())
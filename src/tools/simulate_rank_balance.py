@@ -0,0 +1,98 @@
+"""
+Simulate the step-time skew between ranks of the length-grouped sampler.
+
+Each rank's step time is modeled as its padded LLM tokens (batch size times the
+longest sample) plus `vit_tile_cost` per ViT pass. An all-reduce waits for the slowest rank, so
+a step lasts as long as its slowest rank, and the skew of a step is its slowest rank over the mean rank.
+The same samples are grouped by the token lengths of the length index twice: with the
+megabatches split between the ranks on the same lengths (before), and on the per-sample
+cost of `ShardDataLoader`: the LLM tokens of the actual tiles plus the weighted ViT
+passes (after).
+
+Samples are synthetic by default. Real shards can be simulated from their sidecar
+indexes, e.g. `--lengths data.lengths-<key>.npy --tiles data.tiles-<key>.npy --bands 12`.
+
+Example:
+    python src/tools/simulate_rank_balance.py --num-samples 200000 --world-size 64
+"""
+import argparse
+import sys
+
+import numpy as np
+import torch
+
+sys.path.append('./src')
+
+
+def synthetic_samples(args, rng):
+    from earthdial.train.tiling import get_tile_grid
+
+    # Text tokens, image aspect ratios and, for a fraction of the samples, multi-band images
+    text_tokens = rng.lognormal(np.log(args.mean_text_tokens), 0.8, args.num_samples).astype(np.int64)
+    aspect_ratios = np.exp(rng.uniform(np.log(1 / 4), np.log(4), args.num_samples))
+    tiles = np.empty(args.num_samples, dtype=np.int64)
+    for i, aspect_ratio in enumerate(aspect_ratios):
+        cols, rows = get_tile_grid(int(448 * aspect_ratio), 448, 1, args.max_dynamic_patch, 448)
+        tiles[i] = cols * rows + int(cols * rows != 1)
+    band_groups = np.where(rng.random(args.num_samples) < args.multiband_fraction, -(-args.bands // 3), 1)
+    # The length index counts the worst-case image tokens; the model sees the actual ones
+    lengths = text_tokens + args.num_image_token * (args.max_dynamic_patch + 1)
+    tokens = text_tokens + args.num_image_token * tiles
+    return lengths, tokens, tiles * band_groups
+
+
+def indexed_samples(args):
+    lengths = np.load(args.lengths).astype(np.int64)
+    if not args.tiles:
+        return lengths, lengths, np.full_like(lengths, -(-args.bands // 3))
+    tiles = np.load(args.tiles).astype(np.int64)
+    tokens = np.maximum(lengths + args.num_image_token * (tiles - args.max_dynamic_patch - 1), 1)
+    return lengths, tokens, tiles * -(-args.bands // 3)
+
+
+def step_times(order, tokens, vit_passes, batch_size, world_size, vit_tile_cost):
+    """Return the `[steps, world_size]` modeled time of every rank at every step."""
+    num_steps = len(order) // (batch_size * world_size)
+    batches = order[:num_steps * batch_size * world_size].reshape(num_steps, world_size, batch_size)
+    return batch_size * tokens[batches].max(axis=2) + vit_tile_cost * vit_passes[batches].sum(axis=2)
+
+
+def report(name, times):
+    slowest, mean = times.max(axis=1), times.mean(axis=1)
+    skew = slowest / mean - 1
+    print(f'{name:>30s}: mean skew {skew.mean():6.1%}, p95 skew {np.percentile(skew, 95):6.1%}, '
+          f'time lost to stragglers {1 - mean.sum() / slowest.sum():6.1%}, total {slowest.sum():.3e}')
+    return slowest.sum()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--num-samples', type=int, default=200_000)
+    parser.add_argument('--batch-size', type=int, default=4)
+    parser.add_argument('--world-size', type=int, default=64)
+    parser.add_argument('--vit-tile-cost', type=float, default=80.0,
+                        help='compute of a ViT tile in LLM tokens (see estimate_vit_tile_cost)')
+    parser.add_argument('--num-image-token', type=int, default=256)
+    parser.add_argument('--max-dynamic-patch', type=int, default=6)
+    parser.add_argument('--mean-text-tokens', type=float, default=300)
+    parser.add_argument('--multiband-fraction', type=float, default=0.3)
+    parser.add_argument('--bands', type=int, default=12)
+    parser.add_argument('--lengths', help='token length index (.npy) of a shard')
+    parser.add_argument('--tiles', help='tile index (.npy) of the same shard')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    from earthdial.patch.train_sampler_patch import get_length_grouped_indices
+
+    rng = np.random.default_rng(args.seed)
+    lengths, tokens, vit_passes = indexed_samples(args) if args.lengths else synthetic_samples(args, rng)
+    costs = tokens + np.round(args.vit_tile_cost * vit_passes).astype(np.int64)
+
+    totals = []
+    for name, balance_on in [('balanced on token lengths', None), ('balanced on tokens + ViT cost', costs)]:
+        order = np.asarray(get_length_grouped_indices(
+            lengths, args.batch_size, args.world_size, generator=torch.Generator().manual_seed(args.seed),
+            costs=balance_on))
+        totals.append(report(name, step_times(order, tokens, vit_passes, args.batch_size,
+                                              args.world_size, args.vit_tile_cost)))
+    print(f'expected speedup of the cost balancing: {totals[0] / totals[1]:.3f}x')